@@ -3,34 +3,274 @@
 #
 # Camera module
 #
+import Instrumentation
+import collections
 import cv2
+import glob
 import io
 import numpy as np
-import picamera
+import os
 import random
+import threading
 import time
 
+Frame = collections.namedtuple('Frame', ['seq', 'timestamp', 'image'])
+
+def openCamera(backend=None):
+    """Open a camera backend. Hardware support is only imported when the
+       raspberry pi camera is opened.
+    
+    :param backend (str): 'pi' for the raspberry pi camera, 'replay' to replay
+                          the images in $BOGIE_REPLAY (a glob, default: the
+                          photos directory), or 'sim' for a synthesized scene.
+                          Defaults to $BOGIE_CAMERA, else 'sim' if
+                          $BOGIE_BACKEND is 'sim', else 'pi'.
+    :return (tuple): picamera.PiCamera compatible object, and the seconds it
+                     needs to warm up
+    """
+    if backend is None:
+        backend = os.environ.get('BOGIE_CAMERA')
+    if backend is None:
+        sim = os.environ.get('BOGIE_BACKEND') == 'sim'
+        backend = 'sim' if sim else 'pi'
+    
+    if backend == 'pi':
+        import picamera
+        return picamera.PiCamera(), 2
+    
+    import Simulation
+    if backend == 'replay':
+        files = None
+        if 'BOGIE_REPLAY' in os.environ:
+            files = sorted(glob.glob(os.environ['BOGIE_REPLAY']))
+        return Simulation.ReplayCamera(files), 0
+    elif backend == 'sim':
+        return Simulation.SimCamera(), 0
+    
+    raise ValueError('Unknown camera backend: %s' % backend)
+
 class BogieCamera:
     """Interface to the rover's raspberry pi camera.
     """
-    def __init__(self, res=(740, 480), framerate=30):
+    modes = ('jpeg', 'bgr', 'yuv', 'gray')
+    
+    def __init__(self, res=(740, 480), framerate=30, mode='jpeg', camera=None,
+                 ring_size=3, backend=None):
         """Initialize the vision class
         
+        :param res (tuple): (width,height) of captured frames
+        :param framerate (int): camera framerate
+        :param mode (str): 'jpeg' captures and decodes a JPEG still. 'bgr'
+                           and 'yuv' capture unencoded frames from the video
+                           port straight into a reused buffer, and 'gray'
+                           does the same but keeps only the Y plane.
+        :param camera (picamera.PiCamera): camera to use (default: open one
+                                           with openCamera)
+        :param ring_size (int): number of frame buffers used when streaming,
+                                or 0 for a camera that is only captured from
+                                directly (no start)
+        :param backend (str): camera backend to open (see openCamera)
         :inst self.camera (picamera class): Camera object
+        :inst self.mode (str): capture mode
+        :inst self.buffer (numpy.array): raw capture buffer (None for jpeg)
+        :inst self.ring (list): frame buffers filled by the streaming thread
+        :inst self.frame (Frame): newest streamed frame
+        :inst self.held (int): ring slot of the frame the consumer is using
+        :inst self.counters (dict): streaming frame and latency counters
         """
-        self.camera = picamera.PiCamera()
+        if 0 < ring_size < 3: # One being written, one published, one in use
+            raise ValueError('Streaming needs a ring of at least 3 frames')
+        
+        if mode not in self.modes:
+            raise ValueError('Unknown capture mode: %s' % mode)
+        
+        warmup = 0
+        if camera is None:
+            camera, warmup = openCamera(backend)
+        
+        self.camera = camera
         self.camera.resolution = res
         self.camera.framerate = framerate
+        self.mode = mode
+        self.buffer = self.allocBuffer()
+        self.ring = [self.allocBuffer() for _ in range(ring_size)]
+        self.frame = None
+        self.frame_slot = None
+        self.held = None
+        self.consumed_seq = 0
+        self.counters = {'captured': 0, 'consumed': 0, 'dropped': 0,
+                         'latency_total': 0., 'latency_max': 0.}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.streaming = False
         self.camera.start_preview()
-        time.sleep(2)
+        time.sleep(warmup)
     
-    def shoot(self):
-        """Takes a photo from the camera
+    def allocBuffer(self):
+        """Allocate the buffer unencoded frames are captured into. The camera
+           pads unencoded output to a multiple of 32 columns and 16 rows.
         
+        :return buffer (numpy.array): Capture buffer, or None in jpeg mode
+        """
+        width, height = self.camera.resolution
+        pad_width = (width + 31) // 32 * 32
+        pad_height = (height + 15) // 16 * 16
+        if self.mode == 'bgr':
+            return np.empty((pad_height, pad_width, 3), dtype=np.uint8)
+        elif self.mode in ('yuv', 'gray'): # Planar YUV420: Y, then U and V
+            return np.empty((pad_height * 3 // 2, pad_width), dtype=np.uint8)
+        
+        return None
+    
+    @Instrumentation.timed('camera.capture')
+    def capture(self, buffer):
+        """Capture a frame into `buffer` (see shoot)
+        
+        :param buffer (numpy.array): Buffer from allocBuffer
         :return output (numpy.array): Photograph in array form
         """
-        stream = io.BytesIO()
-        self.camera.capture(stream, format='jpeg')
-        data = np.fromstring(stream.getvalue(), dtype=np.uint8)
-        output = cv2.imdecode(data, 1)
-        return output
+        if self.mode == 'jpeg':
+            stream = io.BytesIO()
+            self.camera.capture(stream, format='jpeg')
+            data = np.frombuffer(stream.getbuffer(), dtype=np.uint8)
+            output = cv2.imdecode(data, 1)
+            return output
+        
+        width, height = self.camera.resolution
+        if self.mode == 'bgr':
+            self.camera.capture(buffer, format='bgr', use_video_port=True)
+            return buffer[:height,:width]
+        
+        self.camera.capture(buffer, format='yuv', use_video_port=True)
+        if self.mode == 'gray':
+            return buffer[:height,:width]
+        
+        return buffer
+    
+    def consume(self):
+        """Hand the published frame to the consumer (condition must be held)
+        
+        :return frame (Frame): Newest unconsumed frame, or None
+        """
+        frame = self.frame
+        if frame is None or frame.seq <= self.consumed_seq:
+            return None
+        
+        self.held = self.frame_slot
+        self.consumed_seq = frame.seq
+        latency = time.time() - frame.timestamp
+        self.counters['consumed'] += 1
+        self.counters['latency_total'] += latency
+        self.counters['latency_max'] = max(self.counters['latency_max'],
+                                           latency)
+        return frame
+    
+    def frames(self, timeout=None):
+        """Iterate over streamed frames, skipping any that went stale while
+           the previous one was being processed
+        
+        :param timeout (float): Max seconds to wait for each frame
+        :return (generator): Frame tuples, until streaming stops
+        """
+        while self.streaming:
+            frame = self.getFrame(timeout)
+            if frame is None:
+                return
+            yield frame
+    
+    def getFrame(self, timeout=None):
+        """Wait for a frame newer than the last one consumed
+        
+        :param timeout (float): Max seconds to wait (default: forever)
+        :return frame (Frame): Newest frame, or None on timeout or if
+                               streaming stopped
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.streaming or
+                                    self.frame is not None and
+                                    self.frame.seq > self.consumed_seq,
+                                    timeout)
+            return self.consume()
+    
+    def getStats(self):
+        """Report streaming counters
+        
+        :return stats (dict): frames captured, consumed and dropped, and the
+                              mean and max capture-to-consume latency
+        """
+        with self.condition:
+            stats = dict(self.counters)
+        
+        latency_total = stats.pop('latency_total')
+        stats['latency_mean'] = latency_total / max(1, stats['consumed'])
+        return stats
+    
+    def latest(self):
+        """Return the newest frame without waiting. Its image stays valid
+           until the next call to latest, getFrame or frames.
+        
+        :return frame (Frame): Newest frame, or None if there isn't one that
+                               hasn't already been consumed
+        """
+        with self.condition:
+            return self.consume()
+    
+    def shoot(self):
+        """Takes a photo from the camera. Outside of jpeg mode the photo is a
+           view of the capture buffer, which is overwritten by the next shot;
+           copy it if it needs to be kept.
+        
+        :return output (numpy.array): Photograph in array form. BGR in jpeg
+                                      and bgr mode, the padded planar YUV420
+                                      frame in yuv mode and the Y plane in
+                                      gray mode.
+        """
+        return self.capture(self.buffer)
+    
+    def start(self):
+        """Start streaming: a background thread captures frames continuously
+           into the ring, and consumers take the newest one with latest,
+           getFrame or frames.
+        """
+        if self.streaming:
+            return
+        if not self.ring:
+            raise ValueError('Camera was opened without a streaming ring')
+        
+        self.streaming = True
+        self.thread = threading.Thread(target=self.stream)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Stop streaming and wait for the capture thread to finish
+        """
+        with self.condition:
+            self.streaming = False
+            self.condition.notify_all()
+        
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+    
+    def stream(self):
+        """Capture loop run by the streaming thread. Each frame is written
+           into a ring slot that is neither published nor in use, then
+           published, replacing (and dropping) any frame not yet consumed.
+        """
+        while self.streaming:
+            with self.condition:
+                slot = [i for i in range(len(self.ring))
+                        if i != self.held and i != self.frame_slot][0]
+            
+            image = self.capture(self.ring[slot])
+            timestamp = time.time()
+            with self.condition:
+                if self.frame is not None and \
+                   self.frame.seq > self.consumed_seq:
+                    self.counters['dropped'] += 1
+                self.counters['captured'] += 1
+                self.frame = Frame(self.counters['captured'], timestamp, image)
+                self.frame_slot = slot
+                self.condition.notify_all()
+
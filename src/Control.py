@@ -0,0 +1,256 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Control module
+#
+import threading
+import time
+
+class PID:
+    """PID controller with output limits. The integral only accumulates
+       while the output isn't saturated, so it can't wind up while the
+       rover is already steering as hard as it can.
+    """
+    def __init__(self, kp=1., ki=0., kd=0., limits=(-1., 1.)):
+        """Initialize
+        
+        :param kp (float): Proportional gain
+        :param ki (float): Integral gain
+        :param kd (float): Derivative gain
+        :param limits (tuple): (min,max) of the output
+        :inst self.integral (float): accumulated error
+        :inst self.last_error (float): error of the previous update, or None
+        """
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.limits = limits
+        self.integral = 0.
+        self.last_error = None
+    
+    def reset(self):
+        """Forget the accumulated state
+        """
+        self.integral = 0.
+        self.last_error = None
+    
+    def update(self, error, dt):
+        """Compute the next output
+        
+        :param error (float): Setpoint minus measurement
+        :param dt (float): Seconds since the previous update
+        :return output (float): Control output, within the limits
+        """
+        derivative = 0.
+        if self.last_error is not None and dt > 0:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+        
+        integral = self.integral + error * dt
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        low, high = self.limits
+        if low <= output <= high:
+            self.integral = integral
+        
+        return min(high, max(low, output))
+
+
+class SteeringController:
+    """Closed-loop steering and speed control at a fixed rate, independent of
+       the vision rate. Vision reports the target position with update, and
+       a control thread (or a replay calling step directly) extrapolates the
+       target's horizontal offset to each tick, steers toward it with a PID
+       controller, and slows down while the target is far off center.
+    """
+    def __init__(self, drive, width, rate=20., max_speed=50, steering=None,
+                 slowdown=0.5, slew=200., stale=0.5, clock=time.time):
+        """Initialize
+        
+        :param drive (MotionScheduler): anything with drive(speed, steering)
+        :param width (int): Width of the camera images, in pixels
+        :param rate (float): Control loop rate in Hz
+        :param max_speed (int): 0<x<254, speed when the target is centered
+        :param steering (PID): Steering controller (default: PID(1., .1, .05))
+        :param slowdown (float): Fraction of max_speed shed as the target
+                                 moves to the edge of the image
+        :param slew (float): Max change in speed per second
+        :param stale (float): Seconds without a vision update before the
+                              rover stops
+        :param clock (function): Time source, matching the timestamps passed
+                                 to update
+        :inst self.observation (tuple): (timestamp, offset) of the latest
+                                        target position, offset from -1 (left
+                                        edge) to 1 (right edge), or None
+        :inst self.offset_rate (float): estimated offset change per second
+        :inst self.speed (float): speed commanded on the last tick
+        :inst self.engaged (bool): whether the controller is driving the rover
+        :inst self.counters (dict): control loop timing counters
+        """
+        if rate <= 0:
+            raise ValueError('Control rate must be positive')
+        
+        self.drive = drive
+        self.width = width
+        self.period = 1. / rate
+        self.max_speed = max_speed
+        self.steering = steering if steering is not None else PID(1., .1, .05)
+        self.slowdown = slowdown
+        self.slew = slew
+        self.stale = stale
+        self.clock = clock
+        self.observation = None
+        self.offset_rate = 0.
+        self.speed = 0.
+        self.last_step = None
+        self.engaged = False
+        self.counters = {'ticks': 0, 'overruns': 0, 'jitter_total': 0.,
+                         'jitter_max': 0., 'busy_max': 0.}
+        self.lock = threading.Lock()
+        self.sending = threading.Lock() # Held from a tick's step to its send
+        self.stopping = threading.Event()
+        self.thread = None
+    
+    def disengage(self):
+        """Let go of the drive until vision reports the target again, without
+           stopping the rover: once this returns, no tick sends a command, so
+           another motion (a search turn) can take over the drive without a
+           tick in flight preempting it
+        """
+        with self.sending, self.lock:
+            self.observation = None
+            self.offset_rate = 0.
+            self.engaged = False
+            self.speed = 0.
+            self.steering.reset()
+    
+    def estimate(self, now):
+        """Extrapolate the target offset to the given time, assuming it keeps
+           moving across the image at the estimated rate
+        
+        :param now (float): Time to estimate the offset at
+        :return offset (float): -1 to 1, or None if vision has gone stale
+        """
+        if self.observation is None:
+            return None
+        
+        timestamp, offset = self.observation
+        age = now - timestamp
+        if age > self.stale:
+            return None
+        
+        offset += self.offset_rate * max(0., age)
+        return min(1., max(-1., offset))
+    
+    def getStats(self):
+        """Report control loop timing
+        
+        :return stats (dict): ticks, overruns (ticks that started more than a
+                              period late), mean and max wake-up jitter, and
+                              the longest time spent on one tick, in seconds
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        
+        jitter_total = stats.pop('jitter_total')
+        stats['jitter_mean'] = jitter_total / max(1, stats['ticks'])
+        return stats
+    
+    def run(self):
+        """Control loop run by the control thread. Ticks are scheduled on a
+           fixed grid; if one starts more than a period late, the missed ones
+           are skipped rather than run back to back.
+        """
+        next_tick = self.clock()
+        while not self.stopping.wait(max(0., next_tick - self.clock())):
+            now = self.clock()
+            lateness = max(0., now - next_tick)
+            with self.sending:
+                command = self.step(now)
+                if command is not None:
+                    self.drive.drive(*command)
+            
+            with self.lock:
+                self.counters['ticks'] += 1
+                self.counters['jitter_total'] += lateness
+                self.counters['jitter_max'] = max(self.counters['jitter_max'],
+                                                  lateness)
+                self.counters['busy_max'] = max(self.counters['busy_max'],
+                                                self.clock() - now)
+                if lateness > self.period:
+                    self.counters['overruns'] += 1
+                    next_tick = now
+            
+            next_tick += self.period
+    
+    def start(self):
+        """Start the control thread
+        """
+        if self.thread is not None:
+            return
+        
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def step(self, now):
+        """Compute the command for one control tick. Doesn't read the clock
+           or touch the drive, so recorded updates can be replayed through it.
+        
+        :param now (float): Time of the tick
+        :return command (tuple): (speed, steering) to send, or None if the
+                                 controller isn't driving the rover. When
+                                 vision goes stale it returns (0, 0.) once,
+                                 which stops the rover, and None after that.
+        """
+        with self.lock:
+            dt = self.period
+            if self.last_step is not None:
+                dt = max(0., now - self.last_step)
+            self.last_step = now
+            
+            offset = self.estimate(now)
+            if offset is None:
+                if not self.engaged:
+                    return None
+                self.engaged = False
+                self.speed = 0.
+                self.steering.reset()
+                return (0, 0.)
+            
+            self.engaged = True
+            steering = self.steering.update(offset, dt)
+            target = self.max_speed * (1. - self.slowdown * abs(offset))
+            change = self.slew * dt
+            self.speed = min(self.speed + change,
+                             max(self.speed - change, target))
+            return (int(round(self.speed)), steering)
+    
+    def stop(self):
+        """Stop the control thread. The rover is left as it was; stop or
+           shut down the drive separately.
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+    
+    def update(self, center, timestamp):
+        """Report a new target position from vision
+        
+        :param center (tuple): (row,col) of the target, or None if it was lost
+        :param timestamp (float): capture time of the frame it was found in
+        """
+        with self.lock:
+            if center is None:
+                self.observation = None
+                self.offset_rate = 0.
+                return
+            
+            offset = ((2. * center[1]) / self.width) - 1
+            if self.observation is not None and \
+               timestamp > self.observation[0]:
+                rate = (offset - self.observation[1]) / \
+                       (timestamp - self.observation[0])
+                self.offset_rate = 0.5 * (self.offset_rate + rate)
+            self.observation = (timestamp, offset)
@@ -0,0 +1,220 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Diagnostics module
+#
+import Instrumentation
+import collections
+import cv2
+import numpy as np
+import os
+import threading
+import time
+
+# Pixel offsets of the dot drawn for each particle (a filled 5x5 disc)
+DOT = np.array([(dy, dx) for dy in range(-2, 3) for dx in range(-2, 3)
+                if dy * dy + dx * dx <= 5])
+
+def drawParticles(out, particles, color=(0,255,255)):
+    """Draw a dot at every particle, in place, with one fancy-indexed
+       assignment instead of a cv2.circle call per particle
+    
+    :param out (numpy.array): Image to draw on
+    :param particles (numpy.array): (N,2) particle positions (row,col)
+    :param color (tuple): BGR dot color
+    """
+    particles = np.asarray(particles)
+    if len(particles) == 0:
+        return
+    
+    height, width = out.shape[:2]
+    inside = (particles[:,0] > 0) & (particles[:,0] < height) & \
+             (particles[:,1] > 0) & (particles[:,1] < width)
+    particles = particles[inside]
+    rows = np.clip(particles[:,0,None] + DOT[:,0], 0, height - 1)
+    cols = np.clip(particles[:,1,None] + DOT[:,1], 0, width - 1)
+    out[rows,cols] = color
+
+@Instrumentation.timed('diagnostics.draw')
+def genTrackingImg(img, particles, center, target):
+    """Generate an image of the tracking progress
+    
+    :param img (numpy.array): camera image
+    :param particles (numpy.array): (N,2) particle positions
+    :param center (tuple): best guess of the target center, or None
+    :param target (numpy.array): target template, pasted in the top left
+    :return out (numpy.array): camera image with particles and
+                               best guess rectangle
+    """
+    out = np.copy(img)
+    drawParticles(out, particles)
+    if center is not None:
+        cv2.rectangle(out, (int(center[1]) - target.shape[1]//2,
+                            int(center[0]) - target.shape[0]//2),
+                           (int(center[1]) + target.shape[1]//2,
+                            int(center[0]) + target.shape[0]//2),
+                      (255,255,255), 3)
+    
+    h = min(target.shape[0], out.shape[0])
+    w = min(target.shape[1], out.shape[1])
+    out[0:h,0:w] = target[0:h,0:w]
+    return out
+
+
+class DiagnosticWriter:
+    """Draws and writes tracking images on a background thread, so the
+       tracking loop only pays for copying the frame. Images wait in a small
+       queue that drops the oldest when full, and can be sampled and rate
+       limited before they are even copied.
+    """
+    def __init__(self, output_dir='../../output', max_rate=5., sample=1,
+                 queue_size=4, keep_frames=True, stream=None):
+        """Initialize
+        
+        :param output_dir (str): Directory for <n>.jpg and latest.jpg,
+                                 created if missing
+        :param max_rate (float): Max images written per second (None: no
+                                 limit)
+        :param sample (int): Only consider every sample'th submitted image
+        :param queue_size (int): Max images waiting to be written
+        :param keep_frames (bool): Write every image as <n>.jpg, as well as
+                                   replacing latest.jpg
+        :param stream (str): if given, also append every image to this
+                             MJPEG file (concatenated JPEGs, which ffmpeg and
+                             VLC can play) in output_dir
+        :inst self.queue (collections.deque): images waiting to be written
+        :inst self.counters (dict): submitted, skipped (sampling and rate
+                                    limit), dropped (queue full), written
+                                    and failed (I/O error) images, and the
+                                    time spent writing
+        :inst self.error (str): the latest I/O error, or None
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.max_rate = max_rate
+        self.sample = max(1, int(sample))
+        self.keep_frames = keep_frames
+        self.queue = collections.deque(maxlen=queue_size)
+        self.counters = {'submitted': 0, 'skipped': 0, 'dropped': 0,
+                         'written': 0, 'failed': 0, 'write_time': 0.}
+        self.error = None
+        self.last_accepted = 0.
+        self.seq = 0
+        self.stream = None
+        if stream is not None:
+            self.stream = open(os.path.join(output_dir, stream), 'ab')
+        
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def close(self):
+        """Write whatever is still queued, then stop the writer thread
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        
+        self.thread.join()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+    
+    def getStats(self):
+        """Report the writer's counters
+        
+        :return stats (dict): counters, the mean seconds per image written,
+                              and the latest I/O error, if any
+        """
+        with self.condition:
+            stats = dict(self.counters)
+            if self.error is not None:
+                stats['error'] = self.error
+        
+        stats['write_mean'] = stats['write_time'] / max(1, stats['written'])
+        return stats
+    
+    def submit(self, img, particles, center, target, seq=None):
+        """Queue a tracking image, unless sampling or the rate limit skips it
+        
+        :param img (numpy.array): camera image (copied if accepted)
+        :param particles (numpy.array): (N,2) particle positions
+        :param center (tuple): best guess of the target center, or None
+        :param target (numpy.array): target template
+        :param seq (int): image number for the file name (default: count)
+        :return (boolean): True if the image was queued
+        """
+        now = time.time()
+        with self.condition:
+            self.counters['submitted'] += 1
+            self.seq = self.seq + 1 if seq is None else seq
+            if self.counters['submitted'] % self.sample or \
+               self.max_rate and now - self.last_accepted < 1. / self.max_rate:
+                self.counters['skipped'] += 1
+                return False
+            self.last_accepted = now
+            seq = self.seq
+        
+        item = (seq, img.copy(), np.array(particles), center, target.copy())
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.counters['dropped'] += 1
+            self.queue.append(item)
+            self.condition.notify()
+        
+        return True
+    
+    def work(self):
+        """Writer thread: draw, encode and write queued images. An image that
+           can't be written is counted and the thread carries on, so a full
+           disk doesn't stop diagnostics for good.
+        """
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                seq, img, particles, center, target = self.queue.popleft()
+            
+            start = time.time()
+            try:
+                self.write(seq, genTrackingImg(img, particles, center,
+                                               target))
+            except OSError as e:
+                with self.condition:
+                    self.counters['failed'] += 1
+                    self.error = str(e)
+                continue
+            with self.condition:
+                self.counters['written'] += 1
+                self.counters['write_time'] += time.time() - start
+    
+    @Instrumentation.timed('diagnostics.write')
+    def write(self, seq, img):
+        """Encode an image once and write it out. latest.jpg is replaced
+           atomically, so readers never see a partly written file.
+        
+        :param seq (int): image number
+        :param img (numpy.array): tracking image
+        """
+        ok, data = cv2.imencode('.jpg', img)
+        if not ok:
+            return
+        
+        data = data.tobytes()
+        Instrumentation.count('diagnostics.bytes', len(data))
+        if self.keep_frames:
+            path = os.path.join(self.output_dir, '%d.jpg' % seq)
+            with open(path, 'wb') as f:
+                f.write(data)
+        
+        latest = os.path.join(self.output_dir, 'latest.jpg')
+        with open(latest + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(latest + '.tmp', latest)
+        
+        if self.stream is not None:
+            self.stream.write(data)
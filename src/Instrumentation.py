@@ -0,0 +1,403 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Instrumentation module
+#
+# Timing spans, counters and latency histograms for the hot paths, cheap
+# enough to leave on: a timed call costs two clock reads and a few integer
+# updates, and nothing but a flag check when instrumentation is disabled
+# ($BOGIE_INSTRUMENT=0, or setEnabled). Latencies are kept in log2
+# histograms, so percentiles are approximate (within a factor of two) but
+# recording never allocates. Updates aren't locked; the rare increment lost
+# to a race between threads timing the same name is an accepted cost.
+#
+# $BOGIE_STATS names where openReporter periodically dumps the stats: a log
+# file, or unix:<path> for a local UNIX datagram socket. Each dump resets
+# the stats, but what was reset is kept, for getStats(cumulative=True).
+# With $BOGIE_PROFILE set to a file, openProfiler lets SIGUSR1 start and
+# stop a sampling profiler that writes its stacks there.
+#
+import collections
+import functools
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+ENABLED = os.environ.get('BOGIE_INSTRUMENT', '1') != '0'
+BUCKETS = 64 # Bucket i counts spans of 2**(i-1) to 2**i microseconds
+
+class Stat:
+    """Count, total, max and histogram of one named span or counter
+    """
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    
+    def __init__(self):
+        """Initialize
+        
+        :inst self.count (int): spans recorded, or the counter's value
+        :inst self.total (int): total span time, in nanoseconds
+        :inst self.max (int): longest span, in nanoseconds
+        :inst self.buckets (list): log2 histogram of span microseconds
+        """
+        self.buckets = [0] * BUCKETS
+        self.reset()
+    
+    def merge(self, other):
+        """Add another stat's spans or count to this one
+        
+        :param other (Stat): Stat to add
+        """
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+    
+    def record(self, elapsed):
+        """Record one span
+        
+        :param elapsed (int): Duration in nanoseconds
+        """
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[(elapsed // 1000).bit_length()] += 1
+    
+    def reset(self):
+        """Start counting afresh. The histogram list is kept, since timed
+           functions hold on to it.
+        """
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets[:] = [0] * BUCKETS
+    
+    def summarize(self):
+        """Compact summary, in microseconds
+        
+        :return (dict): n, and for spans mean, p50, p99 (upper bucket bounds)
+                        and max, and the histogram trimmed of empty buckets
+                        at either end as [first bucket, counts...]
+        """
+        if self.total == 0:
+            return {'n': self.count}
+        
+        used = [i for i, n in enumerate(self.buckets) if n]
+        first, last = used[0], used[-1]
+        summary = {'n': self.count,
+                   'mean': round(self.total / 1000. / self.count, 1),
+                   'max': round(self.max / 1000., 1),
+                   'hist': [first] + self.buckets[first:last + 1]}
+        for name, fraction in (('p50', 0.5), ('p99', 0.99)):
+            seen = 0
+            for i, n in enumerate(self.buckets):
+                seen += n
+                if seen >= fraction * self.count:
+                    summary[name] = 1 << i
+                    break
+        return summary
+
+
+stats = collections.defaultdict(Stat)
+history = collections.defaultdict(Stat) # What getStats(reset=True) reset
+
+def count(name, n=1):
+    """Add to a counter
+    
+    :param name (str): Counter name
+    :param n (int): Amount to add
+    """
+    if ENABLED:
+        stats[name].count += n
+
+def getStats(reset=False, cumulative=False):
+    """Summarize every span and counter
+    
+    :param reset (bool): start counting afresh
+    :param cumulative (bool): include what earlier resets cleared, e.g. for
+                              a summary of the whole run while a Reporter is
+                              resetting the stats with every dump
+    :return (dict): name -> summary (see Stat.summarize)
+    """
+    current = list(stats.items())
+    if cumulative:
+        totals = collections.defaultdict(Stat)
+        for name, stat in list(history.items()) + current:
+            totals[name].merge(stat)
+        current = list(totals.items())
+    
+    summary = dict((name, stat.summarize())
+                   for name, stat in sorted(current) if stat.count)
+    if reset:
+        for name, stat in list(stats.items()):
+            history[name].merge(stat)
+            stat.reset()
+    return summary
+
+def openReporter(interval=10., target=None):
+    """Start dumping the stats periodically, if configured
+    
+    :param interval (float): Seconds between dumps
+    :param target (str): Log file, or unix:<path> for a UNIX datagram socket
+                         (default: $BOGIE_STATS)
+    :return (Reporter): Running reporter, or None if there is no target
+    """
+    if target is None:
+        target = os.environ.get('BOGIE_STATS')
+    if not target:
+        return None
+    
+    reporter = Reporter(target, interval)
+    reporter.start()
+    return reporter
+
+def openProfiler(path=None, signum=signal.SIGUSR1):
+    """Let a signal toggle the sampling profiler, if configured (see
+       Profiler.install)
+    
+    :param path (str): File for the collapsed stacks (default:
+                       $BOGIE_PROFILE)
+    :param signum (int): Signal to toggle on
+    :return (Profiler): The profiler, or None if there is no path
+    """
+    if path is None:
+        path = os.environ.get('BOGIE_PROFILE')
+    if not path:
+        return None
+    
+    return Profiler.install(path, signum)
+
+def setEnabled(enabled):
+    """Turn recording on or off. Timed functions still pay for checking.
+    
+    :param enabled (bool): Whether to record
+    """
+    global ENABLED
+    ENABLED = enabled
+
+def timed(name):
+    """Decorator recording every call of a function as a span
+    
+    :param name (str): Span name, e.g. 'vision.blur'
+    :return (function): Decorator
+    """
+    stat = stats[name]
+    buckets = stat.buckets
+    clock = time.perf_counter_ns
+    
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                # Stat.record, inlined since this runs on every call
+                elapsed = clock() - start
+                stat.count += 1
+                stat.total += elapsed
+                if elapsed > stat.max:
+                    stat.max = elapsed
+                buckets[(elapsed // 1000).bit_length()] += 1
+        return wrapper
+    
+    return decorator
+
+WRAPPER_CODE = timed('')(lambda: None).__code__
+
+
+class Span:
+    """Context manager recording the time spent in a block, for code that
+       isn't a function of its own:
+           
+           with Span('follow.iteration'):
+               ...
+    """
+    __slots__ = ('stat', 'start')
+    
+    def __init__(self, name):
+        """Initialize
+        
+        :param name (str): Span name
+        """
+        self.stat = stats[name]
+        self.start = None
+    
+    def __enter__(self):
+        if ENABLED:
+            self.start = time.perf_counter_ns()
+        return self
+    
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.stat.record(time.perf_counter_ns() - self.start)
+            self.start = None
+        return False
+
+
+class Reporter:
+    """Dumps the stats (since the previous dump) as one line of JSON every
+       interval, to a log file or a local UNIX datagram socket. Nothing waits
+       on the socket: a dump no one is listening for is dropped.
+    """
+    def __init__(self, target, interval=10.):
+        """Initialize
+        
+        :param target (str): Log file, or unix:<path> for a UNIX datagram
+                             socket
+        :param interval (float): Seconds between dumps
+        :inst self.dropped (int): dumps the socket didn't take
+        """
+        if interval <= 0:
+            raise ValueError('Report interval must be positive')
+        
+        self.target = target
+        self.interval = interval
+        self.dropped = 0
+        self.socket = None
+        if target.startswith('unix:'):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.setblocking(False)
+        self.stopping = threading.Event()
+        self.thread = None
+    
+    def dump(self):
+        """Write the stats since the last dump, and reset them
+        """
+        line = json.dumps({'time': round(time.time(), 3), 'pid': os.getpid(),
+                           'stats': getStats(reset=True)},
+                          separators=(',', ':'), sort_keys=True)
+        if self.socket is None:
+            with open(self.target, 'a') as f:
+                f.write(line + '\n')
+            return
+        
+        try:
+            self.socket.sendto(line.encode(), self.target[len('unix:'):])
+        except OSError: # No listener, or it's behind
+            self.dropped += 1
+    
+    def run(self):
+        """Reporter thread
+        """
+        while not self.stopping.wait(self.interval):
+            self.dump()
+    
+    def start(self):
+        """Start the reporter thread
+        """
+        if self.thread is not None:
+            return
+        
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Stop the reporter thread, after a final dump
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.dump()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class Profiler:
+    """Sampling profiler: a thread periodically records the stacks of the
+       other threads (with sys._current_frames), so it costs the same however
+       hot the code is, and nothing while it isn't running. Stacks are
+       written in the collapsed format flamegraph.pl and speedscope read.
+    """
+    def __init__(self, interval=0.005, max_depth=32):
+        """Initialize
+        
+        :param interval (float): Seconds between samples
+        :param max_depth (int): Innermost frames kept of each stack
+        :inst self.samples (collections.Counter): collapsed stack -> samples
+        """
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = collections.Counter()
+        self.stopping = threading.Event()
+        self.thread = None
+    
+    @classmethod
+    def install(cls, path, signum=signal.SIGUSR1, **kwargs):
+        """Toggle profiling with a signal: the first one starts a profiler,
+           the next stops it and writes its stacks to path, and so on. Must
+           be called from the main thread.
+        
+        :param path (str): File for the collapsed stacks
+        :param signum (int): Signal to toggle on
+        :return (Profiler): The profiler the signal toggles
+        """
+        profiler = cls(**kwargs)
+        
+        def toggle(signum, frame):
+            if profiler.thread is None:
+                profiler.samples.clear()
+                profiler.start()
+            else:
+                profiler.stop()
+                profiler.write(path)
+        
+        signal.signal(signum, toggle)
+        return profiler
+    
+    def run(self):
+        """Sampling thread
+        """
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    if code is not WRAPPER_CODE: # Leave out timed's frames
+                        stack.append('%s:%s' % (os.path.basename(
+                            code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+    
+    def start(self):
+        """Start sampling
+        """
+        if self.thread is not None:
+            return
+        
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Stop sampling
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+    
+    def write(self, path):
+        """Write the collapsed stacks, most sampled first
+        
+        :param path (str): Output file
+        """
+        with open(path, 'w') as f:
+            for stack, n in self.samples.most_common():
+                f.write('%s %d\n' % (stack, n))
@@ -3,22 +3,82 @@
 #
 # Motion module
 #
-from Adafruit_MotorHAT import Adafruit_MotorHAT, Adafruit_DCMotor
+import Instrumentation
 import atexit
+import concurrent.futures
 import numpy as np
+import os
+import threading
 import time
 
+# PCA9685 registers, for writing the Motor HAT's PWM controller directly
+PCA9685_MODE1 = 0x00
+PCA9685_AI = 0x20    # MODE1 register auto-increment bit
+PCA9685_RESTART = 0x80
+PCA9685_LED0_ON_L = 0x06
+PCA9685_CHANNEL_WRITES = 4    # Byte writes per setPWM call
+
+# (pwm, in2, in1) channels of Motor HAT motors 1 and 2
+HAT_CHANNELS = {1: (8, 9, 10), 2: (13, 12, 11)}
+
+# (on, off) counts that hold a channel fully high or low
+PIN_HIGH = (4096, 0)
+PIN_LOW = (0, 4096)
+
+def openMotorHAT(addr=0x60, backend=None):
+    """Open a motor controller backend. Hardware support is only imported
+       when the real Motor HAT is opened.
+    
+    :param addr (int): I2C address of the HAT
+    :param backend (str): 'hat' for the Adafruit Motor HAT or 'sim' for the
+                          simulated one. Defaults to $BOGIE_MOTORS, else 'sim'
+                          if $BOGIE_BACKEND is 'sim', else 'hat'.
+    :return (instance): Adafruit_MotorHAT compatible object
+    """
+    if backend is None:
+        backend = os.environ.get('BOGIE_MOTORS')
+    if backend is None:
+        sim = os.environ.get('BOGIE_BACKEND') == 'sim'
+        backend = 'sim' if sim else 'hat'
+    
+    if backend == 'hat':
+        from Adafruit_MotorHAT import Adafruit_MotorHAT
+        return Adafruit_MotorHAT(addr=addr)
+    elif backend == 'sim':
+        import Simulation
+        return Simulation.SimMotorHAT(addr=addr)
+    
+    raise ValueError('Unknown motor backend: %s' % backend)
+
 class Drive:
     """Provides the driving functions for the robot using the Adafruit DC and
        Stepper Motor HAT.
+       
+       The last direction and speed commanded for each motor are cached, and
+       only changes are written to the HAT's PCA9685 PWM controller. When the
+       controller is reachable directly, changes to motors 1 and 2 go out as
+       one block write instead of a transaction per register.
     """
-    def __init__(self, hataddr=0x60):
+    def __init__(self, hataddr=0x60, backend=None, coalesce=True):
         """Initialize the drive class
         
+        :param hataddr (int): I2C address of the HAT
+        :param backend (str): motor controller backend (see openMotorHAT)
+        :param coalesce (bool): batch motor updates into block writes when
+                                the controller supports it
         :inst self.mh (instance): Motor hat object
+        :inst self.state (dict): motor number -> last (direction, speed)
+                                 written
+        :inst self.block (instance): I2C device of the PWM controller, used
+                                     for block writes, or None
+        :inst self.bus (dict): bus traffic counters (see getBusStats)
         """
-        self.mh = Adafruit_MotorHAT(addr=hataddr)
-        self.stop()
+        self.mh = openMotorHAT(hataddr, backend)
+        self.state = {}
+        self.bus = {'commands': 0, 'skipped': 0, 'writes': 0,
+                    'block_writes': 0, 'bytes': 0, 'since': time.time()}
+        self.block = self.openBlockWrite() if coalesce else None
+        self.setMotors({1: (self.mh.RELEASE, 0), 2: (self.mh.RELEASE, 0)})
         
         # Auto-disable motors on program exit
         atexit.register(self.shutdown)
@@ -30,68 +90,341 @@ class Drive:
         :param steering (float): -1 to 1, negative vals steer left
         """
         if speed == 0:    # Stop
-            self.stop()
-            return True
+            return self.stop()
         elif speed > 0:    # Move forward
-            self.mh.getMotor(1).run(Adafruit_MotorHAT.FORWARD)
-            self.mh.getMotor(2).run(Adafruit_MotorHAT.FORWARD)
+            direction = self.mh.FORWARD
         else:    # Move backward
-            self.mh.getMotor(1).run(Adafruit_MotorHAT.BACKWARD)
-            self.mh.getMotor(2).run(Adafruit_MotorHAT.BACKWARD)
+            direction = self.mh.BACKWARD
         
         power_l = 2 * np.abs(speed) * ((steering + 1.) / 2.)
         power_r = 2 * np.abs(speed) - power_l
-        self.mh.getMotor(1).setSpeed(int(power_l))
-        self.mh.getMotor(2).setSpeed(int(power_r))
+        self.setMotors({1: (direction, int(power_l)),
+                        2: (direction, int(power_r))})
         return True
     
+    def getBusStats(self, reset=False):
+        """Report the motor commands received and the I2C traffic they caused
+        
+        :param reset (bool): start counting afresh afterwards
+        :return stats (dict): commands (run/setSpeed equivalents requested),
+                              skipped (those that changed nothing), writes
+                              (I2C transactions issued), block_writes, bytes
+                              written, elapsed seconds and writes_per_s
+        """
+        stats = dict(self.bus)
+        stats['elapsed'] = time.time() - stats.pop('since')
+        stats['writes_per_s'] = stats['writes'] / max(stats['elapsed'], 1e-9)
+        if reset:
+            self.bus = {'commands': 0, 'skipped': 0, 'writes': 0,
+                        'block_writes': 0, 'bytes': 0, 'since': time.time()}
+        
+        return stats
+    
     def move(self, distance=0.):
         """Move forward (or backward) the given distance and then stop
         
         :param distance (float): Distance to travel (in centimeters)
         """
-        # TODO: Find a way to calibrate distance
-        if np.abs(distance) > 0:
-            speed = 128 * int(np.abs(distance) / distance)
-            self.drive(speed, 0.)
-            time.sleep(0.011 * np.abs(distance))
+        duration = self.startMove(distance)
+        if duration > 0:
+            time.sleep(duration)
             self.stop()
         
         return True
     
+    def openBlockWrite(self):
+        """Find the PWM controller's I2C device and turn on register
+           auto-increment, which block writes rely on
+        
+        :return device (instance): I2C device, or None if the motor HAT
+                                   doesn't expose one
+        """
+        device = getattr(getattr(self.mh, '_pwm', None), 'i2c', None)
+        if device is None or not hasattr(device, 'writeList'):
+            return None
+        
+        try:
+            mode = device.readU8(PCA9685_MODE1)
+            if not mode & PCA9685_AI:
+                device.write8(PCA9685_MODE1,
+                              (mode & ~PCA9685_RESTART) | PCA9685_AI)
+                self.bus['writes'] += 1
+                self.bus['bytes'] += 1
+        except IOError:
+            return None
+        
+        return device
+    
+    @Instrumentation.timed('motion.set_motors')
+    def setMotors(self, commands):
+        """Command motors, writing only what differs from the cached state
+        
+        :param commands (dict): motor number -> (direction, speed). Either
+                                may be None to leave it unchanged.
+        """
+        changes = {}
+        for num, (direction, speed) in commands.items():
+            old = self.state.get(num, (None, None))
+            if speed is not None:
+                speed = min(255, max(0, int(speed)))
+            for value, current in ((direction, old[0]), (speed, old[1])):
+                if value is not None:
+                    self.bus['commands'] += 1
+                    if value == current:
+                        self.bus['skipped'] += 1
+            
+            new = (old[0] if direction is None else direction,
+                   old[1] if speed is None else speed)
+            if new != old:
+                changes[num] = (old, new)
+        
+        if not changes:
+            return
+        
+        if self.block is not None and \
+           all(num in HAT_CHANNELS and None not in new
+               for num, (old, new) in changes.items()):
+            try:
+                self.writeBlock(dict((num, new) for num, (old, new)
+                                     in changes.items()))
+                for num, (old, new) in changes.items():
+                    self.state[num] = new
+                return
+            except IOError:
+                self.block = None
+        
+        for num, (old, new) in sorted(changes.items()):
+            motor = self.mh.getMotor(num)
+            if new[0] != old[0]:    # Sets the two direction pins
+                motor.run(new[0])
+                self.bus['writes'] += 2 * PCA9685_CHANNEL_WRITES
+                self.bus['bytes'] += 2 * PCA9685_CHANNEL_WRITES
+            if new[1] != old[1]:
+                motor.setSpeed(new[1])
+                self.bus['writes'] += PCA9685_CHANNEL_WRITES
+                self.bus['bytes'] += PCA9685_CHANNEL_WRITES
+            self.state[num] = new
+    
     def shutdown(self):
         """Shuts down all motors
         """
-        for i in range(1,5):
-            self.mh.getMotor(i).run(Adafruit_MotorHAT.RELEASE)
-        
+        self.setMotors(dict((i, (self.mh.RELEASE, None))
+                            for i in range(1,5)))
         return True
     
-    def stop(self):
-        """Stop the robot
+    def startMove(self, distance=0.):
+        """Start moving forward (or backward), without stopping
+        
+        :param distance (float): Distance to travel (in centimeters)
+        :return (float): Seconds until the distance is covered
         """
-        for i in range(1,3):
-            self.mh.getMotor(i).setSpeed(0)
+        # TODO: Find a way to calibrate distance
+        if np.abs(distance) > 0:
+            speed = 128 * int(np.abs(distance) / distance)
+            self.drive(speed, 0.)
+            return 0.011 * np.abs(distance)
         
-        return True
+        return 0.
     
-    def turn(self, angle=0):
-        """Perform an in-place heading adjustment
+    def startTurn(self, angle=0):
+        """Start an in-place heading adjustment, without stopping
         
         :param angle (float): Turn angle in radians, negative is to the left
+        :return (float): Seconds until the angle is covered
         """
         self.stop()
+        if angle == 0:
+            return 0.
+        
         dir = np.abs(angle) / angle
         if dir > 0:    # Turn right
-            self.mh.getMotor(1).run(Adafruit_MotorHAT.FORWARD)
-            self.mh.getMotor(2).run(Adafruit_MotorHAT.BACKWARD)
+            self.setMotors({1: (self.mh.FORWARD, 128),
+                            2: (self.mh.BACKWARD, 128)})
         
         else:    # Turn left
-            self.mh.getMotor(1).run(Adafruit_MotorHAT.BACKWARD)
-            self.mh.getMotor(2).run(Adafruit_MotorHAT.FORWARD)
+            self.setMotors({1: (self.mh.BACKWARD, 128),
+                            2: (self.mh.FORWARD, 128)})
+        
+        return 0.63 * np.abs(angle)
+    
+    def stop(self):
+        """Stop the robot
+        """
+        self.setMotors({1: (None, 0), 2: (None, 0)})
+        return True
+    
+    def turn(self, angle=0):
+        """Perform an in-place heading adjustment
         
-        self.mh.getMotor(1).setSpeed(128)
-        self.mh.getMotor(2).setSpeed(128)
-        time.sleep(0.63 * np.abs(angle))
+        :param angle (float): Turn angle in radians, negative is to the left
+        """
+        time.sleep(self.startTurn(angle))
         self.stop()
         return True
+    
+    @Instrumentation.timed('motion.i2c_block')
+    def writeBlock(self, states):
+        """Write the full state of one or both of motors 1 and 2 in a single
+           I2C block write. Their PWM channels (8 through 13) are contiguous,
+           so both motors take 24 bytes, within the SMBus block limit.
+        
+        :param states (dict): motor number -> (direction, speed)
+        """
+        values = {}
+        for num, (direction, speed) in states.items():
+            pwm, in2, in1 = HAT_CHANNELS[num]
+            values[pwm] = (0, speed * 16)
+            high_in1 = direction in (self.mh.FORWARD, self.mh.BRAKE)
+            high_in2 = direction in (self.mh.BACKWARD, self.mh.BRAKE)
+            values[in1] = PIN_HIGH if high_in1 else PIN_LOW
+            values[in2] = PIN_HIGH if high_in2 else PIN_LOW
+        
+        first, last = min(values), max(values)
+        data = []
+        for channel in range(first, last + 1):
+            on, off = values[channel]
+            data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+        
+        self.block.writeList(PCA9685_LED0_ON_L + 4 * first, data)
+        self.bus['writes'] += 1
+        self.bus['block_writes'] += 1
+        self.bus['bytes'] += len(data)
+
+
+class MotionScheduler:
+    """Runs Drive commands on a background thread so callers don't block
+       while the rover moves. Every command returns a Future right away, and
+       a new command preempts the one in progress: a timed move or turn is
+       cut short and the new command takes over the motors without stopping
+       in between.
+    """
+    def __init__(self, drive):
+        """Initialize
+        
+        :param drive (Drive): Drive to command. Once the scheduler is in use,
+                              only the scheduler should touch it.
+        :inst self.rover (Drive): Drive the commands run on
+        :inst self.pending (tuple): (future, method, args) of the next
+                                    command, or None
+        :inst self.preempted (bool): whether the running command should end
+        :inst self.running (bool): whether the worker thread should keep going
+        """
+        self.rover = drive
+        self.pending = None
+        self.preempted = False
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def drive(self, speed=0, steering=0.):
+        """Put the rover into continuous motion (see Drive.drive)
+        
+        :return (concurrent.futures.Future): True once applied
+        """
+        return self.submit('drive', speed, steering)
+    
+    def getBusStats(self, reset=False):
+        """Report the drive's I2C traffic (see Drive.getBusStats)
+        
+        :return stats (dict): bus traffic counters
+        """
+        return self.rover.getBusStats(reset)
+    
+    def move(self, distance=0.):
+        """Move the given distance and then stop (see Drive.move)
+        
+        :return (concurrent.futures.Future): True once the move finishes, or
+                                             False if it was preempted
+        """
+        return self.submit('move', distance)
+    
+    def shutdown(self):
+        """Stop the worker thread, then release the motors
+        """
+        with self.condition:
+            self.running = False
+            self.preempted = True
+            if self.pending is not None:
+                self.pending[0].cancel()
+                self.pending = None
+            self.condition.notify_all()
+        
+        self.thread.join()
+        self.rover.shutdown()
+    
+    def stop(self):
+        """Stop the rover (see Drive.stop)
+        
+        :return (concurrent.futures.Future): True once applied
+        """
+        return self.submit('stop')
+    
+    def submit(self, method, *args):
+        """Queue a command, replacing any queued command that hasn't started
+           and preempting the one in progress
+        
+        :param method (str): 'drive', 'move', 'stop' or 'turn'
+        :param args (tuple): Arguments for the command
+        :return (concurrent.futures.Future): Result of the command
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('Motion scheduler has been shut down')
+            
+            if self.pending is not None:
+                self.pending[0].cancel()
+            self.pending = (future, method, args)
+            self.preempted = True
+            self.condition.notify_all()
+        
+        return future
+    
+    def turn(self, angle=0):
+        """Turn in place by the given angle (see Drive.turn)
+        
+        :return (concurrent.futures.Future): True once the turn finishes, or
+                                             False if it was preempted
+        """
+        return self.submit('turn', angle)
+    
+    def work(self):
+        """Worker thread: run each command, waiting out timed ones unless
+           they are preempted
+        """
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                future, method, args = self.pending
+                self.pending = None
+                self.preempted = False
+            
+            if not future.set_running_or_notify_cancel():
+                continue
+            
+            try:
+                if method == 'move':
+                    duration = self.rover.startMove(*args)
+                elif method == 'turn':
+                    duration = self.rover.startTurn(*args)
+                else:
+                    future.set_result(getattr(self.rover, method)(*args))
+                    continue
+                
+                # Wait out the move or turn, unless a newer command arrives
+                deadline = time.time() + duration
+                with self.condition:
+                    while not self.preempted and time.time() < deadline:
+                        self.condition.wait(deadline - time.time())
+                    preempted = self.preempted
+                
+                if not preempted:
+                    self.rover.stop()
+                future.set_result(not preempted)
+            except Exception as e:
+                future.set_exception(e)
@@ -6,63 +6,395 @@
 import numpy as np
 
 class graphSLAM:
-    """Implementation of a graph-based Simultaneous Localization and 
+    """Implementation of a graph-based Simultaneous Localization and
        Mapping (SLAM) algorithm.
        Reference: http://robots.stanford.edu/papers/thrun.graphslam.pdf
+       
+       This is the online form: only the current pose is kept, and each
+       previous pose is marginalized out as the rover moves. Omega is stored
+       as a sparse matrix of 2x2 blocks, one per pair of linked nodes (the
+       pose or a landmark), so updates only touch the blocks they affect.
+       Landmarks can be given up front or discovered as they are measured;
+       unlabeled measurements are matched to the nearest landmark estimate
+       through a grid hash.
     """
-    def __init__(self, measurement_noise=2, motion_noise=2):
+    POSE = 0    # Node holding the current pose
+    NEXT = 1    # Scratch node for the next pose while moving
+    
+    def __init__(self, measurement_noise=2, motion_noise=2, num_landmarks=0,
+                 initial_pose=(0., 0.), max_active=50, gate=5.):
         """Initialize the graphs
         
-        :inst self.Omega (numpy.array): Pose and landmark estimation matrix
-        :inst self.Xi (numpy.array): Vector matrix
+        :param measurement_noise (float): Landmark measurement variance
+        :param motion_noise (float): Motion variance
+        :param num_landmarks (int): Number of landmarks
+        :param initial_pose (tuple): Where the rover starts
+        :param max_active (int): Most landmarks kept linked to the pose.
+                                 Beyond this the weakest links are dropped,
+                                 which bounds the cost of each update.
+        :param gate (float): Max distance between an unlabeled measurement
+                             and the landmark it is matched to
+        :inst self.rows (numpy.array): Node (row) of each Omega block
+        :inst self.cols (numpy.array): Node (column) of each Omega block
+        :inst self.blocks (numpy.array): 2x2 Omega blocks
+        :inst self.num_blocks (int): Number of block slots in use
+        :inst self.free (list): Block slots released for reuse
+        :inst self.links (list): For each node, {neighbor node: block slot}
+        :inst self.num_nodes (int): Number of nodes (2 + landmarks)
+        :inst self.Xi (numpy.array): Information vector, one row per node
+        :inst self.mu (numpy.array): Last estimate, one row per node
+        :inst self.grid (dict): Landmarks in each gate-sized grid cell
+        :inst self.cells (numpy.array): Grid cell of each node's estimate
+        :inst self.indexed (numpy.array): Whether each node is in the grid
+        :inst self.associations (list): Landmark matched to each measurement
+                                        in the last call to process
         """
-        self.Omega = np.zeros((3,3)) ###TODO: How to initialize landmarks
-        self.Xi = np.zeros((3,1))    ###      Grow landmark matrix?
         self.measurement_noise = measurement_noise
         self.motion_noise = motion_noise
+        self.max_active = max_active
+        self.gate = gate
+        self.num_nodes = 2 + num_landmarks
+        capacity = 4 * self.num_nodes
+        self.rows = np.zeros(capacity, dtype=int)
+        self.cols = np.zeros(capacity, dtype=int)
+        self.blocks = np.zeros((capacity, 2, 2))
+        self.num_blocks = 0
+        self.free = []
+        self.links = [{} for _ in range(self.num_nodes)]
+        self.Xi = np.zeros((self.num_nodes, 2))
+        self.mu = np.zeros((self.num_nodes, 2))
+        self.grid = {}
+        self.cells = np.zeros((self.num_nodes, 2), dtype=int)
+        self.indexed = np.zeros(self.num_nodes, dtype=bool)
+        self.associations = []
+        
+        # Anchor the first pose
+        self.addBlock(self.POSE, self.POSE, np.eye(2))
+        self.Xi[self.POSE] = initial_pose
+        self.mu[self.POSE] = initial_pose
+    
+    def addBlock(self, i, j, value):
+        """Add `value` to the Omega block at (i,j), creating it if needed
+        
+        :param i (int): Row node
+        :param j (int): Column node
+        :param value (numpy.array): 2x2 block to add
+        """
+        slot = self.links[i].get(j)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.num_blocks == len(self.blocks): # Double the capacity
+                    self.rows = np.concatenate((self.rows,
+                                                np.zeros_like(self.rows)))
+                    self.cols = np.concatenate((self.cols,
+                                                np.zeros_like(self.cols)))
+                    self.blocks = np.concatenate((self.blocks,
+                                                  np.zeros_like(self.blocks)))
+                slot = self.num_blocks
+                self.num_blocks += 1
+            
+            self.rows[slot] = i
+            self.cols[slot] = j
+            self.blocks[slot] = 0.
+            self.links[i][j] = slot
+        
+        self.blocks[slot] += value
+    
+    def addLandmark(self, position=None):
+        """Add a landmark node. Node storage doubles in capacity when full,
+           so adding landmarks is amortized O(1).
+        
+        :param position (tuple): Initial estimate of where it is, if known
+        :return (int): Index of the new landmark
+        """
+        if self.num_nodes == len(self.Xi):
+            self.Xi = np.concatenate((self.Xi, np.zeros_like(self.Xi)))
+            self.mu = np.concatenate((self.mu, np.zeros_like(self.mu)))
+            self.cells = np.concatenate((self.cells,
+                                         np.zeros_like(self.cells)))
+            self.indexed = np.concatenate((self.indexed,
+                                           np.zeros_like(self.indexed)))
+        
+        node = self.num_nodes
+        self.num_nodes += 1
+        self.links.append({})
+        if position is not None:
+            self.mu[node] = position
+            self.indexNode(node)
+        
+        return node - 2
+    
+    def addLink(self, i, j, value):
+        """Add `value` to block (i,j) and its transpose to block (j,i)
+        
+        :param i (int): Row node
+        :param j (int): Column node
+        :param value (numpy.array): 2x2 block to add
+        """
+        self.addBlock(i, j, value)
+        if i != j:
+            self.addBlock(j, i, np.transpose(value))
+    
+    def associate(self, position):
+        """Find the landmark whose estimate is nearest to a position, looking
+           only in the grid cells within the gate distance
+        
+        :param position (numpy.array): Measured landmark position
+        :return (int): Landmark index, or None if none is within the gate
+        """
+        cell = np.floor(np.asarray(position) / self.gate).astype(int)
+        best, best_distance = None, self.gate
+        for i in range(cell[0] - 1, cell[0] + 2):
+            for j in range(cell[1] - 1, cell[1] + 2):
+                for node in self.grid.get((i, j), ()):
+                    distance = np.hypot(*(self.mu[node] - position))
+                    if distance <= best_distance:
+                        best, best_distance = node, distance
+        
+        if best is None:
+            return None
+        
+        return best - 2
+    
+    def calc_mu(self, tolerance=1e-6, max_iterations=None):
+        """Calculate the estimated pose and landmark matrix by solving
+           Omega * mu = Xi with block-Jacobi preconditioned conjugate
+           gradients, starting from the previous estimate.
+        
+        :param tolerance (float): Relative residual to stop at
+        :param max_iterations (int): Iteration limit (default: 2 per node)
+        :return mu (numpy.array): estimated localization and mapping matrix,
+                                  a column of x,y for the pose and then each
+                                  landmark
+        """
+        num_nodes = self.num_nodes
+        if max_iterations is None:
+            max_iterations = 2 * num_nodes
+        
+        # Inverse of each node's diagonal block; nodes that have never been
+        # observed have none, and keep a zero estimate
+        diagonal = np.tile(np.eye(2), (num_nodes, 1, 1))
+        active = np.zeros(num_nodes, dtype=bool)
+        for node, links in enumerate(self.links):
+            if node in links:
+                diagonal[node] = self.blocks[links[node]]
+                active[node] = True
+        preconditioner = np.linalg.inv(diagonal)
+        preconditioner[~active] = 0.
+        
+        xi = self.Xi[:num_nodes]
+        mu = np.where(active[:,None], self.mu[:num_nodes], 0.)
+        residual = xi - self.multiply(mu)
+        z = np.einsum('nij,nj->ni', preconditioner, residual)
+        direction = z.copy()
+        rz = np.sum(residual * z)
+        limit = (tolerance * np.linalg.norm(xi)) ** 2
+        for _ in range(max_iterations):
+            if np.sum(residual ** 2) <= limit:
+                break
+            
+            product = self.multiply(direction)
+            step = rz / np.sum(direction * product)
+            mu += step * direction
+            residual -= step * product
+            z = np.einsum('nij,nj->ni', preconditioner, residual)
+            rz, rz_old = np.sum(residual * z), rz
+            direction = z + (rz / rz_old) * direction
+        
+        self.mu[:num_nodes] = mu
+        self.reindex()
+        return np.concatenate((mu[self.POSE], mu[2:].ravel()))[:,None]
+    
+    def getLandmarks(self):
+        """Current landmark estimates (as of the last calc_mu, or the first
+           measurement for landmarks seen since)
+        
+        :return (numpy.array): x,y row for each landmark
+        """
+        return self.mu[2:self.num_nodes].copy()
+    
+    def getPose(self):
+        """Current pose estimate
+        
+        :return (numpy.array): x,y of the rover
+        """
+        return self.mu[self.POSE].copy()
+    
+    def indexNode(self, node):
+        """Put a landmark node into the grid cell of its estimate
+        
+        :param node (int): Landmark node
+        """
+        cell = tuple(np.floor(self.mu[node] / self.gate).astype(int))
+        if self.indexed[node]:
+            old = tuple(self.cells[node])
+            if old == cell:
+                return
+            self.grid[old].discard(node)
         
+        self.grid.setdefault(cell, set()).add(node)
+        self.cells[node] = cell
+        self.indexed[node] = True
+    
+    def marginalize(self, node):
+        """Remove a node from the graph, folding its information into its
+           neighbors with the Schur complement of its block. Only the blocks
+           among its neighbors change.
+        
+        :param node (int): Node to remove
+        """
+        links = self.links[node]
+        neighbors = [n for n in links if n != node]
+        b = np.linalg.inv(self.blocks[links[node]])
+        a = dict((n, self.blocks[links[n]].copy()) for n in neighbors)
+        for i in neighbors:
+            a_ib = np.dot(a[i].T, b)
+            for j in neighbors:
+                self.addBlock(i, j, -np.dot(a_ib, a[j]))
+            self.Xi[i] -= np.dot(a_ib, self.Xi[node])
+        
+        self.removeNode(node)
+    
+    def multiply(self, x):
+        """Multiply Omega by a vector
+        
+        :param x (numpy.array): One x,y row per node
+        :return (numpy.array): Omega * x, one row per node
+        """
+        n = self.num_blocks
+        rows = self.rows[:n]
+        product = np.einsum('kij,kj->ki', self.blocks[:n], x[self.cols[:n]])
+        out = np.empty_like(x)
+        out[:,0] = np.bincount(rows, product[:,0], minlength=len(x))
+        out[:,1] = np.bincount(rows, product[:,1], minlength=len(x))
+        return out
+    
     def process(self, measurements, motion):
         """Updates Omega and Xi using new measurements and movement
         
-        :param measurements (list): Measurement vectors
+        :param measurements (list): Measurement vectors, [landmark, dx, dy]
+                                    for a known landmark or [dx, dy] (or
+                                    [None, dx, dy]) to match the measurement
+                                    to a landmark, adding one if none is close
         :param motion (list): Motion displacement vectors
         :return (bool): True if processing successful
         """
+        self.associations = []
         for measurement in measurements:
-            m = 2 * (1 + measurement[0])
-            for i in range(2):
-                self.Omega[i,i] += 1. / self.measurement_noise
-                self.Omega[i+m,i] += -1. / self.measurement_noise
-                self.Omega[i,i+m] += -1. / self.measurement_noise
-                self.Omega[i+m,i+m] += 1. / self.measurement_noise
-                self.Xi[i][0] += -measurement[i+1] / self.measurement_noise
-                self.Xi[i+m][0] += measurement[i+1] / self.measurement_noise
-        
-        for i in range(2):
-            self.Omega = np.insert(Omega, 2, 0, axis=0)
-            self.Omega = np.insert(Omega, 2, 0, axis=1)
-            self.Xi = np.insert(Xi, 2, 0, axis=0)
-        
-        for i in range(2):
-            self.Omega[i][i] += 1. / self.motion_noise
-            self.Omega[i,i+2] += -1. / self.motion_noise
-            self.Omega[i+2,i] += -1. / self.motion_noise
-            self.Omega[i+2][i+2] += 1. / self.motion_noise
-            self.Xi[i][0] += -motion[i] / self.motion_noise
-            self.Xi[i+2][0] += motion[i] / self.motion_noise
-        
-        a = self.Omega[:2,2:]
-        b = np.linalg.inv(self.Omega[:2,:2])
-        c = self.Xi[:2]
-
-        self.Omega = self.Omega[2:,2:] - np.dot(np.dot(a.transpose(), b), a)
-        self.Xi = self.Xi[2:] - np.dot(np.dot(a.transpose(), b), c)
+            delta = np.array(measurement[-2:], dtype=float)
+            position = self.mu[self.POSE] + delta
+            if len(measurement) == 2 or measurement[0] is None:
+                landmark = self.associate(position)
+                if landmark is None:
+                    landmark = self.addLandmark(position)
+            else:
+                landmark = measurement[0]
+                if landmark < 0 or 2 + landmark >= self.num_nodes:
+                    raise ValueError('Unknown landmark: %s' % landmark)
+            
+            self.associations.append(landmark)
+            m = 2 + landmark
+            info = np.eye(2) / self.measurement_noise
+            if m not in self.links[m]: # First sighting, seed the estimate
+                self.mu[m] = position
+                self.indexNode(m)
+            self.addLink(self.POSE, self.POSE, info)
+            self.addLink(m, m, info)
+            self.addLink(self.POSE, m, -info)
+            self.Xi[self.POSE] += -delta / self.measurement_noise
+            self.Xi[m] += delta / self.measurement_noise
+        
+        # Link the next pose to the current one, then marginalize the
+        # current pose out and make the next one current
+        info = np.eye(2) / self.motion_noise
+        delta = np.array(motion[:2], dtype=float)
+        self.addLink(self.POSE, self.POSE, info)
+        self.addLink(self.NEXT, self.NEXT, info)
+        self.addLink(self.POSE, self.NEXT, -info)
+        self.Xi[self.POSE] += -delta / self.motion_noise
+        self.Xi[self.NEXT] += delta / self.motion_noise
+        self.mu[self.NEXT] = self.mu[self.POSE] + delta
+        self.marginalize(self.POSE)
+        self.renameNode(self.NEXT, self.POSE)
+        self.sparsify()
         return True
     
-    def calc_mu(self):
-        """Calculate the estimated pose and landmark matrix
+    def reindex(self):
+        """Move landmarks whose estimates changed grid cells
+        """
+        nodes = np.flatnonzero(self.indexed[:self.num_nodes])
+        cells = np.floor(self.mu[nodes] / self.gate).astype(int)
+        moved = np.any(cells != self.cells[nodes], axis=1)
+        for node in nodes[moved]:
+            self.indexNode(node)
+    
+    def removeNode(self, node):
+        """Drop every block in a node's row and column
         
-        :return mu (numpy.array): estimated localization and mapping matrix
+        :param node (int): Node to remove
         """
-        mu = np.dot(np.linalg.inv(Omega), Xi)
-        return mu
+        for neighbor, slot in self.links[node].items():
+            self.blocks[slot] = 0.
+            self.free.append(slot)
+            if neighbor != node:
+                other = self.links[neighbor].pop(node)
+                self.blocks[other] = 0.
+                self.free.append(other)
+        
+        self.links[node] = {}
+        self.Xi[node] = 0.
+        self.mu[node] = 0.
+    
+    def renameNode(self, old, new):
+        """Move a node's blocks and vectors to an empty node
+        
+        :param old (int): Node to move
+        :param new (int): Empty node to move it to
+        """
+        for neighbor, slot in self.links[old].items():
+            if neighbor == old:
+                self.rows[slot] = self.cols[slot] = new
+                self.links[new][new] = slot
+                continue
+            
+            self.rows[slot] = new
+            self.links[new][neighbor] = slot
+            other = self.links[neighbor].pop(old)
+            self.cols[other] = new
+            self.links[neighbor][new] = other
+        
+        self.links[old] = {}
+        self.Xi[new] = self.Xi[old]
+        self.Xi[old] = 0.
+        self.mu[new] = self.mu[old]
+        self.mu[old] = 0.
+    
+    def sparsify(self):
+        """Keep at most max_active landmarks linked to the pose by dropping
+           the weakest pose-landmark links. To keep Omega positive definite,
+           a dropped link L is replaced with |L| on both diagonals, and Xi is
+           shifted so the current estimate still solves the system.
+        """
+        links = self.links[self.POSE]
+        landmarks = [n for n in links if n != self.POSE]
+        if len(landmarks) <= self.max_active:
+            return
+        
+        strength = [np.linalg.norm(self.blocks[links[n]]) for n in landmarks]
+        weakest = np.argsort(strength)[:len(landmarks) - self.max_active]
+        for index in weakest:
+            n = landmarks[index]
+            link = self.blocks[links[n]].copy()
+            sigma = np.linalg.norm(link, 2)
+            for node, slot in ((self.POSE, links.pop(n)),
+                               (n, self.links[n].pop(self.POSE))):
+                self.blocks[slot] = 0.
+                self.free.append(slot)
+                self.addBlock(node, node, sigma * np.eye(2))
+            
+            self.Xi[self.POSE] += sigma * self.mu[self.POSE] - \
+                                  np.dot(link, self.mu[n])
+            self.Xi[n] += sigma * self.mu[n] - np.dot(link.T,
+                                                      self.mu[self.POSE])
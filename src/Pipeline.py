@@ -0,0 +1,476 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Pipeline module
+#
+# Runs follow.py's work as a pipeline of processes, so the stages use
+# separate cores instead of sharing one interpreter:
+#
+#   capture -> preprocess -> tracking -> control
+#                                    \-> diagnostics
+#
+# Frames travel through shared memory; the queues between stages only carry
+# slot numbers and small results. Queues are bounded, and a stage blocks when
+# the next one falls behind, except diagnostics, which drops frames instead.
+#
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+import os
+import queue
+import signal
+import time
+
+STATS = ('processed', 'dropped', 'busy', 'blocked', 'latency_total',
+         'latency_max')
+
+class FrameRing:
+    """A fixed set of frame buffers in shared memory, handed between
+       processes by slot number. Slots are reference counted and return to
+       the free list when the last holder releases them.
+    """
+    def __init__(self, shape, dtype=np.uint8, slots=4):
+        """Initialize
+        
+        :param shape (tuple): Shape of each frame
+        :param dtype (numpy.dtype): Frame element type
+        :param slots (int): Number of frames
+        :inst self.shm (SharedMemory): memory holding the frames
+        :inst self.refs (multiprocessing.Array): holders of each slot
+        :inst self.free (multiprocessing.Queue): slots nobody holds
+        :inst self.frames (numpy.array): (slots,)+shape view of the memory,
+                                         once attached in this process
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        size = int(np.prod(self.shape)) * self.dtype.itemsize * slots
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self.shm.name
+        self.refs = multiprocessing.Array('i', slots)
+        self.free = multiprocessing.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.frames = None
+    
+    def __getstate__(self):
+        """Pickle by name; the memory is attached again on first use
+        """
+        state = dict(self.__dict__)
+        state['shm'] = None
+        state['frames'] = None
+        return state
+    
+    def acquire(self, timeout=None):
+        """Take a free slot, waiting for one to be released if necessary
+        
+        :param timeout (float): Max seconds to wait (default: forever)
+        :return slot (int): Slot, held once
+        :raises queue.Empty: if no slot became free in time
+        """
+        slot = self.free.get(timeout=timeout)
+        self.refs[slot] = 1
+        return slot
+    
+    def close(self):
+        """Detach this process from the shared memory
+        """
+        self.frames = None
+        if self.shm is not None:
+            self.shm.close()
+    
+    def get(self, slot):
+        """Return a slot's frame
+        
+        :param slot (int): Slot
+        :return (numpy.array): Frame, backed by shared memory
+        """
+        if self.frames is None:
+            if self.shm is None:
+                self.shm = shared_memory.SharedMemory(name=self.name)
+            self.frames = np.ndarray((self.slots,) + self.shape,
+                                     dtype=self.dtype, buffer=self.shm.buf)
+        
+        return self.frames[slot]
+    
+    def release(self, slot):
+        """Give up one hold on a slot
+        
+        :param slot (int): Slot
+        """
+        with self.refs.get_lock():
+            self.refs[slot] -= 1
+            free = self.refs[slot] == 0
+        
+        if free:
+            self.free.put(slot)
+    
+    def unlink(self):
+        """Free the shared memory (once every process is done with it)
+        """
+        self.close()
+        shared_memory.SharedMemory(name=self.name).unlink()
+
+
+class StageStats:
+    """Throughput and latency counters of one stage, in shared memory so the
+       parent process can read them
+    """
+    def __init__(self):
+        """Initialize
+        
+        :inst self.values (multiprocessing.Array): one counter per STATS name
+        """
+        self.values = multiprocessing.Array('d', len(STATS))
+    
+    def record(self, timestamp=None, busy=0., blocked=0., dropped=0):
+        """Count one processed (or dropped) item
+        
+        :param timestamp (float): capture time of the frame it came from
+        :param busy (float): seconds spent working on it
+        :param blocked (float): seconds spent waiting on the next stage
+        :param dropped (int): number of items dropped instead of processed
+        """
+        with self.values.get_lock():
+            v = self.values
+            if dropped:
+                v[STATS.index('dropped')] += dropped
+                return
+            
+            v[STATS.index('processed')] += 1
+            v[STATS.index('busy')] += busy
+            v[STATS.index('blocked')] += blocked
+            if timestamp is not None:
+                latency = time.time() - timestamp
+                v[STATS.index('latency_total')] += latency
+                i = STATS.index('latency_max')
+                v[i] = max(v[i], latency)
+    
+    def snapshot(self, elapsed):
+        """Summarize the counters
+        
+        :param elapsed (float): seconds the stage has been running
+        :return stats (dict): processed and dropped counts, items per second,
+                              fraction of the time busy and blocked, and
+                              mean and max latency from capture
+        """
+        with self.values.get_lock():
+            v = dict(zip(STATS, self.values[:]))
+        
+        processed = v['processed']
+        elapsed = max(elapsed, 1e-9)
+        return {'processed': int(processed), 'dropped': int(v['dropped']),
+                'rate': processed / elapsed,
+                'busy': v['busy'] / elapsed,
+                'blocked': v['blocked'] / elapsed,
+                'latency_mean': v['latency_total'] / max(1, processed),
+                'latency_max': v['latency_max']}
+
+
+def put(q, item, stopping):
+    """Put an item on a bounded queue, waiting while it is full
+    
+    :param q (multiprocessing.Queue): Queue
+    :param item: Item to put
+    :param stopping (multiprocessing.Event): gives up once set
+    :return (float): seconds spent waiting, or None if it gave up
+    """
+    start = time.time()
+    while not stopping.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return time.time() - start
+        except queue.Full:
+            pass
+    
+    return None
+
+def get(q, stopping):
+    """Get the next item from a queue
+    
+    :param q (multiprocessing.Queue): Queue
+    :param stopping (multiprocessing.Event): gives up once set
+    :return: Item, or None if it gave up
+    """
+    while not stopping.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    
+    return None
+
+def captureStage(raw, output, stats, stopping, res, framerate, backend):
+    """Capture frames into the raw ring
+    
+    Sends (seq, timestamp, raw slot)
+    """
+    from Camera import BogieCamera
+    camera = BogieCamera(res, framerate, mode='bgr', ring_size=0,
+                         backend=backend) # Captures into raw, never streams
+    seq = 0
+    while not stopping.is_set():
+        try:
+            slot = raw.acquire(timeout=0.1)
+        except queue.Empty:
+            continue
+        
+        start = time.time()
+        camera.capture(raw.get(slot))
+        timestamp = time.time()
+        seq += 1
+        blocked = put(output, (seq, timestamp, slot), stopping)
+        if blocked is None:
+            break
+        stats.record(timestamp, timestamp - start, blocked)
+    
+    camera.camera.close()
+
+def preprocessStage(raw, blurred, source, output, stats, stopping, res,
+                    keep_raw):
+    """Blur raw frames into the blurred ring
+    
+    Sends (seq, timestamp, raw slot or None, blurred slot)
+    """
+    from Vision import Tracker
+    width, height = res
+    while True:
+        item = get(source, stopping)
+        if item is None:
+            break
+        seq, timestamp, raw_slot = item
+        try:
+            slot = blurred.acquire(timeout=1.)
+        except queue.Empty:
+            raw.release(raw_slot)
+            stats.record(dropped=1)
+            continue
+        
+        start = time.time()
+        Tracker.blur(raw.get(raw_slot)[:height,:width], out=blurred.get(slot))
+        busy = time.time() - start
+        if not keep_raw:
+            raw.release(raw_slot)
+            raw_slot = None
+        blocked = put(output, (seq, timestamp, raw_slot, slot), stopping)
+        if blocked is None:
+            break
+        stats.record(timestamp, busy, blocked)
+
+def trackingStage(raw, blurred, source, control, diagnostics, stats,
+                  stopping, target, num_particles, iterations):
+    """Run the particle filter on blurred frames
+    
+    Sends (seq, timestamp, center, found) to control, and (seq, timestamp,
+    raw slot, particles, center, target) to diagnostics
+    """
+    from Vision import Tracker
+    tracker = None
+    while True:
+        item = get(source, stopping)
+        if item is None:
+            break
+        seq, timestamp, raw_slot, slot = item
+        img = blurred.get(slot)
+        start = time.time()
+        if tracker is None:
+            tracker = Tracker(target, img, num_particles, blurred=True)
+        
+        for _ in range(iterations):
+            found = tracker.track(img, blurred=True, frame_id=seq)
+            if found:
+                break
+        else:
+            tracker.resetParticles()
+        
+        busy = time.time() - start
+        blurred.release(slot)
+        blocked = put(control, (seq, timestamp, tracker.center, found),
+                      stopping)
+        if blocked is None:
+            break
+        
+        if raw_slot is not None:
+            try:
+                diagnostics.put_nowait((seq, timestamp, raw_slot,
+                                        tracker.particles.copy(),
+                                        tracker.center, tracker.target))
+            except queue.Full:
+                raw.release(raw_slot)
+        stats.record(timestamp, busy, blocked)
+
+def controlStage(source, stats, stopping, width, speed, backend):
+    """Steer toward the tracked target, and search for it when lost
+    """
+    from Control import SteeringController
+    from Motion import Drive, MotionScheduler
+    drive = MotionScheduler(Drive(backend=backend))
+    controller = SteeringController(drive, width, max_speed=speed)
+    controller.start()
+    search = None
+    while True:
+        item = get(source, stopping)
+        if item is None:
+            break
+        seq, timestamp, center, found = item
+        start = time.time()
+        if found:
+            controller.update(center, timestamp)
+        else: # Let go first, so a control tick can't stop the search turn
+            controller.disengage()
+            if search is None or search.done():
+                search = drive.turn(0.5)
+        stats.record(timestamp, time.time() - start)
+    
+    controller.stop()
+    drive.shutdown()
+
+def diagnosticsStage(raw, source, stats, stopping, res, output_dir):
+    """Hand annotated frames to a DiagnosticWriter
+    """
+    from Diagnostics import DiagnosticWriter
+    writer = DiagnosticWriter(output_dir)
+    width, height = res
+    while True:
+        item = get(source, stopping)
+        if item is None:
+            break
+        seq, timestamp, raw_slot, particles, center, target = item
+        start = time.time()
+        writer.submit(raw.get(raw_slot)[:height,:width], particles, center,
+                      target, seq)
+        raw.release(raw_slot)
+        stats.record(timestamp, time.time() - start)
+    
+    writer.close()
+
+def runStage(stage, args):
+    """Process entry point. Ctrl-C is left to the parent, which stops the
+       stages in order.
+    
+    :param stage (function): Stage function
+    :param args (tuple): Its arguments
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stage(*args)
+
+
+class Pipeline:
+    """Multi-process version of follow.py's loop. Call start, then poll
+       getStats while it runs, and stop to shut it down.
+       
+       With the simulated backends each process has its own simulated world,
+       so the simulated camera doesn't see the simulated motors move.
+    """
+    stages = ('capture', 'preprocess', 'tracking', 'control', 'diagnostics')
+    
+    def __init__(self, target, res=(740, 480), framerate=30,
+                 num_particles=250, iterations=25, speed=50,
+                 output_dir='../../output', queue_size=2, slots=4,
+                 backend=None):
+        """Initialize
+        
+        :param target (numpy.array): Object image
+        :param res (tuple): (width,height) of captured frames
+        :param framerate (int): camera framerate
+        :param num_particles (int): number of particles to track with
+        :param iterations (int): max particle filter iterations per frame
+        :param speed (int): 0<x<254, Maximum motor speed
+        :param output_dir (str): where diagnostics writes annotated frames,
+                                 or None to skip diagnostics
+        :param queue_size (int): max items waiting between two stages
+        :param slots (int): frame buffers in each shared memory ring
+        :param backend (str): 'sim' to use the simulated camera and motors
+                              (default: see Camera.openCamera and
+                              Motion.openMotorHAT)
+        :inst self.stats (dict): stage name -> StageStats
+        :inst self.processes (list): stage processes, once started
+        """
+        if slots < queue_size + 2:
+            raise ValueError('Need at least queue_size + 2 frame slots')
+        
+        self.target = target
+        self.res = tuple(res)
+        self.framerate = framerate
+        self.num_particles = num_particles
+        self.iterations = iterations
+        self.speed = speed
+        self.output_dir = output_dir
+        self.queue_size = queue_size
+        self.slots = slots
+        self.backend = backend
+        self.stats = dict((stage, StageStats()) for stage in self.stages)
+        self.stopping = multiprocessing.Event()
+        self.processes = []
+        self.rings = []
+        self.started = None
+    
+    def getStats(self):
+        """Report each stage's counters (see StageStats.snapshot)
+        
+        :return stats (dict): stage name -> counters
+        """
+        elapsed = time.time() - self.started if self.started else 0.
+        return dict((stage, self.stats[stage].snapshot(elapsed))
+                    for stage in self.stages)
+    
+    def start(self):
+        """Allocate the shared frame rings and start the stage processes
+        """
+        if self.processes:
+            return
+        
+        # Raw frames keep the camera's padding (see BogieCamera.allocBuffer)
+        width, height = self.res
+        padded = ((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3)
+        raw = FrameRing(padded, slots=self.slots)
+        blurred = FrameRing((height, width, 3), slots=self.slots)
+        self.rings = [raw, blurred]
+        
+        queues = [multiprocessing.Queue(self.queue_size) for _ in range(4)]
+        to_preprocess, to_tracking, to_control, to_diagnostics = queues
+        diagnose = self.output_dir is not None
+        stats = self.stats
+        stopping = self.stopping
+        targets = [
+            (captureStage, (raw, to_preprocess, stats['capture'], stopping,
+                            self.res, self.framerate, self.backend)),
+            (preprocessStage, (raw, blurred, to_preprocess, to_tracking,
+                               stats['preprocess'], stopping, self.res,
+                               diagnose)),
+            (trackingStage, (raw, blurred, to_tracking, to_control,
+                             to_diagnostics, stats['tracking'], stopping,
+                             self.target, self.num_particles,
+                             self.iterations)),
+            (controlStage, (to_control, stats['control'], stopping, width,
+                            self.speed, self.backend)),
+        ]
+        if diagnose:
+            targets.append((diagnosticsStage, (raw, to_diagnostics,
+                                               stats['diagnostics'], stopping,
+                                               self.res, self.output_dir)))
+        
+        self.started = time.time()
+        for target, args in targets:
+            process = multiprocessing.Process(target=runStage,
+                                              args=(target, args),
+                                              name=target.__name__)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+    
+    def stop(self, timeout=5.):
+        """Stop every stage and free the shared memory
+        
+        :param timeout (float): seconds to wait for each process to exit
+        """
+        self.stopping.set()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        
+        for ring in self.rings:
+            ring.unlink()
+        self.rings = []
@@ -0,0 +1,689 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Recording module
+#
+# Segment files hold a sequence of timestamped records with an index at the
+# end:
+#
+#   header:  MAGIC, version (uint16)
+#   records: type (uint8), timestamp (float64), seq (uint32),
+#            length (uint32), payload
+#   index:   timestamp (float64), offset (uint64) of each record
+#   footer:  index offset (uint64), record count (uint32), INDEX_MAGIC
+#
+# A segment that was never closed has no index; readers rebuild it by
+# scanning the records. Readers memory-map the file, so seeking is free and
+# raw frames are read without copying.
+#
+# Record payloads, by type:
+#
+#   FRAME:      JPEG (or PNG) image
+#   RAW_FRAME:  height, width, channels (RAW_HEADER), then the pixels
+#   TRACK:      tracker output for frame seq (TRACK_RECORD)
+#   DRIVE:      speed and steering sent to the drive (DRIVE_RECORD)
+#   TARGET:     PNG of the target template
+#   META:       JSON object of run settings (tracker parameters, seed...)
+#   DROPPED:    none; marks frame seq as captured but not recorded
+#
+# EventRecorder writes segments of frames around motion events; a
+# SessionRecorder logs a whole run (frames, tracker outputs and drive
+# commands), which replay.py can feed back through the tracker and
+# controller.
+#
+import collections
+import cv2
+import json
+import mmap
+import numpy as np
+import os
+import queue
+import struct
+import threading
+import time
+
+MAGIC = b'BOGIESEG'
+INDEX_MAGIC = b'BOGIEIDX'
+VERSION = 1
+EXTENSION = '.bseg'
+HEADER = struct.Struct('<8sH')
+RECORD = struct.Struct('<BdII')
+INDEX_ENTRY = np.dtype([('timestamp', '<f8'), ('offset', '<u8')])
+FOOTER = struct.Struct('<QI8s')
+RAW_HEADER = struct.Struct('<HHB')
+TRACK_RECORD = struct.Struct('<BiiHf') # locked, row, col, particles, maxrw
+DRIVE_RECORD = struct.Struct('<hf') # speed, steering
+
+# Record types
+FRAME = 1
+RAW_FRAME = 2
+TRACK = 3
+DRIVE = 4
+TARGET = 5
+META = 6
+DROPPED = 7
+
+class SegmentWriter:
+    """Writes a segment file. Records should be added in about timestamp
+       order; readers sort the index if they aren't.
+    """
+    def __init__(self, path):
+        """Initialize
+        
+        :param path (str): Segment file to create, and its directory if
+                           need be. It is written under a temporary name
+                           and renamed when closed.
+        :inst self.index (list): (timestamp, offset) of each record
+        :inst self.bytes (int): bytes written so far
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.file = open(path + '.tmp', 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.bytes = HEADER.size
+        self.index = []
+    
+    def add(self, payload, timestamp, seq=0, type=FRAME):
+        """Append a record
+        
+        :param payload (bytes): Record data (e.g. a JPEG)
+        :param timestamp (float): Time the record describes
+        :param seq (int): Sequence number, e.g. the camera frame number
+        :param type (int): Record type
+        """
+        self.index.append((timestamp, self.bytes))
+        self.file.write(RECORD.pack(type, timestamp, seq, len(payload)))
+        self.file.write(payload)
+        self.bytes += RECORD.size + len(payload)
+    
+    def addFrame(self, img, timestamp, seq=0, quality=90):
+        """JPEG-encode an image and append it
+        
+        :param img (numpy.array): BGR image
+        :param timestamp (float): Capture time
+        :param seq (int): Frame number
+        :param quality (int): JPEG quality, 0 to 100
+        """
+        ok, data = cv2.imencode('.jpg', img,
+                                [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        if not ok:
+            raise IOError('Could not encode frame %d' % seq)
+        self.add(data.tobytes(), timestamp, seq, FRAME)
+    
+    def addDrive(self, timestamp, speed, steering):
+        """Append a drive command
+        
+        :param timestamp (float): Time it was sent
+        :param speed (int): Speed
+        :param steering (float): Steering, -1 (left) to 1 (right)
+        """
+        self.add(DRIVE_RECORD.pack(int(speed), steering), timestamp, 0, DRIVE)
+    
+    def addDropped(self, timestamp, seq):
+        """Append a marker for a frame that was captured but not recorded
+        
+        :param timestamp (float): Capture time
+        :param seq (int): Frame number
+        """
+        self.add(b'', timestamp, seq, DROPPED)
+    
+    def addMeta(self, meta, timestamp):
+        """Append the run settings
+        
+        :param meta (dict): JSON serializable settings
+        :param timestamp (float): Time the run started
+        """
+        self.add(json.dumps(meta, sort_keys=True).encode(), timestamp, 0,
+                 META)
+    
+    def addRawFrame(self, img, timestamp, seq=0):
+        """Append an image as is, which is larger than a JPEG but costs
+           nothing to encode and replays exactly
+        
+        :param img (numpy.array): uint8 image, grayscale or with channels
+        :param timestamp (float): Capture time
+        :param seq (int): Frame number
+        """
+        channels = img.shape[2] if img.ndim == 3 else 1
+        header = RAW_HEADER.pack(img.shape[0], img.shape[1], channels)
+        self.add(header + np.ascontiguousarray(img).tobytes(), timestamp, seq,
+                 RAW_FRAME)
+    
+    def addTarget(self, img, timestamp):
+        """Append the target template, losslessly encoded
+        
+        :param img (numpy.array): BGR image
+        :param timestamp (float): Time tracking started
+        """
+        ok, data = cv2.imencode('.png', img)
+        if not ok:
+            raise IOError('Could not encode target')
+        self.add(data.tobytes(), timestamp, 0, TARGET)
+    
+    def addTrack(self, timestamp, seq, center, num_particles=0, maxrw=0.):
+        """Append a tracker output
+        
+        :param timestamp (float): Time the output was reported (the frame's
+                                  capture time is in its own record)
+        :param seq (int): Frame number
+        :param center (tuple): (row,col) of the target, or None if lost
+        :param num_particles (int): Particles in use
+        :param maxrw (float): Best raw particle weight
+        """
+        row, col = (-1, -1) if center is None else center
+        self.add(TRACK_RECORD.pack(center is not None, int(row), int(col),
+                                   min(num_particles, 65535), maxrw),
+                 timestamp, seq, TRACK)
+    
+    def close(self):
+        """Write the index and footer, and move the file into place
+        """
+        if self.file is None:
+            return
+        
+        index = np.array(self.index, dtype=INDEX_ENTRY)
+        self.file.write(index.tobytes())
+        self.file.write(FOOTER.pack(self.bytes, len(index), INDEX_MAGIC))
+        self.bytes += index.nbytes + FOOTER.size
+        self.file.close()
+        self.file = None
+        os.replace(self.path + '.tmp', self.path)
+
+
+class SegmentReader:
+    """Random access to the records of a segment file
+    """
+    def __init__(self, path):
+        """Initialize
+        
+        :param path (str): Segment file
+        :inst self.timestamps (numpy.array): timestamp of each record
+        :inst self.offsets (numpy.array): file offset of each record
+        """
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        if len(self.data) < HEADER.size:
+            raise IOError('%s is not a segment file' % path)
+        magic, version = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise IOError('%s is not a segment file' % path)
+        if version > VERSION:
+            raise IOError('%s has unsupported version %d' % (path, version))
+        
+        index = self.readIndex()
+        if index is None:
+            index = self.scan()
+        if np.any(np.diff(index['timestamp']) < 0):
+            index = index[np.argsort(index['timestamp'], kind='stable')]
+        self.timestamps = index['timestamp']
+        self.offsets = index['offset']
+    
+    def __len__(self):
+        return len(self.offsets)
+    
+    def close(self):
+        """Close the file. Payloads still referenced keep the mapping alive
+           until they are released.
+        """
+        self.view.release()
+        try:
+            self.data.close()
+        except BufferError:
+            pass
+        self.file.close()
+    
+    def commands(self, start=None, end=None):
+        """Decode the drive commands sent between two times
+        
+        :param start (float): First timestamp (default: the beginning)
+        :param end (float): Stop before this timestamp (default: the end)
+        :return (generator): (timestamp, speed, steering) tuples
+        """
+        for type, timestamp, seq, payload in self.records(start, end,
+                                                          (DRIVE,)):
+            speed, steering = DRIVE_RECORD.unpack(payload)
+            yield timestamp, speed, steering
+    
+    def dropped(self, start=None, end=None):
+        """List the frames captured between two times that weren't recorded
+        
+        :param start (float): First timestamp (default: the beginning)
+        :param end (float): Stop before this timestamp (default: the end)
+        :return (generator): (seq, timestamp) tuples
+        """
+        for type, timestamp, seq, payload in self.records(start, end,
+                                                          (DROPPED,)):
+            yield seq, timestamp
+    
+    def frames(self, start=None, end=None):
+        """Decode the frames recorded between two times. Raw frames are
+           read-only views of the file, not copies.
+        
+        :param start (float): First timestamp (default: the beginning)
+        :param end (float): Stop before this timestamp (default: the end)
+        :return (generator): (seq, timestamp, image) tuples
+        """
+        for type, timestamp, seq, payload in self.records(start, end,
+                                                          (FRAME, RAW_FRAME)):
+            if type == FRAME:
+                data = np.frombuffer(payload, dtype=np.uint8)
+                yield seq, timestamp, cv2.imdecode(data, cv2.IMREAD_COLOR)
+                continue
+            
+            height, width, channels = RAW_HEADER.unpack_from(payload)
+            img = np.frombuffer(payload, dtype=np.uint8,
+                                offset=RAW_HEADER.size)
+            shape = (height, width) if channels == 1 else \
+                    (height, width, channels)
+            yield seq, timestamp, img.reshape(shape)
+    
+    def getMeta(self):
+        """Find the run settings
+        
+        :return meta (dict): first META record's settings (empty if none)
+        """
+        for type, timestamp, seq, payload in self.records(types=(META,)):
+            return json.loads(bytes(payload).decode())
+        return {}
+    
+    def getTarget(self):
+        """Find the target template
+        
+        :return target (numpy.array): first TARGET record's image, or None
+        """
+        for type, timestamp, seq, payload in self.records(types=(TARGET,)):
+            data = np.frombuffer(payload, dtype=np.uint8)
+            return cv2.imdecode(data, cv2.IMREAD_COLOR)
+        return None
+    
+    def read(self, i):
+        """Read one record
+        
+        :param i (int): Record number
+        :return (tuple): type, timestamp, seq and payload (a memoryview of
+                         the file)
+        """
+        offset = int(self.offsets[i])
+        type, timestamp, seq, length = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        return type, timestamp, seq, self.view[start:start + length]
+    
+    def readIndex(self):
+        """Load the index from the end of the file
+        
+        :return index (numpy.array): INDEX_ENTRY records, or None if the
+                                     segment wasn't closed properly
+        """
+        size = len(self.data)
+        if size < HEADER.size + FOOTER.size:
+            return None
+        
+        offset, count, magic = FOOTER.unpack_from(self.data,
+                                                  size - FOOTER.size)
+        if magic != INDEX_MAGIC or \
+           offset + count * INDEX_ENTRY.itemsize + FOOTER.size != size:
+            return None
+        
+        return np.frombuffer(self.data, dtype=INDEX_ENTRY, count=count,
+                             offset=offset).copy()
+    
+    def records(self, start=None, end=None, types=None):
+        """Read the records between two times
+        
+        :param start (float): First timestamp (default: the beginning)
+        :param end (float): Stop before this timestamp (default: the end)
+        :param types (tuple): Record types to include (default: all)
+        :return (generator): (type, timestamp, seq, payload) tuples
+        """
+        first = 0 if start is None else self.seek(start)
+        last = len(self) if end is None else self.seek(end)
+        for i in range(first, last):
+            record = self.read(i)
+            if types is None or record[0] in types:
+                yield record
+    
+    def scan(self):
+        """Rebuild the index by walking the records, stopping at the first
+           incomplete one
+        
+        :return index (numpy.array): INDEX_ENTRY records
+        """
+        size = len(self.data)
+        offset = HEADER.size
+        entries = []
+        while offset + RECORD.size <= size:
+            type, timestamp, seq, length = RECORD.unpack_from(self.data,
+                                                              offset)
+            if offset + RECORD.size + length > size:
+                break
+            entries.append((timestamp, offset))
+            offset += RECORD.size + length
+        
+        return np.array(entries, dtype=INDEX_ENTRY)
+    
+    def seek(self, timestamp):
+        """Find the first record at or after a time
+        
+        :param timestamp (float): Time
+        :return (int): Record number (len(self) if there is none)
+        """
+        return int(np.searchsorted(self.timestamps, timestamp))
+    
+    def tracks(self, start=None, end=None):
+        """Decode the tracker outputs recorded between two times
+        
+        :param start (float): First timestamp (default: the beginning)
+        :param end (float): Stop before this timestamp (default: the end)
+        :return (generator): (seq, timestamp, center or None, particles,
+                             maxrw) tuples
+        """
+        for type, timestamp, seq, payload in self.records(start, end,
+                                                          (TRACK,)):
+            locked, row, col, num_particles, maxrw = \
+                TRACK_RECORD.unpack(payload)
+            center = (row, col) if locked else None
+            yield seq, timestamp, center, num_particles, maxrw
+
+
+class EventRecorder:
+    """Records the frames around events. Recent frames wait in a pre-roll
+       ring; when an event is triggered they are written to a new segment,
+       followed by the frames of the post-roll, which restarts whenever
+       another event arrives before it ends. Encoding and writing happen on
+       a worker thread; if it falls behind, frames are dropped (leaving a
+       DROPPED record) rather than holding up the caller.
+    """
+    def __init__(self, output_dir, pre_roll=15, post_roll=45, quality=90,
+                 queue_size=None):
+        """Initialize
+        
+        :param output_dir (str): Directory for the segment files
+        :param pre_roll (int): Frames kept from before each event
+        :param post_roll (int): Frames recorded after the last event
+        :param quality (int): JPEG quality, 0 to 100
+        :param queue_size (int): Frames waiting to be written before new ones
+                                 are dropped (default: pre_roll + post_roll)
+        :inst self.ring (collections.deque): pre-roll (seq, timestamp, image)
+        :inst self.remaining (int): post-roll frames still to record, or 0
+                                    when not recording
+        :inst self.frames (queue.Queue): frames for the writer thread
+        :inst self.queue (queue.Queue): other work for the writer thread
+        :inst self.counters (dict): events, segments, frames, dropped frames
+                                    and bytes written
+        """
+        if queue_size is None:
+            queue_size = pre_roll + post_roll
+        
+        self.output_dir = output_dir
+        self.post_roll = post_roll
+        self.quality = quality
+        self.ring = collections.deque(maxlen=pre_roll)
+        self.remaining = 0
+        self.frames = queue.Queue(maxsize=max(1, queue_size))
+        self.queue = queue.Queue()
+        self.counters = {'events': 0, 'segments': 0, 'frames': 0,
+                         'dropped': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def add(self, img, timestamp, seq=0):
+        """Offer a frame: it's recorded during a post-roll, and otherwise kept
+           in the pre-roll ring
+        
+        :param img (numpy.array): BGR image (copied)
+        :param timestamp (float): Capture time
+        :param seq (int): Frame number
+        """
+        item = (seq, timestamp, img.copy())
+        if self.remaining > 0:
+            self.queueFrame(item)
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.queue.put(('close', None))
+        else:
+            self.ring.append(item)
+    
+    def close(self):
+        """Finish the current segment and stop the writer thread
+        """
+        if self.remaining > 0:
+            self.remaining = 0
+            self.queue.put(('close', None))
+        self.queue.put(('stop', None))
+        self.thread.join()
+    
+    def getStats(self):
+        """Report recording counters
+        
+        :return stats (dict): events, segments, frames, dropped frames and
+                              bytes written
+        """
+        with self.lock:
+            return dict(self.counters)
+    
+    def queueFrame(self, item):
+        """Pass a frame to the writer thread, unless it is behind
+        
+        :param item (tuple): seq, timestamp and image
+        :return (bool): whether the frame was queued
+        """
+        try:
+            self.frames.put_nowait(item)
+        except queue.Full:
+            with self.lock:
+                self.counters['dropped'] += 1
+            self.queue.put(('dropped', (item[1], item[0])))
+            return False
+        self.queue.put(('frame', None))
+        return True
+    
+    def trigger(self, timestamp):
+        """Record an event: start a segment with the pre-roll, or extend the
+           post-roll of the one being recorded
+        
+        :param timestamp (float): Time of the event
+        """
+        with self.lock:
+            self.counters['events'] += 1
+        
+        if self.remaining == 0:
+            name = '%d%s' % (int(timestamp * 1000), EXTENSION)
+            self.queue.put(('open', os.path.join(self.output_dir, name)))
+            while self.ring:
+                self.queueFrame(self.ring.popleft())
+        self.remaining = self.post_roll
+        if self.remaining == 0:
+            self.queue.put(('close', None))
+    
+    def work(self):
+        """Writer thread: open, fill and close segments
+        """
+        writer = None
+        while True:
+            command, arg = self.queue.get()
+            if command == 'open':
+                writer = SegmentWriter(arg)
+            elif command == 'frame':
+                seq, timestamp, img = self.frames.get()
+                start = writer.bytes
+                writer.addFrame(img, timestamp, seq, self.quality)
+                with self.lock:
+                    self.counters['frames'] += 1
+                    self.counters['bytes'] += writer.bytes - start
+            elif command == 'dropped': # Counted when dropped
+                writer.addDropped(*arg)
+            elif command == 'close' and writer is not None:
+                writer.close()
+                writer = None
+                with self.lock:
+                    self.counters['segments'] += 1
+            elif command == 'stop':
+                return
+
+
+class RecordingDrive:
+    """Stands in for a drive, logging every drive command to a
+       SessionRecorder before passing it on. Everything else goes straight
+       to the drive.
+    """
+    def __init__(self, drive, recorder, clock=time.time):
+        """Initialize
+        
+        :param drive (MotionScheduler): anything with drive(speed, steering)
+        :param recorder (SessionRecorder): Where commands are logged
+        :param clock (function): Time source for the command timestamps
+        """
+        self.wrapped = drive
+        self.recorder = recorder
+        self.clock = clock
+    
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+    
+    def drive(self, speed=0, steering=0.):
+        """Log and send a drive command (see Drive.drive)
+        """
+        self.recorder.addDrive(self.clock(), speed, steering)
+        return self.wrapped.drive(speed, steering)
+
+
+class SessionRecorder:
+    """Records a whole run to one segment: the target, every frame, what the
+       tracker made of it, and the commands sent to the drive, so the run can
+       be replayed offline (see replay.py). Encoding and writing happen on a
+       worker thread; if it falls behind, frames are dropped (leaving a
+       DROPPED record) rather than holding up the caller, but tracker
+       outputs and commands never are.
+    """
+    def __init__(self, path, raw=False, quality=90, queue_size=30):
+        """Initialize
+        
+        :param path (str): Segment file to write
+        :param raw (bool): Store frames as is rather than as JPEGs, so they
+                           replay exactly (at ~10x the size)
+        :param quality (int): JPEG quality, 0 to 100
+        :param queue_size (int): Frames waiting to be written before new ones
+                                 are dropped
+        :inst self.frames (queue.Queue): frames for the writer thread
+        :inst self.queue (queue.Queue): other records for the writer thread
+        :inst self.counters (dict): frames, dropped frames, tracks, commands
+                                    and bytes written
+        """
+        self.path = path
+        self.raw = raw
+        self.quality = quality
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.queue = queue.Queue()
+        self.counters = {'frames': 0, 'dropped': 0, 'tracks': 0,
+                         'commands': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        self.writer = SegmentWriter(path)
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def addDrive(self, timestamp, speed, steering):
+        """Record a drive command
+        
+        :param timestamp (float): Time it was sent
+        :param speed (int): Speed
+        :param steering (float): Steering, -1 (left) to 1 (right)
+        """
+        self.queue.put(('drive', (timestamp, speed, steering)))
+    
+    def addFrame(self, img, timestamp, seq=0):
+        """Record a frame, unless the writer is behind
+        
+        :param img (numpy.array): BGR image (copied)
+        :param timestamp (float): Capture time
+        :param seq (int): Frame number
+        :return (bool): whether the frame was queued
+        """
+        try:
+            self.frames.put_nowait((seq, timestamp, img.copy()))
+        except queue.Full:
+            with self.lock:
+                self.counters['dropped'] += 1
+            self.queue.put(('dropped', (timestamp, seq)))
+            return False
+        self.queue.put(('frame', None))
+        return True
+    
+    def addMeta(self, meta, timestamp):
+        """Record the run settings (see SegmentWriter.addMeta)
+        """
+        self.queue.put(('meta', (dict(meta), timestamp)))
+    
+    def addTarget(self, img, timestamp):
+        """Record the target template
+        
+        :param img (numpy.array): BGR image (copied)
+        :param timestamp (float): Time tracking started
+        """
+        self.queue.put(('target', (img.copy(), timestamp)))
+    
+    def addTrack(self, timestamp, seq, center, num_particles=0, maxrw=0.):
+        """Record a tracker output (see SegmentWriter.addTrack)
+        """
+        self.queue.put(('track', (timestamp, seq, center, num_particles,
+                                  maxrw)))
+    
+    def close(self):
+        """Write what's queued, finish the segment and stop the writer
+           thread
+        """
+        self.queue.put(('stop', None))
+        self.thread.join()
+    
+    def getStats(self):
+        """Report recording counters
+        
+        :return stats (dict): frames, dropped frames, tracks, commands and
+                              bytes written
+        """
+        with self.lock:
+            return dict(self.counters)
+    
+    def work(self):
+        """Writer thread: append records in the order they were added
+        """
+        writer = self.writer
+        while True:
+            command, arg = self.queue.get()
+            start = writer.bytes
+            if command == 'frame':
+                seq, timestamp, img = self.frames.get()
+                if self.raw:
+                    writer.addRawFrame(img, timestamp, seq)
+                else:
+                    writer.addFrame(img, timestamp, seq, self.quality)
+                counter = 'frames'
+            elif command == 'track':
+                writer.addTrack(*arg)
+                counter = 'tracks'
+            elif command == 'drive':
+                writer.addDrive(*arg)
+                counter = 'commands'
+            elif command == 'target':
+                writer.addTarget(*arg)
+                counter = None
+            elif command == 'meta':
+                writer.addMeta(*arg)
+                counter = None
+            elif command == 'dropped': # Counted when dropped
+                writer.addDropped(*arg)
+                counter = None
+            elif command == 'stop':
+                writer.close()
+                return
+            
+            with self.lock:
+                if counter is not None:
+                    self.counters[counter] += 1
+                self.counters['bytes'] += writer.bytes - start
@@ -0,0 +1,424 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Simulation module
+#
+import cv2
+import glob
+import numpy as np
+import os
+import threading
+import time
+
+PHOTOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'photos')
+
+class World:
+    """Simulated rover pose, integrated from the commanded wheel speeds.
+       Calibrated to the constants Drive uses: at speed 128 the rover covers
+       1cm per 0.011s, and turns 1 radian per 0.63s when spinning in place.
+    """
+    def __init__(self):
+        """Initialize
+        
+        :inst self.x (float): position (in centimeters)
+        :inst self.y (float): position (in centimeters)
+        :inst self.heading (float): heading in radians, positive to the right
+        :inst self.left (int): left wheel speed, -255 to 255
+        :inst self.right (int): right wheel speed, -255 to 255
+        :inst self.last_update (float): time the pose was last integrated
+        """
+        self.x = 0.
+        self.y = 0.
+        self.heading = 0.
+        self.left = 0
+        self.right = 0
+        self.last_update = time.time()
+        self.lock = threading.Lock()
+    
+    def getPose(self):
+        """Current pose
+        
+        :return (tuple): (x, y, heading)
+        """
+        with self.lock:
+            self.update()
+            return (self.x, self.y, self.heading)
+    
+    def setWheels(self, left, right):
+        """Change the wheel speeds, integrating the pose up to now first
+        
+        :param left (int): left wheel speed, -255 to 255
+        :param right (int): right wheel speed, -255 to 255
+        """
+        with self.lock:
+            self.update()
+            self.left = left
+            self.right = right
+    
+    def update(self):
+        """Integrate the pose since the last update (lock must be held)
+        """
+        now = time.time()
+        dt = now - self.last_update
+        self.last_update = now
+        velocity = (self.left + self.right) / 2. / (0.011 * 128)
+        rotation = (self.left - self.right) / (0.63 * 256)
+        
+        # Exact integration of a constant-velocity arc
+        if abs(rotation) < 1e-9:
+            self.x += velocity * dt * np.sin(self.heading)
+            self.y += velocity * dt * np.cos(self.heading)
+        else:
+            new_heading = self.heading + rotation * dt
+            radius = velocity / rotation
+            self.x += radius * (np.cos(self.heading) - np.cos(new_heading))
+            self.y += radius * (np.sin(new_heading) - np.sin(self.heading))
+            self.heading = new_heading
+
+
+world = World()
+
+
+class SimDCMotor:
+    """Simulated Adafruit_DCMotor
+    """
+    def __init__(self, hat, num):
+        """Initialize
+        
+        :param hat (SimMotorHAT): Controller the motor belongs to
+        :param num (int): Motor number, 1 to 4
+        :inst self.direction (int): FORWARD, BACKWARD or RELEASE
+        :inst self.speed (int): 0 to 255
+        """
+        self.hat = hat
+        self.num = num
+        self.direction = SimMotorHAT.RELEASE
+        self.speed = 0
+    
+    def getVelocity(self):
+        """Signed wheel speed
+        
+        :return (int): -255 to 255, negative is backward
+        """
+        if self.direction == SimMotorHAT.FORWARD:
+            return self.speed
+        elif self.direction == SimMotorHAT.BACKWARD:
+            return -self.speed
+        
+        return 0
+    
+    def run(self, command):
+        """Set the direction
+        
+        :param command (int): FORWARD, BACKWARD or RELEASE
+        """
+        self.direction = command
+        self.hat.updateWorld()
+    
+    def setSpeed(self, speed):
+        """Set the speed
+        
+        :param speed (int): 0 to 255
+        """
+        self.speed = min(255, max(0, int(speed)))
+        self.hat.updateWorld()
+
+
+class SimPWM:
+    """Simulated PCA9685 PWM controller of the Motor HAT, for block writes to
+       its registers. Writes to the channels of motors 1 and 2 are decoded
+       back into motor directions and speeds.
+    """
+    def __init__(self, hat):
+        """Initialize
+        
+        :param hat (SimMotorHAT): Controller the PWM chip belongs to
+        :inst self.i2c (SimPWM): I2C device (the chip itself)
+        :inst self.registers (bytearray): register file
+        """
+        self.hat = hat
+        self.i2c = self
+        self.registers = bytearray(256)
+    
+    def getChannel(self, channel):
+        """Read a channel's on and off counts
+        
+        :param channel (int): Channel, 0 to 15
+        :return (tuple): (on, off)
+        """
+        base = 0x06 + 4 * channel
+        r = self.registers
+        return (r[base] | r[base+1] << 8, r[base+2] | r[base+3] << 8)
+    
+    def readU8(self, register):
+        """Read a register
+        
+        :param register (int): Register address
+        :return (int): value
+        """
+        return self.registers[register]
+    
+    def write8(self, register, value):
+        """Write a register
+        
+        :param register (int): Register address
+        :param value (int): Byte to write
+        """
+        self.registers[register] = value & 0xFF
+    
+    def writeList(self, register, data):
+        """Block write, which needs the MODE1 auto-increment bit
+        
+        :param register (int): First register address
+        :param data (list): Bytes to write
+        """
+        if not self.registers[0] & 0x20:
+            raise IOError('PCA9685 auto-increment is disabled')
+        
+        self.registers[register:register+len(data)] = bytearray(data)
+        for motor, (pwm, in2, in1) in zip(self.hat.motors,
+                                          ((8, 9, 10), (13, 12, 11))):
+            high_in1 = self.getChannel(in1)[0] & 0x1000
+            high_in2 = self.getChannel(in2)[0] & 0x1000
+            if high_in1 and high_in2:
+                motor.direction = SimMotorHAT.BRAKE
+            elif high_in1:
+                motor.direction = SimMotorHAT.FORWARD
+            elif high_in2:
+                motor.direction = SimMotorHAT.BACKWARD
+            else:
+                motor.direction = SimMotorHAT.RELEASE
+            off = self.getChannel(pwm)[1]
+            motor.speed = 0 if off & 0x1000 else off // 16
+        
+        self.hat.updateWorld()
+
+
+class SimMotorHAT:
+    """Simulated Adafruit_MotorHAT. Motor 1 drives the left wheels and motor
+       2 the right, and their speeds move the simulated world's rover.
+    """
+    FORWARD = 1
+    BACKWARD = 2
+    BRAKE = 3
+    RELEASE = 4
+    
+    def __init__(self, addr=0x60, world=world):
+        """Initialize
+        
+        :param addr (int): I2C address (ignored)
+        :param world (World): World whose rover the motors move
+        :inst self.motors (list): the four SimDCMotors
+        :inst self._pwm (SimPWM): PWM controller, as in Adafruit_MotorHAT
+        """
+        self.world = world
+        self.motors = [SimDCMotor(self, num) for num in range(1,5)]
+        self._pwm = SimPWM(self)
+    
+    def getMotor(self, num):
+        """Return a motor
+        
+        :param num (int): Motor number, 1 to 4
+        :return (SimDCMotor): the motor
+        """
+        if num < 1 or num > 4:
+            raise NameError('MotorHAT Motor must be between 1 and 4 inclusive')
+        
+        return self.motors[num-1]
+    
+    def updateWorld(self):
+        """Pass the current wheel speeds on to the world
+        """
+        self.world.setWheels(self.motors[0].getVelocity(),
+                             self.motors[1].getVelocity())
+
+
+class SimCameraBase:
+    """Common picamera.PiCamera interface for the simulated cameras.
+       Subclasses provide render, which returns the next BGR frame.
+    """
+    def __init__(self):
+        """Initialize
+        
+        :inst self.resolution (tuple): (width,height) of captured frames
+        :inst self.framerate (int): nominal framerate
+        :inst self.index (int): number of frames rendered so far
+        :inst self.last_frame (float): when the video port last produced one
+        """
+        self.resolution = (740, 480)
+        self.framerate = 30
+        self.index = 0
+        self.last_frame = 0.
+    
+    def capture(self, output, format='jpeg', use_video_port=False):
+        """Write the next frame to `output` the way picamera would
+        
+        :param output: writable file-like object for jpeg, otherwise an
+                       object supporting the buffer protocol
+        :param format (str): 'jpeg', 'bgr' or 'yuv'
+        :param use_video_port (bool): pace captures at the framerate
+        """
+        if use_video_port:
+            delay = self.last_frame + 1. / self.framerate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.last_frame = time.time()
+        
+        width, height = self.resolution
+        frame = self.render()
+        self.index += 1
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height))
+        
+        if format == 'jpeg':
+            output.write(cv2.imencode('.jpg', frame)[1].tobytes())
+            return
+        
+        # Unencoded output is padded to 32 columns and 16 rows
+        pad_width = (width + 31) // 32 * 32
+        pad_height = (height + 15) // 16 * 16
+        frame = cv2.copyMakeBorder(frame, 0, pad_height - height,
+                                   0, pad_width - width, cv2.BORDER_CONSTANT)
+        if format == 'yuv':
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420)
+        elif format != 'bgr':
+            raise ValueError('Unsupported format: %s' % format)
+        
+        buf = np.frombuffer(output, dtype=np.uint8)
+        buf[:frame.size] = frame.ravel()
+    
+    def close(self):
+        """Nothing to release
+        """
+        pass
+    
+    def start_preview(self):
+        """Nothing to preview
+        """
+        pass
+
+
+class ReplayCamera(SimCameraBase):
+    """Stand-in for picamera.PiCamera that replays image files, for running
+       BogieCamera without the camera hardware.
+    """
+    def __init__(self, files=None):
+        """Initialize
+        
+        :param files (list): Image files to replay, in order (default: the
+                             photos in the repository's photos directory)
+        :inst self.frames (list): decoded images
+        """
+        SimCameraBase.__init__(self)
+        if files is None:
+            files = sorted(glob.glob(os.path.join(PHOTOS, '*.jpg')))
+        
+        self.frames = [cv2.imread(f) for f in files]
+        if len(self.frames) == 0 or any(f is None for f in self.frames):
+            raise IOError('Could not load replay images')
+        
+        self.resolution = self.frames[0].shape[1::-1]
+    
+    def render(self):
+        """Next image in the sequence, looping back to the first
+        
+        :return (numpy.array): BGR image
+        """
+        return self.frames[self.index % len(self.frames)]
+
+
+class SimCamera(SimCameraBase):
+    """Stand-in for picamera.PiCamera that synthesizes frames of a target
+       moving in front of a textured backdrop. The backdrop wraps all the way
+       around the rover, and the view pans with the simulated heading, so
+       turning the simulated motors moves the scene.
+    """
+    def __init__(self, target=None, world=world, fov=0.93, motion=(0.3, 0.6),
+                 seed=0):
+        """Initialize
+        
+        :param target (numpy.array): Target image (default: a synthetic
+                                     marker)
+        :param world (World): World providing the rover heading
+        :param fov (float): Horizontal field of view in radians
+        :param motion (tuple): Amplitude (radians) and angular frequency
+                               (radians per second of frame time) of the
+                               target's side to side motion
+        :param seed (int): Seed for the backdrop texture
+        :inst self.target (numpy.array): Target image
+        :inst self.truth (tuple): (row,col) of the target center in the last
+                                  frame, or None if it was out of view
+        """
+        SimCameraBase.__init__(self)
+        if target is None:
+            # Neutral surround, so the blurred edges blend with the backdrop
+            target = np.full((48, 48, 3), 130, dtype=np.uint8)
+            cv2.circle(target, (24, 24), 16, (40, 40, 200), -1)
+            cv2.rectangle(target, (18, 18), (30, 30), (255, 255, 255), -1)
+        
+        self.target = target
+        self.world = world
+        self.fov = fov
+        self.motion = motion
+        self.seed = seed
+        self.truth = None
+        self.backdrop = None
+    
+    def getFocalLength(self):
+        """Focal length in pixels for the current resolution
+        
+        :return (float): focal length
+        """
+        return (self.resolution[0] / 2.) / np.tan(self.fov / 2.)
+    
+    def makeBackdrop(self):
+        """Generate a smooth random texture covering a full turn
+        
+        :return (numpy.array): BGR backdrop, one column per 1/f radians
+        """
+        width, height = self.resolution
+        circumference = int(round(2 * np.pi * self.getFocalLength()))
+        rng = np.random.default_rng(self.seed)
+        noise = rng.integers(90, 170, size=(height // 24 + 1,
+                                            circumference // 24 + 1, 3))
+        backdrop = cv2.resize(noise.astype(np.uint8),
+                              (circumference, height),
+                              interpolation=cv2.INTER_CUBIC)
+        return cv2.GaussianBlur(backdrop, (9,9), 3)
+    
+    def render(self):
+        """Draw the scene as seen from the current heading
+        
+        :return (numpy.array): BGR image
+        """
+        width, height = self.resolution
+        if self.backdrop is None or self.backdrop.shape[0] != height:
+            self.backdrop = self.makeBackdrop()
+        
+        heading = self.world.getPose()[2]
+        f = self.getFocalLength()
+        offset = int(round(heading * f))
+        columns = np.arange(offset, offset + width) % self.backdrop.shape[1]
+        frame = self.backdrop[:,columns]
+        
+        # Target bearing and height follow a figure eight in frame time
+        t = self.index / float(self.framerate)
+        amplitude, frequency = self.motion
+        bearing = amplitude * np.sin(frequency * t) - heading
+        bearing = (bearing + np.pi) % (2 * np.pi) - np.pi
+        row = int(round(height / 2. + height / 4. * np.sin(2 * frequency * t)))
+        col = int(round(width / 2. + bearing * f))
+        
+        # Paste the target, clipped to the frame
+        t_h, t_w = self.target.shape[:2]
+        top, left = row - t_h // 2, col - t_w // 2
+        r0, c0 = max(top, 0), max(left, 0)
+        r1, c1 = min(top + t_h, height), min(left + t_w, width)
+        if r0 < r1 and c0 < c1:
+            frame[r0:r1,c0:c1] = self.target[r0-top:r1-top,c0-left:c1-left]
+            self.truth = (row, col)
+        else:
+            self.truth = None
+        
+        return frame
@@ -3,40 +3,527 @@
 #
 # Vision module
 #
+import Instrumentation
+import collections
 import cv2
 import numpy as np
-import random
 import time
+import zlib
+
+
+class Resampler:
+    """Vectorized particle resampling. Each strategy draws N particle indices
+       in O(N) from the cumulative weights, instead of walking a sampling
+       wheel one particle at a time.
+    """
+    methods = ('systematic', 'stratified', 'residual')
+    
+    def __init__(self, method='systematic', jitter=10, rng=None):
+        """Initialize
+        
+        :param method (str): 'systematic', 'stratified' or 'residual'
+        :param jitter (int): max noise (in pixels) added to each coordinate
+        :param rng (numpy.random.Generator): random source, or a seed for one
+        :inst self.method (str): resampling strategy
+        :inst self.jitter (int): max noise added to each coordinate
+        :inst self.rng (numpy.random.Generator): random source
+        :inst self.noise (numpy.array): scratch buffer for particle noise
+        """
+        if method not in self.methods:
+            raise ValueError('Unknown resampling method: %s' % method)
+        
+        self.method = method
+        self.jitter = jitter
+        self.rng = np.random.default_rng(rng)
+        self.noise = np.empty((0,2))
+    
+    def getIndices(self, weights, n=None):
+        """Choose which particles survive resampling
+        
+        :param weights (numpy.array): Normalized particle weights
+        :param n (int): Number of indices to draw (default: len(weights))
+        :return indices (numpy.array): Index of the parent of each particle
+        """
+        weights = np.asarray(weights, dtype=float)
+        if n is None:
+            n = len(weights)
+        
+        if self.method == 'residual':
+            # Keep floor(n*w) copies of each particle outright, then fill the
+            # remaining slots systematically from what is left of the weights
+            counts = np.floor(n * weights).astype(int)
+            indices = np.repeat(np.arange(len(weights)), counts)
+            remaining = n - len(indices)
+            if remaining == 0:
+                return indices
+            
+            residual = n * weights - counts
+            positions = (self.rng.random() + np.arange(remaining)) / remaining
+            return np.concatenate((indices,
+                                   self.searchCumulative(residual, positions)))
+        
+        if self.method == 'stratified':
+            positions = (self.rng.random(n) + np.arange(n)) / n
+        else:
+            positions = (self.rng.random() + np.arange(n)) / n
+        
+        return self.searchCumulative(weights, positions)
+    
+    def resample(self, particles, weights, n=None, out=None, indices=None):
+        """Resample particles and add noise to the survivors
+        
+        :param particles (numpy.array): (N,2) array of (row,col) locations
+        :param weights (numpy.array): Normalized particle weights
+        :param n (int): Number of particles to draw (default: len(particles))
+        :param out (numpy.array): (n,2) int array to write the particles to,
+                                  must not be `particles` itself
+        :param indices (numpy.array): n parents already drawn with
+                                      getIndices, to use instead of drawing
+        :return new_particles (numpy.array): (n,2) array of resampled particles
+        """
+        particles = np.asarray(particles, dtype=int)
+        if n is None:
+            n = len(particles) if out is None else len(out)
+        if indices is None:
+            indices = self.getIndices(weights, n)
+        
+        new_particles = np.take(particles, indices, axis=0, out=out)
+        
+        # Uniform integer noise in [-jitter, jitter], drawn into a reused
+        # buffer rather than allocating a new array for every frame
+        if len(self.noise) < n:
+            self.noise = np.empty((n,2))
+        noise = self.noise[:n]
+        self.rng.random(out=noise)
+        noise *= 2 * self.jitter + 1
+        np.floor(noise, out=noise)
+        noise -= self.jitter
+        np.add(new_particles, noise, out=new_particles, casting='unsafe')
+        return new_particles
+    
+    @staticmethod
+    def thin(indices, n):
+        """Evenly spaced subset of drawn indices. The strategies draw
+           indices in order of cumulative weight, so the subset is about
+           what drawing n in the first place would have given.
+        
+        :param indices (numpy.array): Indices from getIndices
+        :param n (int): Number to keep, at most len(indices)
+        :return (numpy.array): n of the indices
+        """
+        return indices[(np.arange(n) * len(indices)) // n]
+    
+    def searchCumulative(self, weights, positions):
+        """Find which weight bin each position in [0,1) falls into
+        
+        :param weights (numpy.array): Particle weights (need not sum to 1)
+        :param positions (numpy.array): Sorted positions in [0,1)
+        :return indices (numpy.array): Bin index for each position
+        """
+        cumulative = np.cumsum(weights)
+        cumulative /= cumulative[-1]
+        indices = np.searchsorted(cumulative, positions, side='right')
+        return np.minimum(indices, len(weights) - 1)
+
+
+class FrameCache:
+    """Small LRU cache of data derived from recent frames (the blurred image,
+       its pyramid, response maps), so repeated track calls on one frame only
+       pay for the particle updates. Frames are identified by a caller
+       supplied id, such as the camera's sequence number. Without one, a
+       checksum of the whole frame stands in, so a new frame captured into
+       a reused buffer can't be mistaken for the last one.
+    """
+    def __init__(self, size=2):
+        """Initialize
+        
+        :param size (int): Max number of frames kept
+        :inst self.entries (collections.OrderedDict): key -> dict of derived
+                                                      data, oldest first
+        :inst self.hits (int): lookups that found their frame
+        :inst self.misses (int): lookups that didn't
+        """
+        if size < 1:
+            raise ValueError('Frame cache needs room for at least one frame')
+        
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def getEntry(self, img, frame_id=None):
+        """Find the cache entry for a frame, adding an empty one (and evicting
+           the least recently used) if it isn't there
+        
+        :param img (numpy.array): Frame
+        :param frame_id: Unique id of the frame, if the caller has one
+        :return (tuple): entry (dict), and whether it was already cached
+        """
+        key = self.getKey(img, frame_id)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry, True
+        
+        self.misses += 1
+        entry = {}
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry, False
+    
+    def getKey(self, img, frame_id=None):
+        """Identify a frame
+        
+        :param img (numpy.array): Frame
+        :param frame_id: Unique id of the frame, if the caller has one
+        :return (tuple): key
+        """
+        if frame_id is not None:
+            return ('id', frame_id)
+        
+        return ('crc', img.shape, img.dtype.str,
+                zlib.crc32(np.ascontiguousarray(img)))
+    
+    def getStats(self):
+        """Report cache use
+        
+        :return stats (dict): hits, misses, frames cached and the bytes held
+                              in their arrays
+        """
+        nbytes = 0
+        for entry in self.entries.values():
+            for value in entry.values():
+                if isinstance(value, tuple): # (template serial, sigma, map)
+                    value = value[-1]
+                if isinstance(value, list): # Pyramid; level 0 is the image
+                    nbytes += sum(level.nbytes for level in value[1:])
+                elif isinstance(value, np.ndarray):
+                    nbytes += value.nbytes
+        
+        return {'hits': self.hits, 'misses': self.misses,
+                'frames': len(self.entries), 'bytes': nbytes}
+
+
+class TemplateModel:
+    """Appearance model of a tracked target. Instead of replacing the
+       template with every patch the tracker locks on to, patches are
+       blended into a running mean, with a running per-pixel variance, and
+       a patch is only blended in if it is close to the mean given that
+       variance, so one bad lock can't corrupt the template. On each lock, a
+       small bank of rescaled templates is tried first in case the target
+       changed size. The template only switches to one after it has matched
+       better on several locks in a row, so a lock a few pixels off (where
+       a smaller template often fits better) can't shrink a target that
+       never changed size. The bank is always resized from the original
+       target (and only then blurred, if the tracker blurs its templates),
+       so switching scales doesn't blur it a little more each time.
+    """
+    def __init__(self, template, alpha=0.1, gate=4., noise=10.,
+                 scales=(0.9, 1.1), min_size=8, base=None, prepare=None,
+                 confirm=3):
+        """Initialize
+        
+        :param template (numpy.array): initial template
+        :param alpha (float): Weight of each accepted patch, 0 to 1
+        :param gate (float): Max mean squared difference, in units of each
+                             pixel's variance, for a patch to be accepted
+        :param noise (float): Pixel noise, added to every pixel's standard
+                              deviation, so new and steady pixels aren't
+                              held to zero difference
+        :param scales (tuple): Relative sizes in the scale bank
+        :param min_size (int): Smallest template side the bank may hold
+        :param base (numpy.array): target the bank is resized from, before
+                                   any preprocessing (default: template)
+        :param prepare (function): preprocessing applied to each resized
+                                   bank template, e.g. Tracker.blur
+        :param confirm (int): Consecutive locks a bank template must match
+                              better on before the template switches to it
+        :inst self.base (numpy.array): target at scale 1
+        :inst self.template (numpy.array): current template, rounded from
+                                           the mean
+        :inst self.mean (numpy.array): running mean, float32
+        :inst self.var (numpy.array): running per-pixel variance, float32
+        :inst self.scale (float): size of the template relative to the
+                                  initial one
+        :inst self.bank (dict): relative scale -> prepared template resized
+                                from self.base, or None until built
+        :inst self.candidate (tuple): bank scale that matched better on the
+                                      last locks, and how many in a row
+        :inst self.counters (dict): updates accepted, rejected by the gate,
+                                    skipped at the image border, and
+                                    rescales
+        """
+        if not 0 < alpha <= 1:
+            raise ValueError('Template blending weight must be in (0, 1]')
+        if confirm < 1:
+            raise ValueError('Rescaling needs at least one confirming lock')
+        
+        self.alpha = alpha
+        self.gate = gate
+        self.noise = noise
+        self.scales = scales
+        self.min_size = min_size
+        self.base = base if base is not None else template
+        self.prepare = prepare
+        self.confirm = confirm
+        self.candidate = (None, 0)
+        self.template = template
+        self.mean = template.astype(np.float32)
+        self.var = np.zeros_like(self.mean)
+        self.scale = 1.
+        self.bank = None
+        self.counters = {'updates': 0, 'rejected': 0, 'border': 0,
+                         'rescaled': 0}
+    
+    def getBank(self):
+        """Templates at each of the scales relative to the current one,
+           resized from self.base and prepared, built once per rescale. The
+           bank also holds the base at the current scale (relative scale 1),
+           for comparing the others with on equal terms, as the running
+           mean may have drifted from the base in appearance.
+        
+        :return bank (dict): relative scale -> template, for 1 and each scale
+                             that leaves the template at least min_size
+                             pixels
+        """
+        if self.bank is not None:
+            return self.bank
+        
+        self.bank = {}
+        height, width = self.base.shape[:2]
+        for scale in (1.,) + tuple(self.scales):
+            size = (int(round(width * self.scale * scale)),
+                    int(round(height * self.scale * scale)))
+            if min(size) >= self.min_size:
+                template = cv2.resize(self.base, size,
+                                      interpolation=cv2.INTER_AREA)
+                if self.prepare is not None:
+                    template = self.prepare(template)
+                self.bank[scale] = template
+        return self.bank
+    
+    def getDistance(self, patch):
+        """Mean squared difference between a patch and the template, in
+           units of each pixel's variance
+        
+        :param patch (numpy.array): Image section of the template's shape
+        :return distance (float): 1 is a typical patch
+        """
+        diff = patch.astype(np.float32) - self.mean
+        return float(np.mean(diff * diff /
+                             (self.var + self.noise * self.noise)))
+    
+    def getStats(self):
+        """Report model counters
+        
+        :return stats (dict): counters and the current scale
+        """
+        stats = dict(self.counters)
+        stats['scale'] = self.scale
+        return stats
+    
+    def propose(self, scale):
+        """Count a lock's vote for a bank template, and switch to it once it
+           has matched better on confirm locks in a row
+        
+        :param scale (float): Key of the bank entry that matched better than
+                              the current template, or None if none did
+        :return template (numpy.array): new template, or None if the
+                                        template stays
+        """
+        if scale is None:
+            self.candidate = (None, 0)
+            return None
+        
+        wins = self.candidate[1] + 1 if self.candidate[0] == scale else 1
+        if wins < self.confirm:
+            self.candidate = (scale, wins)
+            return None
+        return self.rescale(scale)
+    
+    def rescale(self, scale):
+        """Switch to one of the bank's templates. The running mean restarts
+           from it, and the variance is resized along with it.
+        
+        :param scale (float): Key of the bank entry
+        :return template (numpy.array): new template
+        """
+        template = self.getBank()[scale]
+        size = (template.shape[1], template.shape[0])
+        self.mean = template.astype(np.float32)
+        self.var = cv2.resize(self.var, size, interpolation=cv2.INTER_AREA)
+        self.template = template
+        self.scale *= scale
+        self.bank = None
+        self.candidate = (None, 0)
+        self.counters['rescaled'] += 1
+        return template
+    
+    def update(self, patch):
+        """Blend a patch into the template, if it passes the gate
+        
+        :param patch (numpy.array): Image section at the target, of the
+                                    template's shape, or False if the target
+                                    is too close to the image border
+        :return (boolean): True if the template changed
+        """
+        if patch is False:
+            self.counters['border'] += 1
+            return False
+        if self.getDistance(patch) > self.gate:
+            self.counters['rejected'] += 1
+            return False
+        
+        # Exponentially weighted mean and variance
+        diff = patch.astype(np.float32) - self.mean
+        self.mean += self.alpha * diff
+        self.var += self.alpha * diff * diff
+        self.var *= 1. - self.alpha
+        self.template = np.rint(self.mean).astype(self.template.dtype)
+        self.counters['updates'] += 1
+        return True
 
 
 class Tracker:
     """Class for tracking a visual target using a particle filter.
     """
-    def __init__(self, target, img, num_particles=100):
+    # Quantile of the standard normal for the 99% confidence KLD-sampling
+    # bounds its error with
+    KLD_Z = 2.326
+    
+    def __init__(self, target, img, num_particles=100, weighting='sparse',
+                 resampling='systematic', rng=None, pyramid_levels=0,
+                 cache_size=2, cache=None, min_particles=None,
+                 kld_error=0.1, kld_bin=None, model=None, blurred=False):
         """Initialize
         
         :param target (numpy.array): template for target we're tracking
         :param img (numpy.array): first image for tracking
-        :param particles (int): number of particles to use
+        :param num_particles (int): number of particles to use, or the most
+                                    to use when min_particles is given
+        :param weighting (str): 'sparse' compares the target at each particle,
+                                'dense' compares it at every position in the
+                                image once per frame and looks particles up
+        :param resampling (str): resampling strategy (see Resampler)
+        :param rng (numpy.random.Generator): random source, or a seed for one
+        :param pyramid_levels (int): if > 0, re-acquire a lost target with a
+                                     coarse-to-fine search over this many
+                                     halvings of the image (see reacquire)
+        :param cache_size (int): frames kept in the preprocessing cache
+        :param cache (FrameCache): cache shared with other trackers (default:
+                                   a new one holding cache_size frames)
+        :param min_particles (int): if given, the particle count adapts
+                                    between this and num_particles, by
+                                    KLD-sampling (see getParticleCount)
+        :param kld_error (float): KLD-sampling error bound; smaller keeps
+                                  more particles
+        :param kld_bin (int): KLD-sampling bin size in pixels (default: half
+                              the template's smaller side)
+        :param model (function): makes the TemplateModel from the blurred
+                                 target, and the base and prepare keywords
+                                 (default: TemplateModel with its defaults)
+        :param blurred (bool): img has already been blurred (with blur)
         :inst self.target (numpy.array): target template
+        :inst self.model (TemplateModel): appearance model that updates
+                                          self.target on each lock
         :inst self.img (numpy.array): current image
-        :inst self.num_particles (int): number of particles to use
+        :inst self.num_particles (int): number of particles in use
+        :inst self.max_particles (int): size of the particle buffers
         :inst self.minrw (float): current minimum raw weight
         :inst self.maxrw (float): current maximum raw weight
-        :inst self.particles (list): initial set of filtered particles
-        :inst self.weights (list): particle weights (via self.track)
+        :inst self.particles (numpy.array): (N,2) array of filtered particles,
+                                            the first N of particle_buffer
+        :inst self.weights (numpy.array): particle weights (via self.track)
+        :inst self.spare (numpy.array): buffer the next particles are
+                                        resampled into, then swapped in
         :inst self.center (tuple): best guess of where target is in image
+        :inst self.weighting (str): particle weighting mode
+        :inst self.response (numpy.array): dense similarity map for self.img
+        :inst self.rng (numpy.random.Generator): random source
+        :inst self.resampler (Resampler): particle resampler
+        :inst self.pyramid (list): Gaussian pyramid of self.img, when built
+        :inst self.cache (FrameCache): data derived from recent frames
+        :inst self.frame (dict): cache entry of the current image
+        :inst self.template_serial (int): bumped whenever self.target changes
+        :inst self.response_key: key of this tracker's response map in cache
+                                 entries, which differs between trackers
+                                 sharing a cache
+        :inst self.weighed (dict): cache entry of the image self.weights were
+                                   computed on for the current particles and
+                                   target, or None
         """
-        self.target = cv2.GaussianBlur(target,(15,15),7)
-        self.img = cv2.GaussianBlur(img,(15,15),7)
+        if weighting not in ('sparse', 'dense'):
+            raise ValueError('Unknown weighting mode: %s' % weighting)
+        if min_particles is None:
+            min_particles = num_particles
+        if not 0 < min_particles <= num_particles:
+            raise ValueError('Need 0 < min_particles <= num_particles')
+        
+        self.target = self.blur(target)
+        self.model = (model or TemplateModel)(self.target, base=target,
+                                              prepare=self.blur)
+        self.img = img if blurred else self.blur(img)
         self.num_particles = num_particles
+        self.max_particles = num_particles
+        self.min_particles = min_particles
+        self.kld_error = kld_error
+        self.kld_bin = kld_bin
         self.minrw = 0.
         self.maxrw = 0.
+        self.weighting = weighting
+        self.response = None
+        self.response_sigma = None
+        self.rng = np.random.default_rng(rng)
+        self.resampler = Resampler(resampling, rng=self.rng)
+        self.pyramid_levels = pyramid_levels
+        self.pyramid = None
+        self.cache = cache if cache is not None else FrameCache(cache_size)
+        self.frame = None
+        self.template_serial = 0
+        self.response_key = 'response'
+        self.weighed = None
+        
+        # Particle state lives in preallocated buffers, sized for the most
+        # particles and reused every frame
+        self.particle_buffer = np.empty((self.max_particles,2), dtype=int)
+        self.spare = np.empty_like(self.particle_buffer)
+        self.weight_buffer = np.empty(self.max_particles)
+        self.setParticleCount(self.max_particles)
         
-        # Generate particles randomly
-        self.particles = self.genNewParticles(self.num_particles)
+        # Generate particles randomly (or around the likeliest spots)
+        self.resetParticles()
         self.center = None
     
+    @staticmethod
+    @Instrumentation.timed('vision.blur')
+    def blur(img, out=None):
+        """Blur an image the way the tracker expects its input
+        
+        :param img (np.array): Image
+        :param out (np.array): optional destination of the same shape
+        :return (np.array): Blurred image
+        """
+        return cv2.GaussianBlur(img, (15,15), 7, dst=out)
+    
+    def checkLock(self):
+        """Decide whether the particles have converged on the target, and if
+           so update self.center and the target template
+        
+        :return (boolean): True if locked on to the target
+        """
+        # If the particles are all within a 15x15 area, consider it a lock
+        pr_y, pr_x = self.getParticleSpread()
+        if pr_x < 1.5 * self.target.shape[0] and \
+           pr_y < 1.5 * self.target.shape[1]:
+            self.center = self.getParticleWeightedMean(self.particles,
+                                                       self.weights)
+            self.updateTemplate()
+            return True
+        
+        return False
+    
     def compareMSE(self, img1, img2, sigma=10.):
         """Calculate the similarity of two images using Mean Squared Error.
         
@@ -56,15 +543,163 @@ class Tracker:
         similarity = np.exp(-mse / (2 * (sigma ** 2)))
         return similarity
     
-    def genNewParticles(self, num_particles=100):
+    def compareMSEBatch(self, particles, sigma=10., out=None, targets=None,
+                        owners=None):
+        """Calculate the MSE similarity between the target and the image
+           section centered at each particle, for all particles at once.
+           Equivalent to calling compareMSE on getImageSection for each
+           particle, but the sections are gathered from a strided view of
+           the current image instead of being sliced one at a time.
+        
+        :param particles (numpy.array): (row,col) location of each particle
+        :param sigma (float): MSE weight
+        :param out (numpy.array): array to write the similarities to
+        :param targets (numpy.array): (K,height,width[,channels]) templates
+                                      to compare instead of self.target,
+                                      all of one shape
+        :param owners (numpy.array): index into targets of each particle's
+                                     template, grouped into runs
+        :return similarity (numpy.array): <=1.0 for each particle, 0.0 where
+                                          the section leaves the image
+        """
+        particles = np.asarray(particles, dtype=int).reshape(-1, 2)
+        if targets is None:
+            targets = self.target[None]
+            owners = None
+        shape = targets.shape[1:]
+        if self.img.shape[2:] != shape[2:]:
+            raise ValueError('Images must have the same number of channels')
+        
+        # Top left corner of each section, and which ones fit in the image
+        tops = particles[:,0] - shape[0] // 2
+        lefts = particles[:,1] - shape[1] // 2
+        valid = (tops >= 0) & (lefts >= 0) & \
+                (tops + shape[0] <= self.img.shape[0]) & \
+                (lefts + shape[1] <= self.img.shape[1])
+        similarity = np.zeros(len(particles)) if out is None else out
+        similarity[:] = 0.
+        valid = np.flatnonzero(valid)
+        if len(valid) == 0:
+            return similarity
+        
+        # windows[r,c] is the section whose top left corner is at (r,c)
+        windows = np.lib.stride_tricks.as_strided(
+            self.img,
+            shape=(self.img.shape[0] - shape[0] + 1,
+                   self.img.shape[1] - shape[1] + 1) + shape,
+            strides=self.img.strides[:2] + self.img.strides,
+            writeable=False)
+        targets = targets.astype('float')
+        
+        # Work through the particles in chunks small enough for the
+        # temporaries (2MB) to stay in cache
+        chunk = max(1, (1 << 18) // targets[0].size)
+        for start in range(0, len(valid), chunk):
+            index = valid[start:start+chunk]
+            sections = windows[tops[index], lefts[index]]
+            if owners is None:
+                diff = sections - targets[0]
+            else:
+                # Subtract each run of particles sharing a template
+                diff = np.empty(sections.shape)
+                owner = owners[index]
+                runs = np.flatnonzero(owner[1:] != owner[:-1]) + 1
+                for run in np.split(np.arange(len(index)), runs):
+                    np.subtract(sections[run[0]:run[-1]+1],
+                                targets[owner[run[0]]],
+                                out=diff[run[0]:run[-1]+1])
+            np.square(diff, out=diff)
+            mse = diff.reshape(len(index), -1).sum(axis=1)
+            mse /= float(shape[0] * shape[1])
+            similarity[index] = np.exp(-mse / (2 * (sigma ** 2)))
+        
+        return similarity
+    
+    def compareMSEDense(self, particles, sigma=10., out=None):
+        """Look up the MSE similarity for each particle in the dense response
+           map of the current image (see getResponseMap).
+        
+        :param particles (numpy.array): (row,col) location of each particle
+        :param sigma (float): MSE weight
+        :param out (numpy.array): array to write the similarities to
+        :return similarity (numpy.array): <=1.0 for each particle, 0.0 where
+                                          the section leaves the image
+        """
+        particles = np.asarray(particles, dtype=int).reshape(-1, 2)
+        response = self.getResponseMap(sigma)
+        tops = particles[:,0] - self.target.shape[0] // 2
+        lefts = particles[:,1] - self.target.shape[1] // 2
+        valid = (tops >= 0) & (lefts >= 0) & \
+                (tops < response.shape[0]) & (lefts < response.shape[1])
+        similarity = np.zeros(len(particles)) if out is None else out
+        similarity[:] = 0.
+        similarity[valid] = response[tops[valid], lefts[valid]]
+        return similarity
+    
+    def genNewParticles(self, num_particles=100, out=None):
         """Generate a new set particles
         
+        :param num_particles (int): Number of particles to generate
+        :param out (numpy.array): (N,2) int array to write the particles to
         :return (numpy.array): Array of new particles
         """
-        particles = np.random.rand(num_particles,2)
-        particles[:,0] *= self.img.shape[0]
-        particles[:,1] *= self.img.shape[1]
-        return particles.astype(int).tolist()
+        if out is None:
+            out = np.empty((num_particles,2), dtype=int)
+        
+        # Use the resampler's noise buffer as scratch space
+        if len(self.resampler.noise) < len(out):
+            self.resampler.noise = np.empty((len(out),2))
+        particles = self.resampler.noise[:len(out)]
+        self.rng.random(out=particles)
+        particles *= self.img.shape[:2]
+        np.copyto(out, particles, casting='unsafe')
+        return out
+    
+    def getParticleCount(self, indices):
+        """Choose how many particles to resample into (KLD-sampling): enough
+           that, with 99% confidence, the particles' distribution is within
+           kld_error of the weighted one, given how many bins it occupies.
+           A cloud collapsed on a lock occupies few bins and needs few
+           particles; a spread out one needs many.
+        
+        :param indices (numpy.array): parents drawn for the resampling (see
+                                      resampleOrReset)
+        :return num_particles (int): min_particles to max_particles
+        """
+        if self.min_particles == self.max_particles:
+            return self.max_particles
+        if self.maxrw < 0.1: # No good particles; search with all of them
+            return self.max_particles
+        
+        # Count the bins occupied by a resampling at the current size
+        size = self.kld_bin
+        if size is None:
+            size = max(1, min(self.target.shape[:2]) // 2)
+        indices = self.resampler.thin(indices, min(len(indices),
+                                                   self.num_particles))
+        bins = self.particles[indices] // size
+        k = len(np.unique(bins[:,0] * (self.img.shape[1] // size + 2) +
+                          bins[:,1]))
+        if k < 2:
+            return self.min_particles
+        
+        a = 2. / (9. * (k - 1))
+        n = (k - 1) / (2. * self.kld_error) * \
+            (1. - a + np.sqrt(a) * self.KLD_Z) ** 3
+        return int(min(self.max_particles, max(self.min_particles,
+                                               np.ceil(n))))
+    
+    def getParticleSpread(self, particles=None):
+        """Produce the extent of the particle cloud
+        
+        :param particles (numpy.array): Array of particle coordinates
+                                        (default: self.particles)
+        :return (numpy.array): (rows,cols) peak to peak range of the particles
+        """
+        if particles is None:
+            particles = self.particles
+        
+        return np.ptp(particles, axis=0)
     
     def getParticleWeightedMean(self, particles, weights):
         """Produce the weighted mean of particles
@@ -73,12 +708,7 @@ class Tracker:
         :param weights (numpy.array): Particle weights
         :return (tuple): Weighted mean
         """
-        u_weighted_mean = 0.
-        v_weighted_mean = 0.
-        for i in range(len(particles)):
-            u_weighted_mean += particles[i][0] * weights[i]
-            v_weighted_mean += particles[i][1] * weights[i]
-
+        u_weighted_mean, v_weighted_mean = np.dot(weights, particles)
         return (int(u_weighted_mean), int(v_weighted_mean))
     
     def getImageSection(self, center, shape):
@@ -104,94 +734,799 @@ class Tracker:
         
         return False
     
-    def normWeights(self, weights):
+    def getPyramid(self):
+        """Gaussian pyramid of the current image, built once per image. It
+           stops early once the target would shrink below 8 pixels or stop
+           fitting in the image.
+        
+        :return pyramid (list): self.img, then each level at half the size
+                                of the one before
+        """
+        if self.pyramid is not None:
+            return self.pyramid
+        
+        self.pyramid = [self.img]
+        t_h, t_w = self.target.shape[:2]
+        for level in range(1, self.pyramid_levels + 1):
+            t_h, t_w = (t_h + 1) // 2, (t_w + 1) // 2
+            img = self.pyramid[-1]
+            size = ((img.shape[0] + 1) // 2, (img.shape[1] + 1) // 2)
+            if min(t_h, t_w) < 8 or size[0] <= t_h or size[1] <= t_w:
+                break
+            self.pyramid.append(cv2.pyrDown(img))
+        
+        if self.frame is not None:
+            self.frame['pyramid'] = self.pyramid
+        return self.pyramid
+    
+    def getResponseMap(self, sigma=10.):
+        """Calculate the MSE similarity of the target at every position in the
+           current image. The map is computed once per image and target, so
+           its cost does not depend on the number of particles.
+        
+        :param sigma (float): MSE weight
+        :return response (numpy.array): similarity of the image section whose
+                                        top left corner is at each (row,col)
+        """
+        if self.response is not None and self.response_sigma == sigma:
+            return self.response
+        
+        img, target = self.img, self.target
+        if img.dtype != np.uint8 or target.dtype != np.uint8:
+            img = img.astype(np.float32)
+            target = target.astype(np.float32)
+        
+        # Sum of squared differences for every placement of the target.
+        # matchTemplate expands this into ||I||^2 from integral images, minus
+        # twice the cross-correlation with the target (DFT based for larger
+        # templates), plus the constant ||T||^2.
+        ssd = cv2.matchTemplate(img, target, cv2.TM_SQDIFF)
+        np.maximum(ssd, 0, out=ssd) # Rounding can push perfect matches < 0
+        mse = ssd.astype('float') / float(target.shape[0] * target.shape[1])
+        self.response = np.exp(-mse / (2 * (sigma ** 2)))
+        self.response_sigma = sigma
+        if self.frame is not None:
+            self.frame[self.response_key] = (self.template_serial, sigma,
+                                             self.response)
+        return self.response
+    
+    def matchScale(self, center, patch, threshold=0.1):
+        """Compare the scale bank's templates with the image at a position,
+           and vote for the one that matches clearly better than the current
+           template, and well enough to lock on to (see
+           TemplateModel.propose)
+        
+        :param center (tuple): (row,col) to compare at
+        :param patch (numpy.array): section at center of the current
+                                    template's shape, or False
+        :param threshold (float): Least similarity to switch to a template
+        :return (boolean): True if the template changed
+        """
+        if patch is False:
+            return False
+        
+        # A bank template has to beat both the current template and the
+        # base at the current size, or it only won on appearance
+        bank = self.model.getBank()
+        similarity = self.compareMSE(patch, self.target)
+        if 1. in bank and bank[1.].shape == patch.shape:
+            similarity = max(similarity, self.compareMSE(patch, bank[1.]))
+        best = None
+        best_similarity = max(threshold, 1.1 * similarity)
+        for scale, template in bank.items():
+            if scale == 1.:
+                continue
+            section = self.getImageSection(center, template.shape)
+            if section is False:
+                continue
+            similarity = self.compareMSE(section, template)
+            if similarity > best_similarity:
+                best, best_similarity = scale, similarity
+        
+        template = self.model.propose(best)
+        if template is None:
+            return False
+        self.setTarget(template)
+        return True
+    
+    def normWeights(self, weights, out=None):
         """Normalizes particle weights
         
         :param weights (numpy.array): Particle weights
+        :param out (numpy.array): array to write the normalized weights to
         :returns (numpy.array): Normalized weights
         """
-        if np.sum(weights) == 0: # None of the particles were valid?
-            return np.ones(len(weights)) / len(weights)
-        
-        return weights / np.sum(weights)
-    
-    def resample(self, particles, weights):
-        """Resample particles using a sampling wheel
-        Reference: https://www.youtube.com/watch?v=wNQVo6uOgYA
-        
-        :param particles (list): (row,col) locations of each particle
-        :param weights (list): weight of each particle
-        :return new_particles (list): resampled particles
-        """
-        new_particles = []
-        N = len(particles)
-        index = int(random.random() * N)
-        beta = 0.
-        mw = max(weights)
-        for i in range(N):
-            beta += random.random() * 2. * mw
-            while beta > weights[index]:
-                beta -= weights[index]
-                index = (index + 1) % N
-            
-            # Adding random noise to particles
-            x = particles[index][0] + random.randint(-10,10)
-            y = particles[index][1] + random.randint(-10,10)
-            new_particles.append([x,y])
+        if out is None:
+            out = np.empty(len(weights))
         
-        return new_particles
+        total = np.sum(weights)
+        if total == 0: # None of the particles were valid?
+            out[:] = 1. / len(weights)
+            return out
+        
+        return np.divide(weights, total, out=out)
     
-    def track(self, img):
-        """Guesses where our target is in the new image
+    def preprocess(self, img, blurred=False, frame_id=None):
+        """Blur a new image and make it the current one. If the image is
+           still in the cache, its blurred version and whatever else was
+           derived from it are reused.
         
         :param img (np.array): New image
-        :return (boolean): True if object found, otherwise false
+        :param blurred (bool): img has already been blurred (with blur)
+        :param frame_id: Unique id of the image (see FrameCache)
+        :return (boolean): True if the image was cached
+        """
+        entry, cached = self.cache.getEntry(img, frame_id)
+        if not cached:
+            entry['img'] = img if blurred else self.blur(img)
+        
+        self.setFrame(entry)
+        return cached
+    
+    @Instrumentation.timed('vision.resample')
+    def resample(self, particles, weights, out=None, indices=None):
+        """Resample particles (see Resampler)
+        
+        :param particles (numpy.array): (row,col) locations of each particle
+        :param weights (numpy.array): weight of each particle
+        :param out (numpy.array): array to write the new particles to
+        :param indices (numpy.array): parents already drawn, if any
+        :return new_particles (numpy.array): resampled particles
+        """
+        return self.resampler.resample(particles, weights, out=out,
+                                       indices=indices)
+    
+    @Instrumentation.timed('vision.reacquire')
+    def reacquire(self, candidates=4, radius=2, sigma=10., explore=0.2):
+        """Search the whole image for the target coarse-to-fine, and put the
+           particles around the best candidates. The template is compared at
+           every position of the coarsest pyramid level only; each finer
+           level just refines the candidates within `radius` pixels.
+        
+        :param candidates (int): Number of hypotheses to keep
+        :param radius (int): Refinement search radius at each finer level
+        :param sigma (float): MSE weight, for sharing particles by similarity
+        :param explore (float): Fraction of particles still scattered randomly
+        :return centers (numpy.array): (K,2) candidate centers, best first
+        """
+        pyramid = self.getPyramid()
+        targets = [self.target]
+        for img in pyramid[1:]:
+            # A shared pyramid may have been built for a larger target
+            t_h = (targets[-1].shape[0] + 1) // 2
+            t_w = (targets[-1].shape[1] + 1) // 2
+            if min(t_h, t_w) < 8 or img.shape[0] <= t_h or \
+               img.shape[1] <= t_w:
+                break
+            targets.append(cv2.pyrDown(targets[-1]))
+        pyramid = pyramid[:len(targets)]
+        
+        # Global search at the coarsest level, keeping the best few minima
+        # at least half a template apart
+        level = len(pyramid) - 1
+        ssd = cv2.matchTemplate(pyramid[level], targets[level],
+                                cv2.TM_SQDIFF)
+        t_h, t_w = targets[level].shape[:2]
+        positions = []
+        for _ in range(candidates):
+            row, col = np.unravel_index(np.argmin(ssd), ssd.shape)
+            if not np.isfinite(ssd[row,col]):
+                break
+            positions.append((row, col))
+            ssd[max(0, row - t_h // 2):row + t_h // 2 + 1,
+                max(0, col - t_w // 2):col + t_w // 2 + 1] = np.inf
+        
+        # Refine each candidate down the pyramid
+        scores = np.zeros(len(positions))
+        for level in range(level, -1, -1):
+            img, target = pyramid[level], targets[level]
+            t_h, t_w = target.shape[:2]
+            max_top = img.shape[0] - t_h
+            max_left = img.shape[1] - t_w
+            for i, (row, col) in enumerate(positions):
+                if level < len(pyramid) - 1:
+                    row, col = 2 * row, 2 * col
+                top = min(max(row - radius, 0), max_top)
+                left = min(max(col - radius, 0), max_left)
+                bottom = min(row + radius, max_top) + t_h
+                right = min(col + radius, max_left) + t_w
+                window = cv2.matchTemplate(img[top:bottom,left:right],
+                                           target, cv2.TM_SQDIFF)
+                r, c = np.unravel_index(np.argmin(window), window.shape)
+                positions[i] = (top + r, left + c)
+                scores[i] = max(window[r,c], 0)
+        
+        t_h, t_w = self.target.shape[:2]
+        centers = np.array(positions, dtype=int).reshape(-1, 2) + \
+                  (t_h // 2, t_w // 2)
+        order = np.argsort(scores)
+        centers, scores = centers[order], scores[order]
+        
+        # Share the particles among the candidates by similarity, jittered
+        # within a quarter template, and scatter the rest
+        self.setParticleCount(self.max_particles)
+        self.genNewParticles(self.num_particles, out=self.particles)
+        num_seeded = int(round(self.num_particles * (1. - explore)))
+        if len(centers) and num_seeded:
+            similarity = np.exp(-scores / (t_h * t_w * 2. * sigma ** 2))
+            if similarity.sum() > 0:
+                similarity /= similarity.sum()
+            else:
+                similarity[:] = 1. / len(similarity)
+            owners = self.rng.choice(len(centers), num_seeded, p=similarity)
+            spread = (max(1, t_h // 4), max(1, t_w // 4))
+            jitter = self.rng.integers(-np.array(spread), np.array(spread) + 1,
+                                       size=(num_seeded, 2))
+            self.particles[:num_seeded] = centers[owners] + jitter
+        
+        self.weights[:] = 1. / self.num_particles
+        self.weighed = None
+        return centers
+    
+    def resampleOrReset(self):
+        """Act on the weights of the current particles: if none of them are
+           close, start over, and otherwise resample them (into the spare
+           buffer, then swap), as many as getParticleCount asks for. One
+           draw of parents serves both for counting and for resampling.
+        
+        :return (boolean): True if the particles were resampled and need
+                           weighing again
         """
-        self.img = cv2.GaussianBlur(img,(15,15),7)
-        self.weights = self.weigh_particles()
-
         if self.maxrw < 0.01: # Nothing close. Get new particles and try again
             self.center = None
-            self.particles = self.genNewParticles(self.num_particles)
+            self.resetParticles()
+            return False
+        
+        indices = self.resampler.getIndices(self.weights, self.max_particles)
+        num_particles = self.getParticleCount(indices)
+        self.resample(self.particles, self.weights,
+                      out=self.spare[:num_particles],
+                      indices=self.resampler.thin(indices, num_particles))
+        self.spare, self.particle_buffer = self.particle_buffer, self.spare
+        self.setParticleCount(num_particles)
+        return True
+    
+    def resetParticles(self):
+        """Scatter the particles randomly over the image again, reusing the
+           particle buffer. With a pyramid, they are put around the likeliest
+           spots instead (see reacquire).
+        """
+        if self.pyramid_levels > 0:
+            self.reacquire()
+            return
+        
+        self.setParticleCount(self.max_particles)
+        self.genNewParticles(self.num_particles, out=self.particles)
+        self.weights[:] = 1. / self.num_particles
+        self.weighed = None
+    
+    def setFrame(self, entry):
+        """Make a preprocessed frame the current image
+        
+        :param entry (dict): FrameCache entry holding the blurred image
+        """
+        self.frame = entry
+        self.img = entry['img']
+        self.pyramid = entry.get('pyramid')
+        self.response = None
+        response = entry.get(self.response_key)
+        if response is not None and response[0] == self.template_serial:
+            self.response_sigma, self.response = response[1:]
+    
+    def setParticleCount(self, num_particles):
+        """Use the first num_particles of the particle and weight buffers.
+           The weights need setting afterwards.
+        
+        :param num_particles (int): 1 to max_particles
+        """
+        self.num_particles = num_particles
+        self.particles = self.particle_buffer[:num_particles]
+        self.weights = self.weight_buffer[:num_particles]
+    
+    def setTarget(self, target):
+        """Replace the target template, invalidating whatever was computed
+           with the old one
+        
+        :param target (numpy.array): New template
+        """
+        self.target = target
+        self.template_serial += 1
+        self.response = None
+        self.weighed = None
+    
+    @Instrumentation.timed('vision.track')
+    def track(self, img, blurred=False, frame_id=None):
+        """Guesses where our target is in the new image
+        
+        :param img (np.array): New image
+        :param blurred (bool): img has already been blurred (with blur), e.g.
+                               by another process
+        :param frame_id: Unique id of the image, e.g. its camera sequence
+                         number (see FrameCache)
+        :return (boolean): True if object found, otherwise false
+        """
+        self.preprocess(img, blurred, frame_id)
+        
+        # The weights left by the last call still hold if it was on the same
+        # image with the same particles and target
+        if self.weighed is not self.frame:
+            self.weights = self.weigh_particles()
+        
+        if not self.resampleOrReset():
             return False
         
-        # Resample and reweight
-        self.particles = self.resample(self.particles, self.weights)
         self.weights = self.weigh_particles()
+        return self.updateLock()
+    
+    def updateLock(self):
+        """Act on the weights of the resampled particles
+        
+        :return (boolean): True if locked on to the target
+        """
         if self.maxrw < 0.1: # Close but still no good particles
             self.center = None
+            Instrumentation.count('vision.lock_miss')
             return False
         
-        # If the particles are all within a 15x15 area, consider it a lock
-        pr_x = np.ptp(np.array(self.particles)[:,1])
-        pr_y = np.ptp(np.array(self.particles)[:,0])
-        if pr_x < 1.5 * self.target.shape[0] and \
-           pr_y < 1.5 * self.target.shape[1]:
-            self.center = self.getParticleWeightedMean(self.particles,
-                                                       self.weights)
-            self.target = self.getImageSection(self.center, self.target.shape)
+        if self.checkLock():
+            Instrumentation.count('vision.lock')
             return True
         
-        #TODO: Update self.target in a way that accounts for size changes
-        #      in the target. Should we blend the new self.target above with
-        #      the old one to do this? How would that degrade over time?
+        Instrumentation.count('vision.lock_miss')
         return False
     
-    def weigh_particles(self):
-        """Produces a list of particle weights
+    def updateTemplate(self):
+        """Switch to a template of the scale bank if the target at
+           self.center has changed size, and otherwise fold the image section
+           there into the template model
         
-        :return weights (list): weight of each particle
+        :return (boolean): True if the template changed
         """
-        weights = []
-        for i in range(len(self.particles)):
-            p_frame = self.getImageSection(self.particles[i], 
-                                           self.target.shape)
-            if type(p_frame) == np.ndarray:
-                similarity = self.compareMSE(p_frame, self.target)
-                weights.append(similarity)
-            else:
-                weights.append(0.)
+        patch = self.getImageSection(self.center, self.target.shape)
+        if self.matchScale(self.center, patch):
+            return True
+        if self.model.update(patch):
+            self.setTarget(self.model.template)
+            return True
         
+        return False
+    
+    @Instrumentation.timed('vision.weigh')
+    def weigh_particles(self, similarity=None):
+        """Produces a list of particle weights
+        
+        :param similarity (numpy.array): raw weights of the particles when
+                                         they were already computed, e.g. in
+                                         a batch with other trackers
+        :return weights (numpy.array): weight of each particle
+        """
+        if similarity is not None:
+            weights = self.weights
+            weights[:] = similarity
+        elif self.weighting == 'dense':
+            weights = self.compareMSEDense(self.particles, out=self.weights)
+        else:
+            weights = self.compareMSEBatch(self.particles, out=self.weights)
         self.minrw = np.min(weights)
         self.maxrw = np.max(weights)
-        return self.normWeights(weights)
+        self.weighed = self.frame
+        return self.normWeights(weights, out=weights)
+
+
+class MultiTracker:
+    """Tracks several targets in the same frames. Every target keeps its own
+       Tracker and particles, but each frame is blurred (and its pyramid
+       built) once for all of them, and the particles of all targets with
+       templates of the same shape are weighed together in one batch, so
+       another target costs about what its particles do.
+    """
+    def __init__(self, targets, img, num_particles=100, weighting='sparse',
+                 resampling='systematic', rng=None, pyramid_levels=0,
+                 cache_size=2, min_particles=None):
+        """Initialize
+        
+        :param targets (list): templates of the targets to track
+        :param img (numpy.array): first image for tracking
+        :param num_particles (int): number of particles per target (the
+                                    most, when min_particles is given)
+        :param weighting (str): particle weighting mode (see Tracker). With
+                                'dense', each target still needs a response
+                                map of its own per frame.
+        :param resampling (str): resampling strategy (see Resampler)
+        :param rng (numpy.random.Generator): random source, or a seed for one
+        :param pyramid_levels (int): pyramid levels for re-acquiring lost
+                                     targets (see Tracker.reacquire)
+        :param cache_size (int): frames kept in the shared cache
+        :param min_particles (int): if given, each target's particle count
+                                    adapts down to this (see Tracker)
+        :inst self.trackers (list): Tracker of each target
+        :inst self.cache (FrameCache): preprocessed frames, shared by all the
+                                       trackers
+        :inst self.locked (list): whether each target was locked on to in
+                                  the last frame
+        :inst self.centers (list): best guess of each target's center, or
+                                   None
+        """
+        if len(targets) == 0:
+            raise ValueError('MultiTracker needs at least one target')
+        
+        self.weighting = weighting
+        self.rng = np.random.default_rng(rng)
+        self.cache = FrameCache(cache_size)
+        self.trackers = []
+        for i, target in enumerate(targets):
+            tracker = Tracker(target, img, num_particles, weighting,
+                              resampling, self.rng, pyramid_levels,
+                              cache=self.cache, min_particles=min_particles)
+            tracker.response_key = ('response', i)
+            self.trackers.append(tracker)
+        self.locked = [False] * len(self.trackers)
+        self.centers = [None] * len(self.trackers)
+    
+    def __len__(self):
+        return len(self.trackers)
+    
+    def preprocess(self, img, blurred=False, frame_id=None):
+        """Blur a new image once and make it every tracker's current one
+        
+        :param img (np.array): New image
+        :param blurred (bool): img has already been blurred (with
+                               Tracker.blur)
+        :param frame_id: Unique id of the image (see FrameCache)
+        :return (boolean): True if the image was cached
+        """
+        entry, cached = self.cache.getEntry(img, frame_id)
+        if not cached:
+            entry['img'] = img if blurred else Tracker.blur(img)
+        
+        for tracker in self.trackers:
+            tracker.setFrame(entry)
+        return cached
+    
+    @Instrumentation.timed('vision.multi_track')
+    def track(self, img, blurred=False, frame_id=None):
+        """Guesses where each target is in the new image. Same steps as
+           Tracker.track, with the weighing of every step batched.
+        
+        :param img (np.array): New image
+        :param blurred (bool): img has already been blurred (with
+                               Tracker.blur)
+        :param frame_id: Unique id of the image (see FrameCache)
+        :return locked (list): True for each target found
+        """
+        self.preprocess(img, blurred, frame_id)
+        self.weigh([t for t in self.trackers if t.weighed is not t.frame])
+        
+        resampled = [t for t in self.trackers if t.resampleOrReset()]
+        self.weigh(resampled)
+        self.locked = [t in resampled and t.updateLock()
+                       for t in self.trackers]
+        self.centers = [t.center for t in self.trackers]
+        return list(self.locked)
+    
+    def weigh(self, trackers):
+        """Weigh the particles of some trackers. In sparse mode, the particles
+           of all trackers whose templates have the same shape are compared in
+           one batch.
+        
+        :param trackers (list): Trackers sharing the current frame
+        """
+        if self.weighting == 'dense':
+            for tracker in trackers:
+                tracker.weights = tracker.weigh_particles()
+            return
+        
+        groups = collections.defaultdict(list)
+        for tracker in trackers:
+            groups[tracker.target.shape].append(tracker)
+        
+        for group in groups.values():
+            particles = np.concatenate([t.particles for t in group])
+            targets = np.stack([t.target for t in group])
+            owners = np.repeat(np.arange(len(group)),
+                               [len(t.particles) for t in group])
+            similarity = group[0].compareMSEBatch(particles, targets=targets,
+                                                  owners=owners)
+            start = 0
+            for tracker in group:
+                end = start + len(tracker.particles)
+                tracker.weights = tracker.weigh_particles(
+                    similarity[start:end])
+                start = end
+
+
+class MotionDetector:
+    """Detects changes in a stream of frames. Each frame is shrunk to a small
+       grayscale (or edge) image and compared with a running average of the
+       previous ones, and the changed pixels are summed per block of a grid,
+       so the changed regions can be reported as well as the overall amount.
+    """
+    def __init__(self, scale=4, alpha=0.05, threshold=25, grid=(6, 8),
+                 block_threshold=0.05, edges=False):
+        """Initialize
+        
+        :param scale (int): Downsampling factor applied to each frame
+        :param alpha (float): Background learning rate, 0 to 1
+        :param threshold (int): Min change in a downsampled pixel to count
+        :param grid (tuple): (rows,cols) of the block grid
+        :param block_threshold (float): Fraction of a block's pixels that
+                                        must change for it to count as moving
+        :param edges (bool): compare Canny edges rather than intensities,
+                             which ignores gradual lighting changes
+        :inst self.background (numpy.array): running average, float32
+        :inst self.changed (float): fraction of pixels changed in the last
+                                    frame
+        :inst self.blocks (numpy.array): fraction changed in each grid block
+        :inst self.regions (list): (x,y,width,height) of each group of
+                                   adjacent moving blocks, in frame pixels
+        """
+        self.scale = scale
+        self.alpha = alpha
+        self.threshold = threshold
+        self.grid = grid
+        self.block_threshold = block_threshold
+        self.edges = edges
+        self.background = None
+        self.changed = 0.
+        self.blocks = np.zeros(grid)
+        self.regions = []
+        self.frame_size = None
+        self.gray = None
+        self.small = None
+        self.diff = None
+        self.mask = None
+    
+    @Instrumentation.timed('vision.motion')
+    def detect(self, img):
+        """Compare a frame with the background, then fold it in
+        
+        :param img (numpy.array): BGR or grayscale frame
+        :return (boolean): True if any block changed
+        """
+        feature = self.getFeature(img)
+        if self.background is None:
+            self.background = feature.astype(np.float32)
+            return False
+        
+        # Changed pixels, counted without building index arrays
+        cv2.absdiff(feature, cv2.convertScaleAbs(self.background),
+                    dst=self.diff)
+        cv2.threshold(self.diff, self.threshold, 1, cv2.THRESH_BINARY,
+                      dst=self.mask)
+        self.changed = cv2.countNonZero(self.mask) / float(self.mask.size)
+        
+        # Area interpolation averages the mask over each block
+        rows, cols = self.grid
+        self.blocks = cv2.resize(self.mask.astype(np.float32), (cols, rows),
+                                 interpolation=cv2.INTER_AREA)
+        self.regions = self.getRegions()
+        
+        cv2.accumulateWeighted(feature, self.background, self.alpha)
+        return len(self.regions) > 0
+    
+    def getFeature(self, img):
+        """Shrink a frame to the image compared with the background
+        
+        :param img (numpy.array): BGR or grayscale frame
+        :return (numpy.array): downsampled grayscale (or edge) image
+        """
+        height, width = img.shape[:2]
+        size = (max(1, width // self.scale), max(1, height // self.scale))
+        if self.frame_size != (width, height):
+            self.frame_size = (width, height)
+            self.small = np.empty(size[::-1], dtype=np.uint8)
+            self.diff = np.empty_like(self.small)
+            self.mask = np.empty_like(self.small)
+            self.background = None
+        
+        gray = img
+        if img.ndim == 3:
+            self.gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+            gray = self.gray
+        cv2.resize(gray, size, dst=self.small, interpolation=cv2.INTER_AREA)
+        if self.edges:
+            return cv2.Canny(self.small, 50, 150)
+        
+        return self.small
+    
+    def getRegions(self):
+        """Group adjacent moving blocks
+        
+        :return regions (list): (x,y,width,height) of each group, in frame
+                                pixels
+        """
+        moving = (self.blocks >= self.block_threshold).astype(np.uint8)
+        if not moving.any():
+            return []
+        
+        count, labels, stats, centroids = \
+            cv2.connectedComponentsWithStats(moving, connectivity=8)
+        rows, cols = self.grid
+        block_h = self.frame_size[1] / float(rows)
+        block_w = self.frame_size[0] / float(cols)
+        regions = []
+        for x, y, w, h, area in stats[1:]:
+            regions.append((int(x * block_w), int(y * block_h),
+                            int(round(w * block_w)), int(round(h * block_h))))
+        
+        return regions
+
+
+class Panorama:
+    """Stitches frames into a cylindrical panorama as they arrive. Each frame
+       is warped onto the cylinder, where turning in place is a pure shift,
+       and the shift from the previous frame is measured by matching ORB
+       features against that frame only, taking the known turn angle as a
+       prior. Only the mosaic and the previous frame's features are kept.
+    """
+    def __init__(self, angle, frame_size, fov=0.93, features=500,
+                 tolerance=0.15, min_matches=10):
+        """Initialize
+        
+        :param angle (float): Width of the panorama in radians, up to 2*pi
+                              (which wraps around)
+        :param frame_size (tuple): (width,height) of the frames
+        :param fov (float): Horizontal field of view of the camera, radians
+        :param features (int): Max ORB features per frame
+        :param tolerance (float): Max disagreement (radians) between a
+                                  feature match and the turn prior
+        :param min_matches (int): Matches needed to trust the measured shift
+        :inst self.focal (float): focal length in pixels
+        :inst self.mosaic (numpy.array): BGR mosaic
+        :inst self.weight (numpy.array): blending weight at each mosaic pixel
+        :inst self.position (numpy.array): (col,row) of the last frame in the
+                                           mosaic, or None before the first
+        :inst self.counters (dict): frames added, and how many were placed by
+                                    feature matches rather than the prior
+        """
+        width, height = frame_size
+        self.focal = (width / 2.) / np.tan(fov / 2.)
+        self.wrap = angle >= 2 * np.pi - 1e-6
+        self.tolerance = tolerance
+        self.min_matches = min_matches
+        self.orb = cv2.ORB_create(features, fastThreshold=10)
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self.makeWarp(frame_size)
+        
+        # Room for the sweep, plus a margin for drift either way
+        warped_h, warped_w = self.warp_mask.shape
+        self.margin = (warped_h // 10, warped_w // 4)
+        if self.wrap:
+            mosaic_w = int(round(2 * np.pi * self.focal))
+        else:
+            mosaic_w = int(round(angle * self.focal)) + warped_w + \
+                       2 * self.margin[1]
+        mosaic_h = warped_h + 2 * self.margin[0]
+        self.mosaic = np.zeros((mosaic_h, mosaic_w, 3), dtype=np.uint8)
+        self.weight = np.zeros((mosaic_h, mosaic_w), dtype=np.float32)
+        self.position = None
+        self.previous = None
+        self.counters = {'frames': 0, 'matched': 0}
+    
+    def add(self, img, turn=0.):
+        """Stitch a frame into the mosaic
+        
+        :param img (numpy.array): BGR frame
+        :param turn (float): How far the rover turned since the previous
+                             frame, in radians (positive to the right)
+        :return (boolean): True if the shift was measured from features,
+                           False if it fell back on the prior
+        """
+        warped = cv2.remap(img, self.map_x, self.map_y, cv2.INTER_LINEAR)
+        gray = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
+        keypoints, descriptors = self.orb.detectAndCompute(gray,
+                                                           self.warp_inner)
+        points = np.float32([k.pt for k in keypoints]).reshape(-1, 2)
+        
+        matched = False
+        if self.position is None:
+            self.position = np.array([self.margin[1], self.margin[0]], float)
+        else:
+            shift = self.measureShift(points, descriptors, turn)
+            matched = shift is not None
+            if shift is None:
+                shift = (turn * self.focal, 0.)
+            self.position += shift
+            
+            # Keep vertical drift within the margin
+            self.position[1] = np.clip(self.position[1], 0,
+                                       2 * self.margin[0])
+        
+        self.blend(warped)
+        self.previous = (points, descriptors)
+        self.counters['frames'] += 1
+        self.counters['matched'] += int(matched)
+        return matched
+    
+    def blend(self, warped):
+        """Feather a warped frame into the mosaic at self.position, weighting
+           each pixel by its distance from the frame's edge
+        
+        :param warped (numpy.array): Frame on the cylinder
+        """
+        h, w = warped.shape[:2]
+        col, row = int(round(self.position[0])), int(round(self.position[1]))
+        cols = np.arange(col, col + w)
+        weight = self.warp_weight
+        if self.wrap:
+            cols %= self.mosaic.shape[1]
+        else:
+            keep = (cols >= 0) & (cols < self.mosaic.shape[1])
+            warped, weight, cols = warped[:,keep], weight[:,keep], cols[keep]
+        
+        old = self.mosaic[row:row+h,cols].astype(np.float32)
+        old_weight = self.weight[row:row+h,cols]
+        total = old_weight + weight
+        new = (old * old_weight[...,None] + warped * weight[...,None]) / \
+              np.maximum(total, 1e-6)[...,None]
+        self.mosaic[row:row+h,cols] = new.astype(np.uint8)
+        self.weight[row:row+h,cols] = total
+    
+    def getImage(self):
+        """Crop the mosaic to the part covered by frames
+        
+        :return (numpy.array): BGR panorama
+        """
+        covered = self.weight > 0
+        rows = np.flatnonzero(covered.any(axis=1))
+        cols = np.flatnonzero(covered.any(axis=0))
+        if len(rows) == 0:
+            return self.mosaic[:0,:0]
+        
+        return self.mosaic[rows[0]:rows[-1]+1,cols[0]:cols[-1]+1]
+    
+    def makeWarp(self, frame_size):
+        """Precompute the remap tables projecting a frame onto the cylinder,
+           and the blending weights of the warped frame
+        
+        :param frame_size (tuple): (width,height) of the frames
+        """
+        width, height = frame_size
+        f = self.focal
+        cx, cy = (width - 1) / 2., (height - 1) / 2.
+        half_w = int(f * np.arctan(cx / f))
+        theta = np.arange(-half_w, half_w + 1) / f
+        y = np.arange(height) - cy
+        self.map_x = (f * np.tan(theta) + cx).astype(np.float32)
+        self.map_x = np.repeat(self.map_x[None], height, axis=0)
+        self.map_y = (y[:,None] / np.cos(theta)[None] + cy).astype(np.float32)
+        
+        inside = (self.map_y >= 0) & (self.map_y <= height - 1)
+        self.warp_mask = inside
+        self.warp_inner = cv2.erode(inside.astype(np.uint8) * 255,
+                                    np.ones((9,9), np.uint8))
+        
+        # Feather weight: distance to the nearest edge of the warped frame
+        distance = cv2.distanceTransform(
+            cv2.copyMakeBorder(inside.astype(np.uint8), 1, 1, 1, 1,
+                               cv2.BORDER_CONSTANT, value=0),
+            cv2.DIST_L2, 3)[1:-1,1:-1]
+        self.warp_weight = distance.astype(np.float32)
+    
+    def measureShift(self, points, descriptors, turn):
+        """Measure how far the scene moved since the previous frame
+        
+        :param points (numpy.array): (N,2) keypoints of the new frame
+        :param descriptors (numpy.array): their ORB descriptors
+        :param turn (float): turn since the previous frame, radians
+        :return (tuple): (cols,rows) the frame moved in the mosaic, or None if
+                         too few matches agree with the prior
+        """
+        prev_points, prev_descriptors = self.previous
+        if descriptors is None or prev_descriptors is None:
+            return None
+        
+        matches = self.matcher.match(prev_descriptors, descriptors)
+        if len(matches) < self.min_matches:
+            return None
+        
+        prev_idx = np.array([m.queryIdx for m in matches])
+        idx = np.array([m.trainIdx for m in matches])
+        shifts = prev_points[prev_idx] - points[idx]
+        prior = turn * self.focal
+        agree = np.abs(shifts[:,0] - prior) < self.tolerance * self.focal
+        agree &= np.abs(shifts[:,1]) < self.margin[0]
+        if np.count_nonzero(agree) < self.min_matches:
+            return None
+        
+        return tuple(np.median(shifts[agree], axis=0))
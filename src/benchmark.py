@@ -0,0 +1,481 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Tracking benchmark
+#
+# Replays frame sequences with known target positions through
+# Vision.Tracker and reports speed, per-stage timings, memory and accuracy
+# as JSON. Example:
+#
+#   python benchmark.py --particles 100,250,1000 --res 370x240,740x480 \
+#                       --output before.json
+#   python benchmark.py --compare before.json after.json
+#
+# Recorded segments (see Recording) can be replayed too, given the target:
+#
+#   python benchmark.py --sequences 1700000000000.bseg --target target.jpg
+#
+# The cost of a span (see Instrumentation) is always measured; --overhead
+# also runs every operating point with instrumentation on and off.
+#
+from Recording import EXTENSION, SegmentReader
+from Simulation import PHOTOS, SimCamera, World
+from Vision import *
+import Instrumentation
+import argparse
+import cv2
+import glob
+import itertools
+import json
+import numpy as np
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+STAGES = {'preprocess': 'preprocess', 'weigh': 'weigh_particles',
+          'resample': 'resample', 'lock': 'checkLock'}
+
+def photoSequence(path, num_frames=60, res=(740, 480), target_size=64):
+    """Pan a window over a photo so a fixed patch of it moves around the frame
+    
+    :param path (str): Photo file
+    :param num_frames (int): Sequence length
+    :param res (tuple): (width,height) of the frames
+    :param target_size (int): Width and height of the target patch
+    :return (generator): (frame, (row,col) of the target center) tuples
+    """
+    photo = cv2.imread(path)
+    if photo is None:
+        raise IOError('Could not load %s' % path)
+    
+    width, height = res
+    if photo.shape[0] < height or photo.shape[1] < width:
+        photo = cv2.resize(photo, (max(width, photo.shape[1]),
+                                   max(height, photo.shape[0])))
+    
+    # The target is the patch at the middle of the photo. The window origin
+    # swings around the position that centers it, staying inside the photo.
+    center = (photo.shape[0] // 2, photo.shape[1] // 2)
+    origin = (center[0] - height // 2, center[1] - width // 2)
+    margin = target_size // 2
+    amplitude = (max(0, min(origin[0], height // 2 - margin)) * 0.8,
+                 max(0, min(origin[1], width // 2 - margin)) * 0.8)
+    for k in range(num_frames):
+        top = int(origin[0] + amplitude[0] * np.sin(2 * np.pi * k / 45.))
+        left = int(origin[1] + amplitude[1] * np.sin(2 * np.pi * k / 60.))
+        frame = photo[top:top+height,left:left+width]
+        yield frame, (center[0] - top, center[1] - left)
+
+def simSequence(num_frames=60, res=(740, 480)):
+    """Frames from the simulated camera with a stationary rover
+    
+    :param num_frames (int): Sequence length
+    :param res (tuple): (width,height) of the frames
+    :return (generator): (frame, (row,col) of the target center) tuples
+    """
+    camera = SimCamera(world=World())
+    camera.resolution = res
+    for k in range(num_frames):
+        frame = camera.render()
+        camera.index += 1
+        yield frame, camera.truth
+
+def segmentSequence(path, num_frames=60):
+    """Frames recorded in a segment file, without known target positions
+    
+    :param path (str): Segment file
+    :param num_frames (int): Max sequence length
+    :return (generator): (frame, None) tuples
+    """
+    reader = SegmentReader(path)
+    for k, (seq, timestamp, frame) in enumerate(reader.frames()):
+        if k == num_frames:
+            break
+        yield frame, None
+    reader.close()
+
+def loadSequence(name, num_frames, res, target=None):
+    """Materialize a named sequence at the given resolution
+    
+    :param name (str): 'sim', the path of a photo, or of a segment file
+    :param num_frames (int): Sequence length
+    :param res (tuple): (width,height) of the frames
+    :param target (numpy.array): Target template, at the sequence's own
+                                 resolution (default: cropped out of the
+                                 first frame, which needs a known position)
+    :return (tuple): list of frames, list of target centers, target template
+    """
+    if name.endswith(EXTENSION):
+        source = segmentSequence(name, num_frames)
+        first, truth = next(source)
+        base = first.shape[1::-1]
+        source = itertools.chain([(first, truth)], source)
+        size = 64
+    elif name == 'sim':
+        base = (740, 480)
+        source = simSequence(num_frames, base)
+        size = 48
+    else:
+        base = (740, 480)
+        source = photoSequence(name, num_frames, base)
+        size = 64
+    
+    scale = (res[0] / float(base[0]), res[1] / float(base[1]))
+    frames, truths = [], []
+    for frame, truth in source:
+        frames.append(cv2.resize(frame, res, interpolation=cv2.INTER_AREA))
+        if truth is not None:
+            truth = (truth[0] * scale[1], truth[1] * scale[0])
+        truths.append(truth)
+    
+    if target is not None:
+        target = cv2.resize(target, (max(4, int(round(target.shape[1] *
+                                                      scale[0]))),
+                                     max(4, int(round(target.shape[0] *
+                                                      scale[1])))),
+                            interpolation=cv2.INTER_AREA)
+        return frames, truths, target
+    
+    if truths[0] is None:
+        raise ValueError('%s has no known target position; give a target '
+                         'image' % name)
+    
+    # Crop the target template out of the first frame
+    row, col = truths[0]
+    h = max(4, int(round(size * scale[1])))
+    w = max(4, int(round(size * scale[0])))
+    top, left = int(round(row)) - h // 2, int(round(col)) - w // 2
+    target = frames[0][top:top+h,left:left+w].copy()
+    return frames, truths, target
+
+def runTracker(frames, truths, target, num_particles, weighting, iterations,
+               seed, timings=None, pyramid_levels=0, min_particles=None):
+    """Run Tracker over a sequence the way follow.py does, calling track up
+       to `iterations` times per frame until it locks on
+    
+    :param frames (list): Frames
+    :param truths (list): Target centers
+    :param target (numpy.array): Target template
+    :param num_particles (int): Number of particles
+    :param weighting (str): Tracker weighting mode
+    :param iterations (int): Max track calls per frame
+    :param seed (int): Tracker random seed
+    :param timings (dict): if given, filled with the time spent in each stage
+    :param pyramid_levels (int): Tracker pyramid levels (0: no pyramid)
+    :param min_particles (int): adapt the particle count down to this
+    :return (dict): frames, track calls, calls before the first lock, locked
+                    frames, position errors, particles weighed, and frame
+                    cache and template model counters
+    """
+    tracker = Tracker(target, frames[0], num_particles, weighting=weighting,
+                      rng=seed, pyramid_levels=pyramid_levels,
+                      min_particles=min_particles)
+    if timings is not None:
+        for stage, method in STAGES.items():
+            timings[stage] = []
+            setattr(tracker, method,
+                    timed(getattr(tracker, method), timings[stage]))
+    
+    calls = 0
+    acquire_calls = None
+    locked = 0
+    errors = []
+    particles = 0
+    for i, (frame, truth) in enumerate(zip(frames, truths)):
+        found = False
+        for _ in range(iterations):
+            calls += 1
+            particles += tracker.num_particles
+            found = tracker.track(frame, frame_id=i)
+            if found:
+                break
+        
+        if not found:
+            continue
+        
+        locked += 1
+        if acquire_calls is None:
+            acquire_calls = calls
+        if truth is not None:
+            errors.append(np.hypot(tracker.center[0] - truth[0],
+                                   tracker.center[1] - truth[1]))
+    
+    return {'frames': len(frames), 'calls': calls,
+            'acquire_calls': acquire_calls, 'locked': locked,
+            'errors': errors, 'particles': particles,
+            'cache': tracker.cache.getStats(),
+            'template': tracker.model.getStats()}
+
+def timed(method, times):
+    """Wrap a bound method so each call's duration is appended to `times`
+    
+    :param method (function): Method to wrap
+    :param times (list): Where durations are recorded
+    :return (function): Wrapped method
+    """
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            times.append(time.perf_counter() - start)
+    
+    return wrapper
+
+def benchmark(sequence, res, num_particles, weighting, num_frames=60,
+              iterations=25, seed=0, pyramid_levels=0, target=None,
+              min_particles=None, span_cost=None):
+    """Benchmark one operating point
+    
+    :param sequence (str): 'sim', the path of a photo, or of a segment file
+                           (see loadSequence)
+    :param res (tuple): (width,height) of the frames
+    :param num_particles (int): Number of particles, or the most to use when
+                                min_particles is given
+    :param weighting (str): Tracker weighting mode
+    :param num_frames (int): Sequence length
+    :param iterations (int): Max track calls per frame
+    :param seed (int): Tracker random seed
+    :param pyramid_levels (int): Tracker pyramid levels (0: no pyramid)
+    :param target (numpy.array): Target template, for sequences without
+                                 known target positions
+    :param min_particles (int): adapt the particle count down to this
+    :param span_cost (dict): if given (see measureSpanCost), also time runs
+                             with instrumentation on and off, and estimate
+                             its overhead from the number of spans
+    :return (dict): configuration and measurements
+    """
+    frames, truths, target = loadSequence(sequence, num_frames, res, target)
+    
+    # Timed run
+    timings = {}
+    start = time.perf_counter()
+    run = runTracker(frames, truths, target, num_particles, weighting,
+                     iterations, seed, timings, pyramid_levels, min_particles)
+    elapsed = time.perf_counter() - start
+    
+    # Separate run for memory, since tracing allocations slows everything
+    tracemalloc.start()
+    runTracker(frames, truths, target, num_particles, weighting, iterations,
+               seed, pyramid_levels=pyramid_levels,
+               min_particles=min_particles)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    # Instrumentation on and off, alternating and keeping the fastest of
+    # each. The difference is often lost in run to run noise, so the spans
+    # recorded times their measured cost is reported as well.
+    instrumentation = None
+    if span_cost is not None:
+        instrumentation = {'enabled_s': None, 'disabled_s': None}
+        for enabled in (False, True) * 3:
+            Instrumentation.setEnabled(enabled)
+            Instrumentation.getStats(reset=True)
+            start = time.perf_counter()
+            runTracker(frames, truths, target, num_particles, weighting,
+                       iterations, seed, pyramid_levels=pyramid_levels,
+                       min_particles=min_particles)
+            duration = time.perf_counter() - start
+            key = 'enabled_s' if enabled else 'disabled_s'
+            if instrumentation[key] is None or \
+               duration < instrumentation[key]:
+                instrumentation[key] = round(duration, 6)
+            if enabled:
+                stats = Instrumentation.getStats(reset=True)
+                instrumentation['spans'] = sum(stat['n']
+                                               for stat in stats.values())
+        Instrumentation.setEnabled(True)
+        instrumentation['overhead_pct'] = round(
+            100. * (instrumentation['enabled_s'] /
+                    instrumentation['disabled_s'] - 1.), 2)
+        instrumentation['estimated_pct'] = round(
+            100. * instrumentation['spans'] * span_cost['span_ns'] * 1e-9 /
+            instrumentation['disabled_s'], 4)
+    
+    errors = np.array(run['errors'])
+    stages = {}
+    for stage, times in timings.items():
+        stages[stage] = {'calls': len(times),
+                         'total_s': round(float(np.sum(times)), 6),
+                         'mean_ms': round(1000. * float(np.mean(times)), 4)
+                                    if times else 0.}
+    
+    return {
+        'sequence': os.path.basename(sequence),
+        'res': '%dx%d' % res,
+        'particles': num_particles,
+        'min_particles': min_particles or num_particles,
+        'mean_particles': round(run['particles'] / float(run['calls']), 1),
+        'weighting': weighting,
+        'pyramid': pyramid_levels,
+        'frames': run['frames'],
+        'track_calls': run['calls'],
+        'acquire_calls': run['acquire_calls'],
+        'fps': round(run['frames'] / elapsed, 3),
+        'calls_per_s': round(run['calls'] / elapsed, 3),
+        'stages': stages,
+        'cache': run['cache'],
+        'template': run['template'],
+        'instrumentation': instrumentation,
+        'peak_traced_bytes': peak,
+        'accuracy': {
+            'lock_rate': round(run['locked'] / float(run['frames']), 4),
+            'mean_error_px': round(float(errors.mean()), 3)
+                             if len(errors) else None,
+            'max_error_px': round(float(errors.max()), 3)
+                            if len(errors) else None,
+        },
+    }
+
+def compare(old_path, new_path):
+    """Print how each operating point changed between two result files
+    
+    :param old_path (str): Baseline results
+    :param new_path (str): New results
+    """
+    def key(r):
+        return (r['sequence'], r['res'], r['particles'], r['weighting'],
+                r.get('pyramid', 0), r.get('min_particles', r['particles']))
+    
+    with open(old_path) as f:
+        old = dict((key(r), r) for r in json.load(f)['results'])
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    
+    print('%-18s %-9s %6s %-7s %4s %6s %10s %10s %8s %9s' %
+          ('sequence', 'res', 'parts', 'weigh', 'pyr', 'min', 'fps',
+           'fps new', 'change', 'err new'))
+    for r in new:
+        o = old.get(key(r))
+        if o is None:
+            continue
+        change = (r['fps'] / o['fps'] - 1.) * 100 if o['fps'] else 0.
+        print('%-18s %-9s %6d %-7s %4d %6d %10.2f %10.2f %+7.1f%% %9s' %
+              (key(r) + (o['fps'], r['fps'], change,
+                         r['accuracy']['mean_error_px'])))
+
+def measureSpanCost(calls=200000):
+    """Time a trivial function bare, timed with instrumentation on, and timed
+       with it off
+    
+    :param calls (int): Calls of each
+    :return (dict): nanoseconds per call of each, and the extra cost of a
+                    recorded span
+    """
+    def noop():
+        pass
+    
+    instrumented = Instrumentation.timed('benchmark.noop')(noop)
+    cost = {}
+    for name, function, enabled in (('bare_ns', noop, True),
+                                    ('enabled_ns', instrumented, True),
+                                    ('disabled_ns', instrumented, False)):
+        Instrumentation.setEnabled(enabled)
+        start = time.perf_counter_ns()
+        for _ in range(calls):
+            function()
+        cost[name] = round((time.perf_counter_ns() - start) / float(calls), 1)
+    Instrumentation.setEnabled(True)
+    Instrumentation.getStats(reset=True)
+    cost['span_ns'] = round(cost['enabled_ns'] - cost['bare_ns'], 1)
+    return cost
+
+def getMeta():
+    """Describe the environment the benchmark ran in
+    
+    :return (dict): commit, versions and platform
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    
+    return {'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'opencv': cv2.__version__,
+            'machine': platform.machine(), 'time': int(time.time())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Vision.Tracker')
+    parser.add_argument('--sequences', default='sim,photos',
+                        help="comma separated: 'sim', 'photos' (every image "
+                             "in photos/), image paths or segment files")
+    parser.add_argument('--target', help='target image, for sequences '
+                                         'without known target positions')
+    parser.add_argument('--particles', default='100,250,1000')
+    parser.add_argument('--res', default='370x240,740x480')
+    parser.add_argument('--weighting', default='sparse')
+    parser.add_argument('--pyramid', default='0',
+                        help='comma separated Tracker pyramid levels')
+    parser.add_argument('--min-particles', default='0',
+                        help='comma separated minimum particle counts, to '
+                             'adapt the count down from --particles (0: '
+                             'fixed count)')
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--iterations', type=int, default=25)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--overhead', action='store_true',
+                        help='also time each operating point with '
+                             'instrumentation on and off')
+    parser.add_argument('--output', help='write JSON results here')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files and exit')
+    args = parser.parse_args()
+    
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+    
+    target = None
+    if args.target:
+        target = cv2.imread(args.target)
+        if target is None:
+            sys.exit('Could not load %s' % args.target)
+    
+    sequences = []
+    for name in args.sequences.split(','):
+        if name == 'photos':
+            sequences += sorted(glob.glob(os.path.join(PHOTOS, '*.jpg')))
+        else:
+            sequences.append(name)
+    
+    span_cost = measureSpanCost()
+    results = []
+    for sequence in sequences:
+        for res in args.res.split(','):
+            res = tuple(int(v) for v in res.split('x'))
+            for weighting in args.weighting.split(','):
+                for levels in args.pyramid.split(','):
+                    for num_particles in args.particles.split(','):
+                        for minimum in args.min_particles.split(','):
+                            minimum = min(int(minimum), int(num_particles))
+                            result = benchmark(sequence, res,
+                                               int(num_particles), weighting,
+                                               args.frames, args.iterations,
+                                               args.seed, int(levels), target,
+                                               minimum or None,
+                                               span_cost if args.overhead
+                                               else None)
+                            results.append(result)
+                            print('%(sequence)-18s %(res)-9s %(particles)6d '
+                                  '%(weighting)-7s %(pyramid)d '
+                                  '%(mean_particles)7.1f %(fps)8.2f fps'
+                                  % result)
+    
+    output = {'meta': getMeta(),
+              'span_cost': span_cost,
+              'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+            f.write('\n')
+    else:
+        print(json.dumps(output, indent=1, sort_keys=True))
@@ -4,95 +4,149 @@
 # Follow object test
 #
 from Camera import *
+from Control import *
+from Diagnostics import DiagnosticWriter
 from Motion import *
+from Pipeline import Pipeline
+from Recording import RecordingDrive, SessionRecorder
 from Vision import *
+import Instrumentation
 import numpy as np
 import cv2
 import sys
 import time
 
-def follow(target, speed=50):
+def follow(target, speed=50, session=None, seed=None, raw=False):
     """Track and move toward the object specified
     
     :param target (numpy.array): Object image
     :param speed (int): 0<x<254, Maximum motor speed 
+    :param session (str): Record the run to this segment file, for replay.py
+    :param seed (int): Tracker random seed (default: the time, when
+                       recording)
+    :param raw (bool): Record frames as is rather than as JPEGs, so replay.py
+                       sees exactly what the tracker did
     """
-    drive = Drive()
-    bogiecam = BogieCamera()
-    img = bogiecam.shoot()
-    tracker = Tracker(target, img, 250)
+    drive = MotionScheduler(Drive())
+    search = None
+    bogiecam = BogieCamera(mode='bgr')
+    bogiecam.start()
+    img = bogiecam.getFrame().image
+    recorder = None
+    commands = drive
+    if session is not None:
+        if seed is None:
+            seed = int(time.time())
+        recorder = SessionRecorder(session, raw=raw)
+        recorder.addMeta({'num_particles': 250, 'min_particles': 30,
+                          'iterations': 25, 'seed': seed, 'speed': speed,
+                          'rate': 20., 'raw': raw}, time.time())
+        recorder.addTarget(target, time.time())
+        commands = RecordingDrive(drive, recorder)
+    tracker = Tracker(target, img, 250, rng=seed, min_particles=30)
+    controller = SteeringController(commands, img.shape[1], max_speed=speed)
+    controller.start()
+    diagnostics = DiagnosticWriter('../../output')
+    reporter = Instrumentation.openReporter()
+    Instrumentation.openProfiler()
     img_index = 0
-    i = 0
-    while True:
-        img = bogiecam.shoot()
-        for _ in range(25): # Attempt max 25 iterations of PF
-            found = tracker.track(img)
+    try:
+        for frame in bogiecam.frames():
+            img = frame.image
+            if recorder is not None:
+                recorder.addFrame(img, frame.timestamp, frame.seq)
+            for _ in range(25): # Attempt max 25 iterations of PF
+                with Instrumentation.Span('follow.iteration'):
+                    found = tracker.track(img, frame_id=frame.seq)
+                    if recorder is not None:
+                        recorder.addTrack(time.time(), frame.seq,
+                                          tracker.center if found else None,
+                                          tracker.num_particles,
+                                          tracker.maxrw)
 
-            # Testing / Diagnostic
-            img_index += 1
-            t_img = genTrackingImg(img, tracker)
-            t_target = tracker.target
-            t_img[0:t_target.shape[0],0:t_target.shape[1]] = t_target
-            cv2.imwrite('../../output/'+str(img_index)+'.jpg',t_img)
-            cv2.imwrite('../../output/latest.jpg',t_img)
-            #cv2.imwrite('../../output/'+str(img_index)+'_raw.jpg',img)
-            #cv2.imwrite('../../output/latest_raw.jpg',img)
-            print img_index, tracker.minrw, tracker.maxrw
-            # End Testing / Diagnostic
-            
-            # If target is locked on, proceed.
-            if found:
-                break
+                    # Testing / Diagnostic
+                    img_index += 1
+                    diagnostics.submit(img, tracker.particles,
+                                       tracker.center, tracker.target,
+                                       img_index)
+                    print(img_index, tracker.num_particles, tracker.minrw,
+                          tracker.maxrw)
+                    # End Testing / Diagnostic
+                
+                # If target is locked on, proceed.
+                if found:
+                    break
 
-            drive.stop()
+                # Target lost: the controller stops the rover, unless it
+                # already has (a search turn may be under way)
+                controller.update(None, frame.timestamp)
+                
+            else: # Target not found, turn 0.5 radians to the right. The turn
+                  # runs in the background while we keep tracking, once the
+                  # controller has let go of the drive.
+                controller.disengage()
+                if search is None or search.done():
+                    search = drive.turn(0.5)
+                tracker.resetParticles()
+                continue
             
-        else: # Target not found, turn 0.5 radians to the right
-            drive.turn(0.5)
-            tracker.genNewParticles(100)
-            continue
-        
-        # If target is found, Use the X coordinate of the target position in 
-        # the camera as the steering input.
-        # TODO: May need to implement PID if camera isn't perfectly straight
-        steering = ((2. * tracker.center[1]) / img.shape[1]) - 1
-        print steering
-        drive.drive(speed,steering)
-        
+            # If target is found, the controller steers toward it until the
+            # next frame is processed.
+            controller.update(tracker.center, frame.timestamp)
+    except KeyboardInterrupt:
+        pass
+    
+    controller.stop()
+    diagnostics.close()
+    if recorder is not None:
+        recorder.close()
+        print(recorder.getStats())
+    print(controller.getStats())
+    print(diagnostics.getStats())
+    print(Instrumentation.getStats(cumulative=True))
+    if reporter is not None:
+        reporter.stop()
+    bogiecam.stop()
     drive.shutdown()
     return True
 
-def genTrackingImg(img, tracker):
-    """Generate an image of the tracking progress
+def followPipelined(target, speed=50, report=5.):
+    """Like follow, but with capture, preprocessing, tracking, control and
+       diagnostics running as a pipeline of processes (see Pipeline)
     
-    :param img (numpy.array): camera image
-    :return out (numpy.array): camera image with particles and
-                               best guess rectangle
+    :param target (numpy.array): Object image
+    :param speed (int): 0<x<254, Maximum motor speed
+    :param report (float): seconds between printing the stage counters
     """
-    # Draw the particles
-    out = np.copy(img)
-    for u,v in tracker.particles:
-        if 0 < u < img.shape[0] and 0 < v < img.shape[1]:
-            cv2.circle(out, (v,u), 2, (0,255,255), -1)
-    
-    center = tracker.center
-    target = tracker.target
-    if center is not None:
-        cv2.rectangle(out, (int(center[1]) - target.shape[1]/2,
-                            int(center[0]) - target.shape[0]/2),
-                           (int(center[1]) + target.shape[1]/2,
-                            int(center[0]) + target.shape[0]/2),
-                      (255,255,255), 3)
+    pipeline = Pipeline(target, num_particles=250, speed=speed)
+    pipeline.start()
+    try:
+        while True:
+            time.sleep(report)
+            for stage, stats in sorted(pipeline.getStats().items()):
+                print(stage, stats)
+    except KeyboardInterrupt:
+        pass
     
-    return out
+    pipeline.stop()
+    return True
 
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        exit("Must specify target image file")
+        exit("Must specify target image file (and 'pipeline' to run the "
+             "stages in separate processes, or 'record' to record the run "
+             "for replay.py, and 'raw' to record the frames uncompressed)")
     
     try:
         target = cv2.imread(sys.argv[1])
     except:
         exit("Problem loading target image file")
     
-    follow(target)
+    if len(sys.argv) > 2 and sys.argv[2] == 'pipeline':
+        followPipelined(target)
+    elif len(sys.argv) > 2 and sys.argv[2] == 'record':
+        follow(target, session='../../output/session-%d.bseg' %
+               (time.time() * 1000), raw=sys.argv[3:4] == ['raw'])
+    else:
+        follow(target)
@@ -5,40 +5,58 @@
 #
 from Camera import *
 from Motion import *
+from Vision import Panorama
+import sys
 
-def gatherPhotos(angle):
-    '''Gather images for a panorama
+def capturePanorama(angle, bogiecam, drive, step=0.25):
+    '''Turn through a panorama, stitching frames as they arrive
     
     :param angle (float): How wide of a panorama in radians, from 0 to 2*pi
-    :return photos (list): List of numpy.array images
+    :param bogiecam (BogieCamera): Camera, streaming
+    :param drive (Drive): Drive to turn with
+    :param step (float): Min turn (radians) between stitched frames
+    :return pano (Panorama): Stitched panorama
     '''
-    drive = Drive()
-    num_shots = np.ceil(angle / 0.5)
-    photos = []
+    width, height = bogiecam.camera.resolution
+    pano = Panorama(angle, (width, height))
     
     # Position the camera to the left limit
     drive.turn(-angle/2.)
+    bogiecam.latest() # Skip any frame captured during the turn
     
-    for i in range(num_shots-1)
-        photos.append(bogiecam.shoot())
-        turn = min(0.5,angle-(0.5 * i))
-        drive.turn(turn)
+    # Sweep right at a constant rate; the heading of each frame is
+    # estimated from its timestamp, and the stitcher refines it
+    start = time.time()
+    duration = drive.startTurn(angle)
+    rate = angle / duration
+    last_heading = 0.
+    pano.add(bogiecam.getFrame().image, 0.)
+    for frame in bogiecam.frames():
+        heading = min(angle, (frame.timestamp - start) * rate)
+        if heading - last_heading >= step or heading >= angle:
+            pano.add(frame.image, heading - last_heading)
+            last_heading = heading
+        if frame.timestamp - start >= duration:
+            break
+    drive.stop()
     
-    # Return the rober to the original heading
-    drive.turn(-angle)
-    
-    return photos
+    # Return the rover to the original heading
+    drive.turn(-angle/2.)
+    return pano
 
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         exit("Must specify an angle (in radians)")
     
-    bogiecam = BogieCamera()
     try:
-        photos = gatherPhotos(float(sys.argv[1]))
-    except:
+        angle = min(2 * np.pi, float(sys.argv[1]))
+    except ValueError:
         exit("Invalid angle")
     
-    #pano = bogiecam.makePanorama(photos)
-    cv2.imwrite("pano.jpg", pano)
+    bogiecam = BogieCamera(mode='bgr')
+    bogiecam.start()
+    pano = capturePanorama(angle, bogiecam, Drive())
+    bogiecam.stop()
+    print(pano.counters)
+    cv2.imwrite("pano.jpg", pano.getImage())
@@ -0,0 +1,209 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Session replay
+#
+# Feeds a recorded session (see Recording.SessionRecorder, and follow.py's
+# 'record' mode) back through Vision.Tracker and Control.SteeringController
+# as fast as they'll go, on a simulated clock, and compares what they do with
+# what the rover did. A replay of unchanged code repeats the run exactly
+# when the frames were recorded raw (follow.py's 'record raw' mode) and none
+# were dropped; JPEG frames only come close. Change the code or the
+# parameters to see how the same run would have gone. Example:
+#
+#   python replay.py ../../output/session-1700000000000.bseg
+#   python replay.py session.bseg --particles 500 --min-particles 50 \
+#                    --output replay.json
+#
+from Control import SteeringController
+from Recording import SegmentReader
+from Vision import Tracker
+import Instrumentation
+import argparse
+import bisect
+import collections
+import cv2
+import itertools
+import json
+import numpy as np
+import sys
+import time
+
+def replay(reader, target=None, num_particles=None, min_particles=None,
+           pyramid_levels=None, iterations=None, seed=None, rate=None,
+           speed=None):
+    """Replay a session. Parameters left as None take the recorded setting.
+    
+    :param reader (SegmentReader): Recorded session
+    :param target (numpy.array): Target image (default: the recorded one)
+    :param num_particles (int): Tracker particles (maximum, if adapting)
+    :param min_particles (int): Tracker minimum particles, or 0 for a fixed
+                                count
+    :param pyramid_levels (int): Tracker pyramid levels
+    :param iterations (int): Max tracking attempts per frame
+    :param seed (int): Tracker random seed
+    :param rate (float): Control loop rate in Hz
+    :param speed (int): Controller max speed
+    :return report (dict): frames, frames dropped from the recording,
+                           locks, agreement with the recorded run, command
+                           counts and differences, replay time and speedup
+                           over the session's duration
+    """
+    meta = reader.getMeta()
+    if target is None:
+        target = reader.getTarget()
+    if target is None:
+        raise ValueError('Session has no target; one must be given')
+    
+    def setting(value, name, default):
+        return value if value is not None else meta.get(name, default)
+    
+    num_particles = setting(num_particles, 'num_particles', 250)
+    min_particles = setting(min_particles, 'min_particles', 0)
+    pyramid_levels = setting(pyramid_levels, 'pyramid_levels', 0)
+    iterations = setting(iterations, 'iterations', 25)
+    seed = setting(seed, 'seed', 0)
+    rate = setting(rate, 'rate', 20.)
+    speed = setting(speed, 'speed', 50)
+    
+    # What the rover did: tracker outputs by frame, in the order they were
+    # reported, and the commands it was sent
+    recorded = collections.defaultdict(list)
+    for seq, timestamp, center, particles, maxrw in reader.tracks():
+        recorded[seq].append((timestamp, center))
+    commands = list(reader.commands())
+    command_times = [c[0] for c in commands]
+    dropped = len(list(reader.dropped()))
+    
+    frames = reader.frames()
+    first = next(frames, None)
+    if first is None:
+        raise ValueError('Session has no frames')
+    
+    seq, timestamp, img = first
+    tracker = Tracker(target, img, num_particles, rng=seed,
+                      pyramid_levels=pyramid_levels,
+                      min_particles=min_particles or None)
+    controller = SteeringController(None, img.shape[1], rate=rate,
+                                    max_speed=speed)
+    ticks = [timestamp]
+    sent = []
+    
+    def advance(now):
+        """Run the control ticks due up to now
+        """
+        while ticks[0] <= now:
+            command = controller.step(ticks[0])
+            if command is not None:
+                sent.append((ticks[0],) + command)
+            ticks[0] += controller.period
+    
+    counters = {'frames': 0, 'locks': 0, 'agree': 0, 'compared': 0,
+                'tracks': 0}
+    errors = []
+    start = time.perf_counter()
+    for seq, timestamp, img in itertools.chain([first], frames):
+        counters['frames'] += 1
+        outputs = recorded.get(seq, [])
+        for k in range(iterations): # As follow does
+            found = tracker.track(img, frame_id=seq)
+            counters['tracks'] += 1
+            # Apply the output when the rover did, if it got this far
+            reported = outputs[k][0] if k < len(outputs) else timestamp
+            advance(reported)
+            if found:
+                break
+            controller.update(None, timestamp)
+        else:
+            controller.disengage()
+            tracker.resetParticles()
+        
+        if found:
+            counters['locks'] += 1
+            controller.update(tracker.center, timestamp)
+        
+        if outputs:
+            counters['compared'] += 1
+            center = outputs[-1][1]
+            if (center is not None) == bool(found):
+                counters['agree'] += 1
+            if found and center is not None:
+                errors.append(np.hypot(tracker.center[0] - center[0],
+                                       tracker.center[1] - center[1]))
+    advance(max([timestamp] + command_times))
+    elapsed = time.perf_counter() - start
+    
+    # Pair each replayed command with the nearest recorded one
+    differences = []
+    for when, sent_speed, sent_steering in sent if commands else []:
+        i = bisect.bisect_left(command_times, when)
+        nearest = min((j for j in (i - 1, i) if 0 <= j < len(commands)),
+                      key=lambda j: abs(command_times[j] - when))
+        differences.append((abs(sent_speed - commands[nearest][1]),
+                            abs(sent_steering - commands[nearest][2])))
+    
+    duration = reader.timestamps[-1] - reader.timestamps[0]
+    report = dict(counters)
+    report.update({
+        'dropped': dropped,
+        'raw': meta.get('raw', False),
+        'settings': {'num_particles': num_particles,
+                     'min_particles': min_particles,
+                     'pyramid_levels': pyramid_levels,
+                     'iterations': iterations, 'seed': seed, 'rate': rate,
+                     'speed': speed},
+        'agreement': counters['agree'] / float(max(1, counters['compared'])),
+        'center_error': float(np.mean(errors)) if errors else None,
+        'commands': {'recorded': len(commands), 'replayed': len(sent)},
+        'duration_s': round(duration, 3),
+        'replay_s': round(elapsed, 3),
+        'speedup': round(duration / elapsed, 2) if elapsed > 0 else None,
+        'template': tracker.model.getStats(),
+        'instrumentation': Instrumentation.getStats()})
+    if differences:
+        differences = np.array(differences)
+        report['commands']['speed_diff'] = float(differences[:,0].mean())
+        report['commands']['steering_diff'] = float(differences[:,1].mean())
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded session '
+                                                 'through the tracker and '
+                                                 'controller')
+    parser.add_argument('session', help='session segment file')
+    parser.add_argument('--target', help='target image (default: the '
+                                         'recorded one)')
+    parser.add_argument('--particles', type=int)
+    parser.add_argument('--min-particles', type=int,
+                        help='adapt the count down to this (0: fixed count)')
+    parser.add_argument('--pyramid', type=int, help='Tracker pyramid levels')
+    parser.add_argument('--iterations', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--rate', type=float, help='control loop rate in Hz')
+    parser.add_argument('--speed', type=int, help='controller max speed')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+    
+    target = None
+    if args.target:
+        target = cv2.imread(args.target)
+        if target is None:
+            sys.exit('Could not load %s' % args.target)
+    
+    reader = SegmentReader(args.session)
+    try:
+        report = replay(reader, target, args.particles, args.min_particles,
+                        args.pyramid, args.iterations, args.seed, args.rate,
+                        args.speed)
+    except ValueError as e:
+        sys.exit(str(e))
+    finally:
+        reader.close()
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+            f.write('\n')
+    else:
+        print(json.dumps(report, indent=1, sort_keys=True))
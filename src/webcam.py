@@ -4,6 +4,9 @@
 # Webcam Program
 # 
 from Camera import *
+from Recording import EventRecorder, SessionRecorder
+from Vision import MotionDetector
+import Instrumentation
 import cv2
 import sys
 import time
@@ -30,26 +33,56 @@ def compareMSE(img1, img2, sigma=10.):
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        exit("Must specify output directory")
+        exit("Must specify output directory (and 'record' to record segments "
+             "around motion instead of single frames, or 'session' to record "
+             "every frame to one)")
     
-    bogiecam = BogieCamera()
-    res = bogiecam.camera.resolution
-    pixels = float(res[0] * res[1])
-    picture = bogiecam.shoot()
-    picture_edges = cv2.Canny(picture,100,200)
+    recorder = None
+    session = None
+    if len(sys.argv) > 2 and sys.argv[2] == 'record':
+        recorder = EventRecorder(sys.argv[1])
+    elif len(sys.argv) > 2 and sys.argv[2] == 'session':
+        session = SessionRecorder('%s/session-%d.bseg' % (sys.argv[1],
+                                                          time.time() * 1000))
+    
+    reporter = Instrumentation.openReporter()
+    Instrumentation.openProfiler()
+    bogiecam = BogieCamera(mode='bgr')
+    detector = MotionDetector()
+    bogiecam.start()
+    picture = bogiecam.getFrame().image
+    detector.detect(picture)
     filename = sys.argv[1]+'/'+str(int(time.time()))+'.jpg'
     cv2.imwrite(filename, picture)
     
-    while True:
-        img = bogiecam.shoot()
-        img_edges = cv2.Canny(img,100,200)
-        diff = len(img_edges[img_edges != picture_edges]) / pixels
-        print diff
-        if diff > 0.005:
-            print time.time()
-            filename = sys.argv[1]+'/'+str(int(time.time()))+'.jpg'
-            cv2.imwrite(filename, img)
-        
-        picture = img
-        picture_edges = img_edges
-
+    try:
+        for frame in bogiecam.frames():
+            img = frame.image
+            motion = detector.detect(img)
+            if session is not None:
+                session.addFrame(img, frame.timestamp, frame.seq)
+            if recorder is not None:
+                recorder.add(img, frame.timestamp, frame.seq)
+                if motion:
+                    recorder.trigger(frame.timestamp)
+            if motion:
+                print(frame.timestamp, detector.changed, detector.regions)
+                if recorder is None: # Milliseconds and frame number, so
+                                     # frames in the same second don't clash
+                    filename = '%s/%d-%d.jpg' % (sys.argv[1],
+                                                 frame.timestamp * 1000,
+                                                 frame.seq)
+                    cv2.imwrite(filename, img)
+    except KeyboardInterrupt:
+        pass
+    
+    bogiecam.stop()
+    if recorder is not None:
+        recorder.close()
+        print(recorder.getStats())
+    if session is not None:
+        session.close()
+        print(session.getStats())
+    print(Instrumentation.getStats(cumulative=True))
+    if reporter is not None:
+        reporter.stop()
@@ -0,0 +1,10 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Test configuration: the modules live flat in src/
+#
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
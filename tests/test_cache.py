@@ -0,0 +1,42 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Frame cache tests
+#
+from Vision import FrameCache
+import numpy as np
+import pytest
+
+def test_frame_id_identifies_frames():
+    cache = FrameCache()
+    img = np.zeros((48, 64, 3), dtype=np.uint8)
+    assert not cache.getEntry(img, frame_id=1)[1]
+    img[5,5] = 255 # Same id, so the same frame, whatever the pixels
+    assert cache.getEntry(img, frame_id=1)[1]
+    assert not cache.getEntry(img, frame_id=2)[1]
+    assert cache.getStats()['hits'] == 1
+
+
+def test_reused_buffer_without_id():
+    cache = FrameCache()
+    img = np.zeros((480, 640, 3), dtype=np.uint8)
+    entry, cached = cache.getEntry(img)
+    assert not cached
+    assert cache.getEntry(img)[0] is entry
+    
+    img[1,1] = 1 # A new capture into the same buffer
+    entry, cached = cache.getEntry(img)
+    assert not cached
+    assert cache.getEntry(img.copy())[0] is entry
+
+
+def test_size_bounded():
+    cache = FrameCache(size=2)
+    img = np.zeros((8, 8), dtype=np.uint8)
+    for k in range(5):
+        cache.getEntry(img, frame_id=k)
+    assert cache.getStats()['frames'] == 2
+    assert not cache.getEntry(img, frame_id=0)[1]
+    
+    with pytest.raises(ValueError):
+        FrameCache(size=0)
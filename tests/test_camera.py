@@ -0,0 +1,89 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Camera tests, against the simulated cameras
+#
+from Camera import BogieCamera
+from Simulation import ReplayCamera, SimCamera, World
+import numpy as np
+import pytest
+
+RES = (320, 240) # Already a multiple of 32x16, so only yuv is padded
+ODD_RES = (330, 250) # Padded to 352x256
+
+def openCamera(backend, mode, res=RES, **kwargs):
+    """BogieCamera on a simulated camera, fast enough not to pace the tests
+    """
+    camera = ReplayCamera() if backend == 'replay' else \
+             SimCamera(world=World())
+    return BogieCamera(res, framerate=1000, mode=mode, camera=camera,
+                       **kwargs)
+
+def expectedShape(mode, res):
+    width, height = res
+    pad_width = (width + 31) // 32 * 32
+    pad_height = (height + 15) // 16 * 16
+    return {'jpeg': (height, width, 3), 'bgr': (height, width, 3),
+            'yuv': (pad_height * 3 // 2, pad_width),
+            'gray': (height, width)}[mode]
+
+
+@pytest.mark.parametrize('backend', ['replay', 'sim'])
+@pytest.mark.parametrize('mode', BogieCamera.modes)
+@pytest.mark.parametrize('res', [RES, ODD_RES])
+def test_shoot_shape_and_dtype(backend, mode, res):
+    cam = openCamera(backend, mode, res)
+    img = cam.shoot()
+    assert img.shape == expectedShape(mode, res)
+    assert img.dtype == np.uint8
+    assert img.any()
+
+@pytest.mark.parametrize('mode', ['bgr', 'yuv', 'gray'])
+def test_shoot_reuses_capture_buffer(mode):
+    cam = openCamera('replay', mode)
+    first = cam.shoot()
+    second = cam.shoot()
+    assert np.shares_memory(first, cam.buffer)
+    assert np.shares_memory(second, cam.buffer)
+
+def test_jpeg_has_no_capture_buffer():
+    cam = openCamera('replay', 'jpeg')
+    assert cam.buffer is None
+
+def test_gray_is_the_y_plane():
+    yuv = openCamera('replay', 'yuv').shoot()
+    gray = openCamera('replay', 'gray').shoot()
+    assert np.array_equal(gray, yuv[:RES[1],:RES[0]])
+
+@pytest.mark.parametrize('mode', ['bgr', 'yuv', 'gray'])
+def test_streaming_reuses_ring_buffers(mode):
+    cam = openCamera('sim', mode, ring_size=3)
+    cam.start()
+    try:
+        seen = set()
+        for _ in range(12):
+            frame = cam.getFrame(timeout=5.)
+            assert frame is not None
+            assert frame.image.shape == expectedShape(mode, RES)
+            slots = [i for i, buf in enumerate(cam.ring)
+                     if np.shares_memory(frame.image, buf)]
+            assert len(slots) == 1
+            seen.add(slots[0])
+    finally:
+        cam.stop()
+    
+    assert len(cam.ring) == 3
+    assert len(seen) > 1 # Frames rotate through the ring...
+    assert not np.shares_memory(cam.ring[0], cam.buffer) # ...not shoot's
+
+def test_streaming_needs_a_ring():
+    cam = openCamera('replay', 'bgr', ring_size=0)
+    assert cam.ring == []
+    with pytest.raises(ValueError):
+        cam.start()
+    with pytest.raises(ValueError):
+        openCamera('replay', 'bgr', ring_size=2)
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        openCamera('replay', 'rgb')
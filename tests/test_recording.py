@@ -0,0 +1,57 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Recording tests
+#
+from Recording import (EXTENSION, EventRecorder, SegmentReader,
+                       SegmentWriter, SessionRecorder)
+import glob
+import numpy as np
+import os
+import threading
+import time
+
+def test_event_recorder_drops_rather_than_blocks(tmp_path, monkeypatch):
+    # Hold the writer thread up on the first frame, as a slow encoder would
+    release = threading.Event()
+    addFrame = SegmentWriter.addFrame
+    def slowAddFrame(self, *args, **kwargs):
+        release.wait()
+        return addFrame(self, *args, **kwargs)
+    monkeypatch.setattr(SegmentWriter, 'addFrame', slowAddFrame)
+    
+    recorder = EventRecorder(str(tmp_path), pre_roll=2, post_roll=50,
+                             queue_size=5)
+    img = np.zeros((24, 32, 3), dtype=np.uint8)
+    start = time.perf_counter()
+    recorder.add(img, 0., 0)
+    recorder.trigger(0.)
+    for seq in range(1, 41):
+        recorder.add(img, seq / 30., seq)
+    assert time.perf_counter() - start < 5 # Nothing waited on the writer
+    
+    release.set()
+    recorder.close()
+    stats = recorder.getStats()
+    assert stats['dropped'] > 0
+    assert stats['frames'] + stats['dropped'] == 41
+    
+    paths = glob.glob(os.path.join(str(tmp_path), '*' + EXTENSION))
+    assert len(paths) == 1
+    reader = SegmentReader(paths[0])
+    recorded = [seq for seq, timestamp, frame in reader.frames()]
+    dropped = [seq for seq, timestamp in reader.dropped()]
+    reader.close()
+    assert len(recorded) == stats['frames']
+    assert sorted(recorded + dropped) == list(range(41))
+
+
+def test_session_recorder_creates_directory(tmp_path):
+    path = os.path.join(str(tmp_path), 'output', 'session-1' + EXTENSION)
+    recorder = SessionRecorder(path)
+    recorder.addFrame(np.zeros((24, 32, 3), dtype=np.uint8), 0., 0)
+    recorder.close()
+    
+    reader = SegmentReader(path)
+    assert [seq for seq, timestamp, frame in reader.frames()] == [0]
+    reader.close()
@@ -0,0 +1,86 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Resampling and tracker seeding tests
+#
+from Vision import Resampler, Tracker
+import cv2
+import numpy as np
+import pytest
+
+def movingFrames(n, res=(370, 240)):
+    """A target moving over a textured backdrop
+    
+    :return (tuple): target image, and n frames
+    """
+    width, height = res
+    backdrop = np.random.default_rng(3).integers(0, 255, (height, width, 3),
+                                                 dtype=np.uint8)
+    backdrop = cv2.GaussianBlur(backdrop, (0, 0), 3)
+    target = np.full((32, 32, 3), 130, dtype=np.uint8)
+    cv2.circle(target, (16, 16), 11, (40, 40, 200), -1)
+    
+    frames = []
+    for k in range(n):
+        img = backdrop.copy()
+        top = height // 2 - 16 + k * 3
+        left = width // 2 - 16 + k * 5
+        img[top:top+32,left:left+32] = target
+        frames.append(img)
+    return target, frames
+
+
+def test_same_seed_same_particles():
+    target, frames = movingFrames(5)
+    trackers = [Tracker(target, frames[0], 100, rng=7) for _ in range(2)]
+    assert np.array_equal(trackers[0].particles, trackers[1].particles)
+    
+    for img in frames:
+        for _ in range(10): # Until a lock, as follow does
+            found = [tracker.track(img) for tracker in trackers]
+            assert found[0] == found[1]
+            assert np.array_equal(trackers[0].particles,
+                                  trackers[1].particles)
+            assert np.array_equal(trackers[0].weights, trackers[1].weights)
+            assert trackers[0].center == trackers[1].center
+            if found[0]:
+                break
+    assert trackers[0].center is not None
+
+def test_different_seed_different_particles():
+    target, frames = movingFrames(1)
+    first = Tracker(target, frames[0], 100, rng=7)
+    second = Tracker(target, frames[0], 100, rng=8)
+    assert not np.array_equal(first.particles, second.particles)
+
+@pytest.mark.parametrize('method', Resampler.methods)
+@pytest.mark.parametrize('n', [None, 50, 400])
+def test_resampling_keeps_count_and_favours_heavy_weights(method, n):
+    rng = np.random.default_rng(0)
+    particles = rng.integers(0, 500, (200, 2))
+    weights = np.full(200, 0.1 / 199)
+    weights[17] = 0.9 # One heavy particle
+    resampler = Resampler(method, jitter=0, rng=1)
+    
+    indices = resampler.getIndices(weights, n)
+    expected = 200 if n is None else n
+    assert len(indices) == expected
+    assert indices.min() >= 0 and indices.max() < 200
+    assert abs(np.mean(indices == 17) - 0.9) < 0.05
+    
+    resampled = resampler.resample(particles, weights, n)
+    assert resampled.shape == (expected, 2)
+    heavy = np.all(resampled == particles[17], axis=1)
+    assert abs(np.mean(heavy) - 0.9) < 0.05
+
+@pytest.mark.parametrize('method', Resampler.methods)
+def test_resampling_jitter_is_bounded(method):
+    particles = np.full((100, 2), 50)
+    weights = np.full(100, 0.01)
+    resampled = Resampler(method, jitter=3, rng=2).resample(particles,
+                                                            weights)
+    assert np.abs(resampled - 50).max() <= 3
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        Resampler('multinomial')
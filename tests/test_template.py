@@ -0,0 +1,74 @@
+# Nathan Harmon
+# https://github.com/nharmon/bogie-five
+#
+# Template model tests: the scale bank only rescales on real size changes
+#
+from Simulation import PHOTOS
+from Vision import TemplateModel, Tracker
+from benchmark import loadSequence
+import cv2
+import numpy as np
+import os
+import pytest
+
+def track(tracker, frames, iterations=25):
+    """Run a tracker over frames as follow does
+    
+    :return locks (int): frames the target was locked on
+    """
+    locks = 0
+    for k, img in enumerate(frames):
+        for _ in range(iterations):
+            if tracker.track(img, frame_id=k):
+                locks += 1
+                break
+    return locks
+
+
+@pytest.mark.parametrize('name', ['sim', 'bogie_five1.jpg'])
+def test_fixed_size_keeps_scale(name):
+    if name != 'sim':
+        name = os.path.join(PHOTOS, name)
+    frames, truths, target = loadSequence(name, 60, (370, 240))
+    tracker = Tracker(target, frames[0], 250, rng=0)
+    assert track(tracker, frames) > 0
+    assert tracker.model.scale == 1.0
+    assert tracker.model.getStats()['rescaled'] == 0
+
+
+def test_growing_target_rescales():
+    rng = np.random.default_rng(1)
+    background = cv2.GaussianBlur(rng.integers(0, 255, (480, 740, 3),
+                                               dtype=np.uint8), (0, 0), 4)
+    target = np.full((48, 48, 3), 130, dtype=np.uint8)
+    cv2.circle(target, (24, 24), 16, (40, 40, 200), -1)
+    cv2.rectangle(target, (18, 18), (30, 30), (255, 255, 255), -1)
+    
+    frames = []
+    for k in range(60): # Grows to three times its size
+        n = int(round(48 * (1 + 2 * k / 59.)))
+        img = background.copy()
+        top, left = 240 - n // 2, int(370 + 100 * np.sin(k / 10.)) - n // 2
+        img[top:top+n,left:left+n] = cv2.resize(target, (n, n))
+        frames.append(img)
+    
+    tracker = Tracker(target, frames[0], 250, rng=0)
+    assert track(tracker, frames) > 50
+    assert tracker.model.scale > 2.5
+
+
+def test_rescale_needs_consecutive_wins():
+    model = TemplateModel(np.zeros((20, 20), dtype=np.uint8), confirm=3)
+    assert model.propose(0.9) is None
+    assert model.propose(0.9) is None
+    assert model.propose(None) is None # A lock the template won
+    assert model.propose(0.9) is None
+    assert model.propose(1.1) is None
+    assert model.scale == 1.0
+    
+    model.propose(1.1)
+    assert model.propose(1.1).shape == (22, 22) # Third win in a row
+    assert model.scale == 1.1
+    
+    with pytest.raises(ValueError):
+        TemplateModel(np.zeros((20, 20), dtype=np.uint8), confirm=0)